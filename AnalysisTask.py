@@ -6,6 +6,8 @@ import time
 
 import Kernels
 import Signals
+from FramePass import consumeFrames
+import ResultCache
 from GFSVis import visualizeGFS
 from Grid import makeDomain
 from ColorMap import *
@@ -110,6 +112,48 @@ def readAnalysisProject( fileName ):
     
     return tasks
     
+def executeTasks( tasks ):
+    '''Executes the given tasks, in order.  The computations of tasks which analyze the same
+    scb file are performed first, in a single shared pass over the file (see
+    FramePass.consumeFrames), so the file is only read once.  The computations still run one
+    after another; tasks which compute with several worker processes don't share the pass.
+    The remaining work of each task is then performed by the task itself.
+
+    @param      tasks           A list of AnalysisTask instances.
+    '''
+    # the tasks which can share their computation, grouped by scb file
+    groups = {}
+    computed = []
+    for task in tasks:
+        if ( task.work & AnalysisTask.COMPUTE and task.canShareComputation() ):
+            if ( task.fetchResults() ):
+                computed.append( task )
+                continue
+            key = os.path.normcase( os.path.abspath( task.scbName ) )
+            if ( groups.has_key( key ) ):
+                groups[ key ].append( task )
+            else:
+                groups[ key ] = [ task ]
+
+    for group in groups.values():
+        if ( len( group ) < 2 ):
+            continue
+        print 'Shared pass for %d tasks: %s' % ( len( group ), ', '.join( [ t.workName for t in group ] ) )
+        print "\tAccessing scb file:", group[0].scbName
+        frameSet = NPFrameSet( group[0].scbName )
+        consumers = []
+        for task in group:
+            consumers += task.frameConsumers( frameSet )
+        s = time.clock()
+        count = consumeFrames( frameSet, consumers )
+        print '\t\t%d frames done in %.2f seconds' % ( count, time.clock() - s )
+        for task in group:
+            task.storeResults()
+        computed += group
+
+    for task in tasks:
+        task.execute( task in computed )
+    
 class AnalysisTask:
     # Work to be performed by the task
     NO_WORK = 0
@@ -160,6 +204,8 @@ class AnalysisTask:
         self.workFldr = '.'
         self.obstName = ''
         self.active = False
+        self.workerCount = 1
+        self.cacheSize = 0
 
     def setSCBFile( self, fileName ):
         '''Sets the scb file name for the analysis task.
@@ -208,6 +254,22 @@ class AnalysisTask:
         #   Future versions will make use of this.
         self.obstName = fileName
 
+    def setWorkerCount( self, count ):
+        '''Sets the number of worker processes the task may use to compute its results.
+
+        @param      count       An int.  The number of worker processes.  If one, the work is
+                                performed in this process.
+        '''
+        self.workerCount = max( 1, count )
+
+    def setCacheSize( self, size ):
+        '''Sets the maximum size of the cache of computed results in the task's work folder.
+
+        @param      size        An int.  The maximum size of the cache (in bytes).  If zero
+                                (the default), results are neither cached nor reused.
+        '''
+        self.cacheSize = size
+
     def setActiveState( self, state ):
         '''Sets the active state of the task - the active state determines whether the task
         work should be performed or not.
@@ -216,8 +278,73 @@ class AnalysisTask:
         '''
         self.active = state
         
-    def execute( self ):
-        '''Execute the task'''
+    def execute( self, computed=False ):
+        '''Execute the task
+
+        @param      computed        A boolean.  If True, the task's computation has already been
+                                    performed (see executeTasks) and only the remaining work
+                                    is done.
+        '''
+        raise AttributeError, "execute not instantiated for this class: %s" % ( str( self.__class__ ) )
+
+    def cacheParameters( self ):
+        '''Reports the values the task's computed results depend on.  Tasks with identical
+        parameters compute identical results (with the same version of the analysis code).
+
+        @returns    A list of values (see ResultCache.makeKey).
+        '''
+        return [ self.typeStr(), ResultCache.fileIdentity( self.scbName ),
+                 ResultCache.fileIdentity( self.obstName ), self.timeStep ]
+
+    def resultFiles( self ):
+        '''Reports the files which hold the task's computed results.
+
+        @returns    A list of strings.  The names of the files.
+        '''
+        raise AttributeError, "resultFiles not instantiated for this class: %s" % ( str( self.__class__ ) )
+
+    def getCache( self ):
+        '''Returns the cache of computed results in the task's work folder, or None if
+        results aren't cached.'''
+        if ( self.cacheSize <= 0 ):
+            return None
+        return ResultCache.ResultCache( os.path.join( self.workFldr, ResultCache.CACHE_FOLDER ), self.cacheSize )
+
+    def fetchResults( self ):
+        '''Replaces the task's results with cached results computed from identical inputs.
+
+        @returns    A boolean.  True if cached results were found (and the task's computation
+                    can be skipped).
+        '''
+        cache = self.getCache()
+        if ( cache is None ):
+            return False
+        if ( cache.fetch( ResultCache.makeKey( *self.cacheParameters() ), self.resultFiles() ) ):
+            print "\tReusing cached results for %s" % ( self.workName )
+            return True
+        return False
+
+    def storeResults( self ):
+        '''Adds the task's computed results to the cache.'''
+        cache = self.getCache()
+        if ( cache is not None ):
+            cache.store( ResultCache.makeKey( *self.cacheParameters() ), self.resultFiles() )
+
+    def canShareComputation( self ):
+        '''Reports if the task's computation can be performed as part of a shared pass over
+        its scb file (see frameConsumers).
+
+        @returns    A boolean.  True if the computation can be shared.
+        '''
+        return False
+
+    def frameConsumers( self, frameSet ):
+        '''Creates the consumers which perform the task's computation as part of a shared
+        pass over its scb file (see executeTasks).
+
+        @param      frameSet        An instance of NPFrameSet.  The task's scb data.
+        @returns    A list of FramePass.FrameConsumer instances.
+        '''
         raise NotImplementedError
 
     @staticmethod
@@ -355,6 +482,10 @@ class DomainAnalysisTask( AnalysisTask ):
         self.domainX = Vector2( minX, maxX )
         self.domainY = Vector2( minY, maxY )
 
+    def cacheParameters( self ):
+        return AnalysisTask.cacheParameters( self ) + [ ( self.domainX[0], self.domainX[1] ),
+                                                        ( self.domainY[0], self.domainY[1] ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
@@ -392,6 +523,9 @@ class DiscreteAnalysisTask( DomainAnalysisTask ):
         '''
         self.cellSize = h
 
+    def cacheParameters( self ):
+        return DomainAnalysisTask.cacheParameters( self ) + [ self.cellSize ]
+
     def setColorMap( self, mapName ):
         '''Sets the name of the color map to use in visualization.
 
@@ -441,7 +575,14 @@ class DensityAnalysisTask( DiscreteAnalysisTask ):
         '''
         self.smoothParam = h
 
-    def execute( self ):
+    def cacheParameters( self ):
+        return DiscreteAnalysisTask.cacheParameters( self ) + [ 'GaussianKernel', self.smoothParam ]
+
+    def resultFiles( self ):
+        dataFile = os.path.join( self.getWorkPath( 'density' ), self.workName ) + '.density'
+        return [ dataFile, dataFile + Crowd.STATS_EXT ]
+
+    def execute( self, computed=False ):
         '''Perform the work of the task'''
         if ( self.work ):
             print 'Density analysis: %s' % ( self.workName )
@@ -449,8 +590,8 @@ class DensityAnalysisTask( DiscreteAnalysisTask ):
             frameSet = NPFrameSet( self.scbName )
             workPath = self.getWorkPath( 'density' )
             tempFile = os.path.join( workPath, self.workName )
-            grids = Crowd.GridFileSequence( tempFile )
-            if ( self.work & AnalysisTask.COMPUTE ):
+            grids = Crowd.GridFileSequence( tempFile, workerCount=self.workerCount )
+            if ( self.work & AnalysisTask.COMPUTE and not computed and not self.fetchResults() ):
                 print "\tComputing"
                 kernel = Kernels.GaussianKernel( self.smoothParam, self.cellSize, False )
                 domain = makeDomain( self.domainX, self.domainY, self.cellSize )
@@ -460,6 +601,7 @@ class DensityAnalysisTask( DiscreteAnalysisTask ):
                 s = time.clock()
                 grids.convolveSignal( domain, kernel, signal, frameSet )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
+                self.storeResults()
             if ( self.work & AnalysisTask.VIS ):
                 dataFile = grids.outFileName + ".density"
                 if ( not os.path.exists( dataFile ) ):
@@ -474,9 +616,22 @@ class DensityAnalysisTask( DiscreteAnalysisTask ):
                     print '\tError loading color map: "%s", loading flame instead' % ( self.colorMapName )
                     colorMap = COLOR_MAPS[ 'flame' ]
                 print '\tCreating images'
-                visualizeGFS( reader, colorMap, imageName, self.outImgType, 1.0, None )
+                visualizeGFS( reader, colorMap, imageName, self.outImgType, 1.0, None, workerCount=self.workerCount )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s ) 
 
+    def canShareComputation( self ):
+        # multiple workers compute the grids faster on their own
+        return self.workerCount == 1
+
+    def frameConsumers( self, frameSet ):
+        tempFile = os.path.join( self.getWorkPath( 'density' ), self.workName )
+        grids = Crowd.GridFileSequence( tempFile )
+        kernel = Kernels.GaussianKernel( self.smoothParam, self.cellSize, False )
+        domain = makeDomain( self.domainX, self.domainY, self.cellSize )
+        sigDomain = makeDomain( self.domainX, self.domainY )
+        signal = Signals.PedestrianSignal( sigDomain ) # signal domain is the same as convolution domain
+        return [ grids.convolveConsumer( domain, kernel, signal ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
@@ -496,7 +651,7 @@ class SpeedAnalysisTask( DiscreteAnalysisTask ):
     def __init__( self ):
         DiscreteAnalysisTask.__init__( self )
 
-    def execute( self ):
+    def execute( self, computed=False ):
         '''Perform the work of the task'''
         if ( self.work ):
             print 'Speed analysis: %s' % ( self.workName )
@@ -504,13 +659,14 @@ class SpeedAnalysisTask( DiscreteAnalysisTask ):
             frameSet = NPFrameSet( self.scbName )
             workPath = self.getWorkPath( 'speed' )
             tempFile = os.path.join( workPath, self.workName )
-            grids = Crowd.GridFileSequence( tempFile )
-            if ( self.work & AnalysisTask.COMPUTE ):
+            grids = Crowd.GridFileSequence( tempFile, workerCount=self.workerCount )
+            if ( self.work & AnalysisTask.COMPUTE and not computed and not self.fetchResults() ):
                 print "\tComputing"
                 domain = makeDomain( self.domainX, self.domainY, self.cellSize )
                 s = time.clock()
                 grids.computeSpeeds( domain, frameSet, self.timeStep )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
+                self.storeResults()
             if ( self.work & AnalysisTask.VIS ):
                 dataFile = grids.outFileName + ".speed"
                 if ( not os.path.exists( dataFile ) ):
@@ -525,9 +681,22 @@ class SpeedAnalysisTask( DiscreteAnalysisTask ):
                     print '\tError loading color map: "%s", loading flame instead' % ( self.colorMapName )
                     colorMap = COLOR_MAPS[ 'flame' ]
                 print '\tCreating images'
-                visualizeGFS( reader, colorMap, imageName, self.outImgType, 1.0, None )
+                visualizeGFS( reader, colorMap, imageName, self.outImgType, 1.0, None, workerCount=self.workerCount )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s ) 
 
+    def resultFiles( self ):
+        dataFile = os.path.join( self.getWorkPath( 'speed' ), self.workName ) + '.speed'
+        return [ dataFile, dataFile + Crowd.STATS_EXT ]
+
+    def canShareComputation( self ):
+        return True
+
+    def frameConsumers( self, frameSet ):
+        tempFile = os.path.join( self.getWorkPath( 'speed' ), self.workName )
+        grids = Crowd.GridFileSequence( tempFile )
+        domain = makeDomain( self.domainX, self.domainY, self.cellSize )
+        return [ grids.speedConsumer( domain, frameSet, self.timeStep ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
@@ -546,7 +715,7 @@ class FlowAnalysisTask( AnalysisTask ):
         '''
         self._lines.append( ( name, line ) )
         
-    def execute( self ):
+    def execute( self, computed=False ):
         '''Perform the work of the task'''
         if ( self.work ):
             print 'Flow analysis: %s' % ( self.workName )
@@ -556,13 +725,14 @@ class FlowAnalysisTask( AnalysisTask ):
             lines = self.lines
             workPath = self.getWorkPath( 'flow' )
             tempFile = os.path.join( workPath, self.workName )
-            if ( self.work & AnalysisTask.COMPUTE ):
+            if ( self.work & AnalysisTask.COMPUTE and not computed and not self.fetchResults() ):
                 print '\tComputing'
                 s = time.clock()
                 Crowd.computeFlow( frameSet, lines, tempFile, names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
+                self.storeResults()
             if ( self.work & AnalysisTask.VIS ):
-                if ( not os.path.exists( tempFile + ".flow" ) ):
+                if ( not os.path.exists( tempFile + Crowd.FLOW_EXT ) and not os.path.exists( tempFile + ".flow" ) ):
                     print "\tCan't create flow plots - unable to locate file: %s" % tempFile
                     return
                 print '\tComputing plots'
@@ -574,6 +744,21 @@ class FlowAnalysisTask( AnalysisTask ):
                 Crowd.plotFlow( tempFile, frameSet.simStepSize, titlePrefix=self.workName, legendStr=names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
 
+    def cacheParameters( self ):
+        lines = [ ( l.p1.x, l.p1.y, l.p2.x, l.p2.y ) for l in self.lines ]
+        return AnalysisTask.cacheParameters( self ) + [ self.lineNames, lines ]
+
+    def resultFiles( self ):
+        tempFile = os.path.join( self.getWorkPath( 'flow' ), self.workName )
+        return [ tempFile + Crowd.FLOW_EXT, tempFile + Crowd.FLOW_NAMES_EXT ]
+
+    def canShareComputation( self ):
+        return True
+
+    def frameConsumers( self, frameSet ):
+        tempFile = os.path.join( self.getWorkPath( 'flow' ), self.workName )
+        return [ Crowd.FlowCounter( self.lines, tempFile, self.lineNames ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
@@ -643,6 +828,10 @@ class RectRegionAnalysisTask( AnalysisTask ):
             rectData += ' %.5f %.5f %.5f %.5f' % ( rect.minCorner[0], rect.minCorner[1], rect.size[0], rect.size[1] )
         file.write( '%s\n' % rectData )
 
+    def cacheParameters( self ):
+        rects = [ ( r.minCorner[0], r.minCorner[1], r.size[0], r.size[1] ) for r in self.rects ]
+        return AnalysisTask.cacheParameters( self ) + [ self.rectNames, rects ]
+
     @property
     def rectNames( self ):
         return [ x[0] for x in self._rects ]
@@ -656,7 +845,7 @@ class PopulationAnalysisTask( RectRegionAnalysisTask ):
     def __init__( self ):
         RectRegionAnalysisTask.__init__( self )
 
-    def execute( self ):
+    def execute( self, computed=False ):
         '''Perform the work of the task'''
         if ( self.work ):
             print 'Population analysis: %s' % ( self.workName )
@@ -666,11 +855,12 @@ class PopulationAnalysisTask( RectRegionAnalysisTask ):
             rects = self.rects
             workPath = self.getWorkPath( 'population' )
             tempFile = os.path.join( workPath, self.workName )
-            if ( self.work & AnalysisTask.COMPUTE ):
+            if ( self.work & AnalysisTask.COMPUTE and not computed and not self.fetchResults() ):
                 print '\tComputing'
                 s = time.clock()
                 Crowd.computePopulation( frameSet, rects, tempFile, names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
+                self.storeResults()
             if ( self.work & AnalysisTask.VIS ):
                 if ( not os.path.exists( tempFile + ".pop" ) ):
                     print "\tCan't create population plots - unable to locate file: %s" % tempFile
@@ -680,6 +870,16 @@ class PopulationAnalysisTask( RectRegionAnalysisTask ):
                 Crowd.plotPopulation( tempFile, frameSet.simStepSize, titlePrefix=self.workName, legendStr=names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
 
+    def resultFiles( self ):
+        return [ os.path.join( self.getWorkPath( 'population' ), self.workName ) + '.pop' ]
+
+    def canShareComputation( self ):
+        return True
+
+    def frameConsumers( self, frameSet ):
+        tempFile = os.path.join( self.getWorkPath( 'population' ), self.workName )
+        return [ Crowd.PopulationCounter( self.rects, tempFile, self.rectNames ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
@@ -690,7 +890,7 @@ class FundDiagAnalysisTask( RectRegionAnalysisTask ):
     def __init__( self ):
         RectRegionAnalysisTask.__init__( self )
 
-    def execute( self ):
+    def execute( self, computed=False ):
         '''Perform the work of the task'''
         if ( self.work ):
             print 'Fundamental diagram analysis: %s' % ( self.workName )
@@ -700,17 +900,29 @@ class FundDiagAnalysisTask( RectRegionAnalysisTask ):
             rects = self.rects
             workPath = self.getWorkPath( 'fundDiag' )
             tempFile = os.path.join( workPath, self.workName )
-            if ( self.work & AnalysisTask.COMPUTE ):
+            if ( self.work & AnalysisTask.COMPUTE and not computed and not self.fetchResults() ):
                 print '\tComputing'
                 s = time.clock()
                 Crowd.computeFundDiag( frameSet, rects, tempFile, names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
+                self.storeResults()
             if ( self.work & AnalysisTask.VIS ):
                 print '\tCreating plots'
                 s=time.clock()
                 Crowd.plotFundDiag( tempFile, rects, names )
                 print '\t\tdone in %.2f seconds' % ( time.clock() - s )
 
+    def resultFiles( self ):
+        tempFile = os.path.join( self.getWorkPath( 'fundDiag' ), self.workName )
+        return [ tempFile + '.pop' ] + [ tempFile + '_%s.npy' % name for name in self.rectNames ]
+
+    def canShareComputation( self ):
+        return True
+
+    def frameConsumers( self, frameSet ):
+        tempFile = os.path.join( self.getWorkPath( 'fundDiag' ), self.workName )
+        return [ Crowd.FundDiagCounter( self.rects, tempFile, self.rectNames ) ]
+
     @staticmethod
     def typeStr():
         '''Returns a string representation of this task'''
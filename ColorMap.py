@@ -1,6 +1,12 @@
 # The basic color map class
 # responsible for mapping scalar value [0,1] to a color
 #   specifically, designed to work on numpy arrays
+#
+# Each color map defines its colors over the normalized range [0, 1] (see mapColors).  The
+#   colors are evaluated once into a lookup table, so coloring a grid is a normalization
+#   followed by a table look up written directly into the surface's pixels.  A map which
+#   colors a function of the data (e.g., its log) transforms the data before the normalization
+#   (see transform); both the surface and the array outputs go through the same path.
 
 import pygame
 import numpy as np
@@ -20,8 +26,10 @@ class ColorMap:
     BAR_WIDTH = 20      # width of the bar
     LABEL_COUNT = 11     # number of numerical labels to apply to bar
     LABEL_PAD = 4       # the number of pixels between bar and labels
-    FONT = None
+    FONT = None         # the font of the bar's labels (see labelFont)
     FONT_SIZE = 12
+    LUT_SIZE = 4096     # number of entries in the color lookup table
+    BG_COLOR = None     # the color of values below the data range (None if not distinguished)
     def __init__( self, dataRange=None ):
         if ( dataRange == None ):
             self.dataRange = [0.0, 10.0]
@@ -29,6 +37,14 @@ class ColorMap:
         else:
             self.dataRange = dataRange
             self.fixedRange = True
+        # the color lookup table (see table) and its packed versions, keyed by pixel format
+        self.lut = None
+        self.packed = {}
+
+    @staticmethod
+    def labelFont():
+        '''Returns the font of the bar's labels, initializing pygame's fonts on first use.  Only
+        drawing a bar requires the fonts; coloring data doesn't.'''
         if ( ColorMap.FONT == None ):
             if ( not pygame.font.get_init() ):
                 pygame.font.init()
@@ -36,15 +52,129 @@ class ColorMap:
                 ColorMap.FONT = pygame.font.Font( 'arialn.ttf', ColorMap.FONT_SIZE )
             except IOError:
                 ColorMap.FONT = pygame.font.Font( pygame.font.get_default_font(), ColorMap.FONT_SIZE )
+        return ColorMap.FONT
+
+    def mapColors( self, normData ):
+        '''Maps normalized values to colors.  It defines the color map and is only evaluated
+        to build the lookup table (see table).
+
+        @param      normData        A numpy array of N floats in the range [0, 1].
+        @returns    An Nx3 numpy array of uint8s.  The RGB color of each value.
+        '''
+        raise AttributeError, "mapColors not instantiated for this class: %s" % ( str( self.__class__ ) )
+
+    def table( self ):
+        '''Returns the color lookup table, building it if necessary.  Entry i is the color of
+        the normalized value i / ( LUT_SIZE - 1 ).
+
+        @returns    A LUT_SIZE x 3 numpy array of uint8s.
+        '''
+        if ( self.lut is None ):
+            self.lut = self.mapColors( np.linspace( 0.0, 1.0, self.LUT_SIZE ) )
+            self.packed = {}
+        return self.lut
+
+    def fullTable( self ):
+        '''Returns the color lookup table followed by the background color (see BG_COLOR).
+        Without a background color, the background is the color of the minimum value.
+
+        @returns    A ( LUT_SIZE + 1 ) x 3 numpy array of uint8s.
+        '''
+        lut = self.table()
+        if ( self.BG_COLOR is None ):
+            return np.vstack( ( lut, lut[:1] ) )
+        return np.vstack( ( lut, np.array( [ self.BG_COLOR ], dtype=np.uint8 ) ) )
+
+    def packedTable( self, surface ):
+        '''Returns the color lookup table packed into the pixel format of the surface.  The
+        entry following the table is the background color.
+
+        @param      surface     An instance of a 32-bit pygame Surface.
+        @returns    A numpy array of LUT_SIZE + 1 uint32s.
+        '''
+        shifts = surface.get_shifts()
+        if ( not self.packed.has_key( shifts ) ):
+            lut = self.fullTable().astype( np.uint32 )
+            self.packed[ shifts ] = ( lut[:,0] << shifts[0] ) | ( lut[:,1] << shifts[1] ) | ( lut[:,2] << shifts[2] )
+        return self.packed[ shifts ]
+
+    def lutIndex( self, data, (minVal, maxVal) ):
+        '''Returns the index of each value's entry in the lookup table (see table).  Values
+        outside the range map to the first and last entries.
+
+        @param      data        A numpy array of values.
+        @returns    A numpy array of ints (the same shape as data).
+        '''
+        assert( maxVal >= minVal )
+        index = np.subtract( data, minVal, dtype=np.float32 )
+        range = maxVal - minVal
+        if ( range > 0.00001 ):
+            index *= ( self.LUT_SIZE - 1 ) / range
+        else:
+            index.fill( 0.0 )
+        index += 0.5
+        np.clip( index, 0.0, self.LUT_SIZE - 1, out=index )
+        return index.astype( np.intp )
+
+    def surfaceRange( self, dataRange ):
+        '''Returns the range of values spanned by the colors of the map, given the range of
+        the data.'''
+        return map( lambda x: float(x), dataRange )
+
+    def transform( self, dataRange, data ):
+        '''Transforms the data, and its range, into the values which are colored.  By default,
+        the data is colored as is.
+
+        @param      dataRange   A 2-tuple.  The range of the colors (minVal, maxVal).
+        @param      data        A numpy array.  The values to color.
+        @returns    A 2-tuple ( range, values ).  The transformed range and data.
+        '''
+        return dataRange, data
 
     def getColor( self, value, (minVal, maxVal) ):
         '''Given a range of values (minVal and maxVal) and a single value, returns
         an RGB value for that value'''
-        raise AttributeError, "getColor not instantiated for this class: %s" % ( str( self.__class__ ) )
+        mapRange, mapData = self.transform( ( minVal, maxVal ), np.array( [ value ] ) )
+        color = self.table()[ self.lutIndex( mapData, mapRange )[0] ]
+        return tuple( int( c ) for c in color )
+
+    def colorIndex( self, dataRange, data ):
+        '''Returns the index of each value's color in the packed table (see packedTable).
+
+        @param      dataRange   A 2-tuple.  The range of the data (minVal, maxVal).
+        @param      data        A WxH numpy array.  The values to color.
+        @returns    A WxH numpy array of ints.
+        '''
+        assert( len( data.shape ) == 2 )
+        if ( not self.fixedRange ):
+            self.dataRange = self.surfaceRange( dataRange )
+        mapRange, mapData = self.transform( self.dataRange, data )
+        index = self.lutIndex( mapData, mapRange )
+        if ( self.BG_COLOR is not None ):
+            index[ self.bgMask( data, dataRange ) ] = self.LUT_SIZE
+        return index
 
     def colorOnSurface( self, dataRange, data ):
         """Creates a surface with the data colored onto it"""
-        raise AttributeError, "ColorMap class can't be called"
+        index = self.colorIndex( dataRange, data )
+        surface = pygame.Surface( data.shape, 0, 32 )
+        lut = self.packedTable( surface )
+        # the surface's rows run top to bottom
+        pixels = pygame.surfarray.pixels2d( surface )
+        np.take( lut, index, out=pixels[ :, ::-1 ], mode='clip' )
+        del pixels
+        return surface
+
+    def colorArray( self, dataRange, data ):
+        '''Colors the data into an image array (without a pygame surface).
+
+        @param      dataRange   A 2-tuple.  The range of the data (minVal, maxVal).
+        @param      data        A WxH numpy array.  The values to color.
+        @returns    A WxHx3 numpy array of uint8s.  The image in surfarray layout (the same
+                    as the surface created by colorOnSurface).
+        '''
+        index = self.colorIndex( dataRange, data )
+        return np.take( self.fullTable(), index[ :, ::-1 ], axis=0, mode='clip' )
 
     def mapBar( self, dataRange, labelCount=LABEL_COUNT ):
         '''Create a bar map for the given range'''
@@ -58,7 +188,8 @@ class ColorMap:
         labelDelta = domain / ( labelCount - 1 )
         labels = [ '%.2g' % ( i * labelDelta + dataRange[0] ) for i in range( labelCount - 1 ) ]
         labels.append( '>= %.2g' % dataRange[1] )
-        labelSrf = [ ColorMap.FONT.render( x, True, (255, 255, 255) ) for x in labels ]
+        font = self.labelFont()
+        labelSrf = [ font.render( x, True, (255, 255, 255) ) for x in labels ]
         labelHeight = labelSrf[0].get_rect().height
         labelWidth = max( [ srf.get_rect().width for srf in labelSrf ] )
         barRect.top = labelHeight / 2
@@ -117,54 +248,30 @@ class TwoToneHSVMap( ColorMap ):
         @param      maxColor        A 3-tuple (HSV) such that H in [0,360], S & V in [0,1].
                                     This color maps to the maximum value (and above).
         '''
-        self.minColor = np.array( minColor )
-        self.minColor.shape = ( 1, 1, 3 )
-        self.maxColor = np.array( maxColor )
-        self.maxColor.shape = ( 1, 1, 3 )
+        self.minColor = np.array( minColor, dtype=np.float64 )
+        self.maxColor = np.array( maxColor, dtype=np.float64 )
         self.colorDelta = self.maxColor - self.minColor
-        
+        self.lut = None
 
-    def getColor( self, value, (minVal, maxVal) ):
-        '''Given a range of values (minVal and maxVal) and a single value, returns
-        an RGB value for that value'''
-        normData = self._normalize( value, (minVal, maxVal ) )
-        hsv = self.minColor + self.colorDelta * normData
-        return hsvToRgb( hsv[0,0,0], hsv[0,0,1], hsv[0,0,2] )
-
-    def colorOnSurface( self, dataRange, data ):
-        '''Creates the two tone colors the same sizes as the data'''
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        normData = self._normalize( data, self.dataRange )
-        normData.shape = ( normData.shape[0], normData.shape[1], 1 )
-        hsv = self.minColor + self.colorDelta * normData
-        color = np.zeros( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 )
-        for row in xrange( hsv.shape[0] ):
-            color[ row, :, : ] = hsvToRgbNP( hsv[ row, :, : ] )
-        
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+    def mapColors( self, normData ):
+        '''Interpolates the HSV colors (see ColorMap.mapColors)'''
+        hsv = self.minColor + self.colorDelta * normData[ :, np.newaxis ]
+        return hsvToRgbNP( hsv )
     
 class GreyScaleMap( ColorMap ):
     """Maps the data to a grey scale map"""
     def __init__( self, dataRange=None ):
         ColorMap.__init__( self, dataRange )
 
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        normData = self._normalize( data, self.dataRange )
-        color = np.zeros( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 )
-        color[:,:,0] = normData * 255
-        color[:,:,1] = normData * 255
-        color[:,:,2] = normData * 255
-        
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+    def mapColors( self, normData ):
+        """Maps the values to shades of grey (see ColorMap.mapColors)"""
+        color = np.empty( ( normData.size, 3 ), dtype=np.uint8 )
+        color[:,:] = ( normData * 255 )[ :, np.newaxis ]
+        return color
     
 class BlackBodyMap( ColorMap ):
     """Maps the data to a black-body color map"""
+    BG_COLOR = ( 128, 128, 128 )
     def __init__( self, red=0.4, yellow=0.75, dataRange=None ):
         """Allows configuration of the red and yellow points of the map"""
         ColorMap.__init__( self, dataRange )
@@ -172,65 +279,31 @@ class BlackBodyMap( ColorMap ):
         self.red = red
         self.yellow = yellow
 
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        normData = self._normalize( data, self.dataRange )
-        color = np.zeros( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 )
-        color[:,:,0] = ( normData * 2.0 ).clip( 0.0, 1.0 ) * 255
-        color[:,:,1] = ( ( normData - 0.25 ) * 2 ).clip( 0.0, 1.0 ) * 255
-        color[:,:,2] = ( ( normData - 0.5 ) * 2 ).clip( 0.0, 1.0 ) * 255
-        # use grey as the default bg color
-        bgMask = self.bgMask( data, dataRange )
-        color[ bgMask ] = 128
-        
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+    def mapColors( self, normData ):
+        """Maps the values to black-body colors (see ColorMap.mapColors)"""
+        color = np.empty( ( normData.size, 3 ), dtype=np.uint8 )
+        color[:,0] = ( normData * 2.0 ).clip( 0.0, 1.0 ) * 255
+        color[:,1] = ( ( normData - 0.25 ) * 2 ).clip( 0.0, 1.0 ) * 255
+        color[:,2] = ( ( normData - 0.5 ) * 2 ).clip( 0.0, 1.0 ) * 255
+        return color
 
 class FlameMap( ColorMap ):
     """Maps the data to a black-body color map"""
+    BG_COLOR = ( 128, 128, 128 )
     def __init__( self, dataRange=None ):
         """Color map goes from black->blue->red->orange->yellow"""
         ColorMap.__init__( self, dataRange )
-        
-    def getColor( self, value, (minVal, maxVal) ):
-        '''Given a range of values (minVal and maxVal) and a single value, returns
-        an RGB value for that value'''
-        normData = self._normalize( value, (minVal, maxVal ) )
-        color = [0, 0, 0]
-        color[0] = int( clip( ( ( normData - 0.25 ) * 4.0 ), 0.0, 1.0 ) * 255 )
-        color[1] = int( clip( ( ( normData - 0.5 ) * 4.0 ), 0.0, 1.0 ) * 255 )
-        if ( normData < 0.25 ):
-            color[2] = int( clip( normData * 4.0, 0.0, 1.0 ) * 255 )
-        elif ( normData > 0.75 ):
-            color[2] = int( clip( ( normData - 0.75 ) * 4.0, 0.0, 1.0 ) * 255 )
-        else:
-            color[2] = int( clip( 1.0 - ( normData - 0.25 ) * 4.0, 0.0, 1.0 ) * 255 )
-        return color
 
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a flame-colored map the same size as the data"""
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        normData = self._normalize( data, self.dataRange )
-        color = np.zeros( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 )
-        color[:,:,0] = ( ( normData - 0.25 ) * 4.0 ).clip( 0.0, 1.0 ) * 255
-        color[:,:,1] = ( ( normData - 0.5 ) * 4.0 ).clip( 0.0, 1.0 ) * 255
-        b1Mask = normData < 0.25
-        b3Mask = normData > 0.75
-        b2Mask = ~( b1Mask | b3Mask )
-        blueValues = np.zeros_like( normData )
-        blueValues[b1Mask] = ( normData[ b1Mask ] * 4.0 )
-        blueValues[b3Mask ]= ( normData[ b3Mask ] - 0.75 ) * 4.0
-        blueValues[b2Mask ] = 1.0 - ( normData[ b2Mask ] - 0.25 ) * 4.0
-        color[:,:,2] = blueValues.clip( 0.0, 1.0 ) * 255
-        # use grey as the default bg color
-        
-        bgMask = self.bgMask( data, dataRange )
-        color[ bgMask ] = 128
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+    def mapColors( self, normData ):
+        """Maps the values to flame colors (see ColorMap.mapColors)"""
+        color = np.empty( ( normData.size, 3 ), dtype=np.uint8 )
+        color[:,0] = ( ( normData - 0.25 ) * 4.0 ).clip( 0.0, 1.0 ) * 255
+        color[:,1] = ( ( normData - 0.5 ) * 4.0 ).clip( 0.0, 1.0 ) * 255
+        blueValues = np.where( normData < 0.25, normData * 4.0,
+                               np.where( normData > 0.75, ( normData - 0.75 ) * 4.0,
+                                         1.0 - ( normData - 0.25 ) * 4.0 ) )
+        color[:,2] = blueValues.clip( 0.0, 1.0 ) * 255
+        return color
     
 class StephenBlackBodyMap( BlackBodyMap ):
     """This is stephen's black body map which clamps the data range to a
@@ -239,11 +312,9 @@ class StephenBlackBodyMap( BlackBodyMap ):
         BlackBodyMap.__init__( self, red, yellow, dataRange )
         self.maxVal = maxValue
 
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        if ( dataRange[1] > self.maxVal ):
-            dataRange = [ float( dataRange[0]), float( self.maxVal ) ]
-        return BlackBodyMap.colorOnSurface( self, dataRange, data )
+    def surfaceRange( self, dataRange ):
+        '''The colors span the data range, up to the maximum value'''
+        return [ float( dataRange[0] ), float( min( dataRange[1], self.maxVal ) ) ]
     
 class LogBlackBodyMap( BlackBodyMap ):
     """First takes the log of the data before performing a black body
@@ -251,15 +322,11 @@ class LogBlackBodyMap( BlackBodyMap ):
     def __init__( self, maxValue=6.0, red=0.4, yellow=0.75, dataRange=None ):
         BlackBodyMap.__init__( self, red, yellow, dataRange )
         
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        # NOTE: This is wrong for the color bar
-        dRange = ( np.log( dataRange[0] + 0.001 ), np.log( dataRange[1] + 0.001 ) )
-        print "Log BlackBodyMap", dRange
-        s =  BlackBodyMap.colorOnSurface( self, dRange, np.log( data + 0.001 ) )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        return s
+    def transform( self, dataRange, data ):
+        '''Colors the log of the data (see ColorMap.transform)'''
+        # NOTE: The bar's labels are spaced evenly in the data, not in its log
+        logRange = ( np.log( dataRange[0] + 0.001 ), np.log( dataRange[1] + 0.001 ) )
+        return logRange, np.log( data + 0.001 )
     
 class BandedBlackBodyMap( BlackBodyMap ):
     """Maps the data to a black-body color map"""
@@ -267,23 +334,21 @@ class BandedBlackBodyMap( BlackBodyMap ):
         BlackBodyMap.__init__( self, red, yellow, dataRange )
         self.bandCount = bandCount
 
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = map( lambda x: float(x), dataRange )
-        normData = self._normalize( data, self.dataRange )
+    BG_COLOR = None
+
+    def mapColors( self, normData ):
+        """Maps the values to banded black-body colors (see ColorMap.mapColors)"""
         normData = np.ceil( normData * self.bandCount ) / self.bandCount
-        
-        color = np.zeros( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 )
-        color[:,:,0] = ( normData * 2.5 ).clip( 0.0, 1.0 ) * 255
-        color[:,:,1] = ( ( normData - 0.4 ) / 0.35 ).clip( 0.0, 1.0 ) * 255
-        color[:,:,2] = ( ( normData - 0.75 ) / 0.25 ).clip( 0.0, 1.0 ) * 255
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+        color = np.empty( ( normData.size, 3 ), dtype=np.uint8 )
+        color[:,0] = ( normData * 2.5 ).clip( 0.0, 1.0 ) * 255
+        color[:,1] = ( ( normData - 0.4 ) / 0.35 ).clip( 0.0, 1.0 ) * 255
+        color[:,2] = ( ( normData - 0.75 ) / 0.25 ).clip( 0.0, 1.0 ) * 255
+        return color
 
 class RedBlueMap( ColorMap ):
     '''Color map which is white at 0 and verges to red and blue at the extreme values.  The map is
     symmetric.  So, the range at which the colors reach red and blue is the maximum( min, max).'''
+    BG_COLOR = ( 0, 0, 0 )
     def __init__( self, dataRange=None ):
         """Color map goes from blue->white->red"""
         ColorMap.__init__( self, dataRange )
@@ -302,28 +367,23 @@ class RedBlueMap( ColorMap ):
         minVal = -maxVal
         return float( minVal ), float( maxVal )
         
-    def colorOnSurface( self, dataRange, data ):
-        """Creates a greyscale map the same size as the data"""
-        assert( len( data.shape ) == 2 )
-        if ( not self.fixedRange ):
-            self.dataRange = self.bipolarRange( dataRange )
-        normData = self._normalize( data, self.dataRange )
-        color = np.ones( ( data.shape[0], data.shape[1], 3 ), dtype=np.uint8 ) * 255
-
+    def surfaceRange( self, dataRange ):
+        '''The colors span the bipolar range (see bipolarRange)'''
+        return self.bipolarRange( dataRange )
+
+    def mapColors( self, normData ):
+        """Maps the values to blue->white->red (see ColorMap.mapColors)"""
+        color = np.empty( ( normData.size, 3 ), dtype=np.uint8 )
+        color[:,:] = 255
         redMask = normData > 0.5
         blueMask = normData < 0.5
-
         vals = ( 2.0 * normData[ blueMask ] ) * 255
         color[ blueMask, 0 ] = vals
         color[ blueMask, 1 ] = vals
-        vals = ( 1.0 - 2.0 * normData[ redMask ] ) * 255
+        vals = ( 2.0 - 2.0 * normData[ redMask ] ) * 255
         color[ redMask, 1 ] = vals
         color[ redMask, 2 ] = vals
-        
-        # use balck as the default bg color
-        bgMask = self.bgMask( data, dataRange )
-        color[ bgMask ] = 0
-        return pygame.surfarray.make_surface( color[:,::-1,:] )
+        return color
 
 # a dictionary from available color map namess to an instance of a color map
 
@@ -17,6 +17,7 @@
 #   - Draw in obstacles (lowest priority)
 
 from math import sqrt, ceil
+import os
 import struct
 import pygame
 import numpy as np
@@ -29,7 +30,7 @@ import Kernels
 from GridFileSequence import *
 from flow import *
 from primitives import Vector2, Segment
-from trajectory.scbData import FrameSet
+from trajectory.scbData import FrameSet, NPFrameSet, IDMap
 from trace import renderTraces
 import pylab as plt
 from ObjSlice import Polygon
@@ -37,24 +38,10 @@ from obstacles import *
 import pylab as plt
 from GFSVis import visualizeGFS
 from stats import StatRecord
+from FramePass import FrameConsumer, consumeFrames
 
         
 ##          HELPER FUNCTION FOR REGION TESTS
-def findCurrentRegion( frame, polygons, excludeStates ):
-    '''Given a frame, determines which region each agent is in.
-    Performs a brute-force search across all regions'''
-    regions = np.zeros( len( frame.agents ), dtype=np.int )
-    for a, agt in enumerate( frame.agents ):
-        if ( agt.state in excludeStates ): continue
-        poly = -1
-        for i, p in enumerate( polygons ):
-            if ( p.pointInside( agt.pos ) ):
-                poly = i
-                break
-        assert poly != -1
-        regions[a] = poly
-    return regions
-
 def updateRegion( currRegion, pos, polygons ):
     '''Given a Vector2 (pos) and the expectation of its last known region, provides
     a new region assignment.'''
@@ -66,34 +53,6 @@ def updateRegion( currRegion, pos, polygons ):
             return test
         else:
             return currRegion
-
-def findRegionSpeed( f1, f2, timeStep, polygons, excludeStates, regions=None ):
-    '''Given a frame of data, and a set of polygons computes the average region speed for
-    each region.  If regions is a Nx1 array (for N agents in frame) then it uses a smart
-    mechanism for determining which region the agent is in (and updates it accordingly)
-    Otherwise, it performs the brute-force search.
-    Returns an Mx1 array (for M polygons) and the regions object.'''
-    # if regions is defined, it's the location of the region for f1
-    #   This region accumulates the speed
-
-    regions = findCurrentRegion( f2, polygons, excludeStates )
-    speeds = np.zeros( len(polygons), dtype=np.float32 )
-    counts = np.zeros( len(polygons), dtype=np.int )
-    for a, ag1 in enumerate( f1.agents ):
-        if ( f2.agents[a].state in excludeStates ): continue
-        # compute speed
-        p1 = ag1.pos
-        p2 = f2.agents[ a ].pos
-        disp = (p2 - p1).magnitude()
-        speed = disp / timeStep
-        
-        # increment counters and accumulators
-        speeds[ regions[a] ] += speed
-        counts[ regions[a] ] += 1
-
-    mask = counts != 0
-    speeds[ mask ] /= counts[ mask ]
-    return speeds, regions
     
 
 def drawPolygonPG( surf, polygon, worldToImg, color, width ):
@@ -184,13 +143,11 @@ def plotFlow( outFileName, timeStep, titlePrefix='', legendStr=None, newFig=Fals
         plt.clf()
         fig = plt.gcf()
     
-    dataFile = outFileName + ".flow"
-    dFile = open( dataFile, 'r' )
-    nameLine = dFile.readline()[2:]
+    names, data = readFlow( outFileName )
     if ( legendStr is None ):
-        legendStr = nameLine.split('~')
+        legendStr = names
     
-    data = np.loadtxt( dFile )
+    data = data.astype( np.float64 )
     data[:,0] *= timeStep
     smoothFlows = np.empty_like( data[:, 1:] )
     for col in xrange( data.shape[1] - 1 ):
@@ -259,9 +216,190 @@ def plotPopulation( outFileName, timeStep, titlePrefix='', legendStr=None, newFi
     plt.savefig( outFileName + ".pop.png" )
     plt.savefig( outFileName + ".pop.eps" )
 
+# The extensions of the files holding the flow counts and the flow line names
+FLOW_EXT = '.flow.npy'
+FLOW_NAMES_EXT = '.flow.names'
+# The maximum number of (frame, agent, line) triples tested for crossings at once
+FLOW_BLOCK_SIZE = 1 << 18
+# The size of the header written by writeNPYHeader
+NPY_HEADER_SIZE = 128
+
+def writeNPYHeader( file, dtype, shape ):
+    '''Writes the header of a .npy file (see numpy.lib.format) at the current position of the
+    file.  The header always has NPY_HEADER_SIZE bytes, so it can be written before the array's
+    final shape is known and rewritten in place when it is.
+
+    @param      file        An open file object.
+    @param      dtype       A numpy dtype.  The type of the array's elements.
+    @param      shape       A tuple of ints.  The shape of the array.
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % ( np.dtype( dtype ).str, tuple( shape ) )
+    header = header.ljust( NPY_HEADER_SIZE - 11 ) + '\n'
+    if ( len( header ) != NPY_HEADER_SIZE - 10 ):
+        raise ValueError, "The npy header for shape %s is too long" % ( str( shape ) )
+    file.write( '\x93NUMPY\x01\x00' + struct.pack( '<H', len( header ) ) + header )
+
+def frameAgentIDs( frameSet, frame ):
+    '''Reports the global identifiers of the agents in the current frame of the data.
+
+    @param      frameSet    An instance of trajectory data.
+    @param      frame       A numpy array.  The current frame, one row per agent.
+    @returns    A numpy array of ints.  The identifier of the agent in each row of the frame.
+    '''
+    ids = frameSet.getFrameIds()
+    if ( isinstance( ids, IDMap ) ):
+        return np.arange( frame.shape[0] )
+    return np.asarray( ids )[ :frame.shape[0] ]
+
+class FlowCounter( FrameConsumer ):
+    '''Counts the agents crossing a set of line segments as part of a pass over pedestrian
+    data (see FramePass.consumeFrames).
+
+    Each line is oriented; an agent crosses it when the agent's displacement between two
+    consecutive frames intersects the line, going from its negative side to its positive side.
+    Every agent is counted at most once per line.  Because the displacements themselves are
+    tested, crossings aren't missed by fast agents or coarsely sampled data.
+
+    The frames are buffered and tested in blocks, as arrays of (frames x agents x lines).  The
+    accumulated counts are written as a .npy file (FLOW_EXT) with one row per frame: the frame
+    index followed by the number of agents who have crossed each line.  The first row, with
+    index zero and no crossings, precedes the data's first frame.  The line names are written,
+    one per line, to a text file (FLOW_NAMES_EXT).'''
+    def __init__( self, segments, outFileName, names=None ):
+        '''Constructor.
+
+        @param  segments        A list of Segment instances.
+        @param  outFileName     The base name of the files to write the flow results to.
+        @param  names           An optional list of strings.  If provided, there must be
+                                one string for each Segment (in segments).  If none are
+                                provided, line names will be generated.
+        '''
+        if ( names is None ):
+            names = [ 'Line %d' % i for i in xrange( len( segments ) ) ]
+        self.names = names
+        self.outFileName = outFileName
+        self.segCount = len( segments )
+        # the endpoints of each segment
+        self.S0 = np.array( [ ( seg.p1.x, seg.p1.y ) for seg in segments ], dtype=np.float64 ).reshape( -1, 2 )
+        S1 = np.array( [ ( seg.p2.x, seg.p2.y ) for seg in segments ], dtype=np.float64 ).reshape( -1, 2 )
+        disp = S1 - self.S0
+        self.L = np.sqrt( np.sum( disp * disp, axis=1 ) )
+        # the unit direction of each segment
+        self.D = disp / self.L[ :, np.newaxis ]
+        # the signed distance to the LINE on which segment lies is A * x + B * y + C
+        self.A = -self.D[ :, 1 ]
+        self.B = self.D[ :, 0 ]
+        self.C = self.D[ :, 1 ] * self.S0[ :, 0 ] - self.D[ :, 0 ] * self.S0[ :, 1 ]
+
+    def start( self, frameSet ):
+        f = open( self.outFileName + FLOW_NAMES_EXT, 'w' )
+        f.write( '\n'.join( self.names ) + '\n' )
+        f.close()
+        self.outFile = open( self.outFileName + FLOW_EXT, 'wb' )
+        writeNPYHeader( self.outFile, np.int32, ( 0, self.segCount + 1 ) )
+        self.rowCount = 0
+        self.Y_COL = 1
+        if ( frameSet.is3D ):
+            self.Y_COL = 2
+        agtCount = frameSet.agentCount()
+        # the number of agents who have crossed each segment
+        self.crossed = np.zeros( self.segCount, dtype=np.int32 )
+        # An NxM array indicating which segment each agent has already crossed
+        self.alreadyCrossed = np.zeros( ( agtCount, self.segCount ), dtype=np.bool )
+        # The block of buffered positions: row zero holds the frame preceding the block.
+        #   Agents missing from a frame have NaN positions and never cross.
+        blockSize = max( 1, FLOW_BLOCK_SIZE / max( 1, agtCount * self.segCount ) )
+        self.positions = np.empty( ( blockSize + 1, agtCount, 2 ), dtype=np.float64 )
+        self.indices = np.empty( blockSize + 1, dtype=np.int32 )
+        self.count = -1
+        self.writeRows( np.zeros( ( 1, self.segCount + 1 ), dtype=np.int32 ) )
+
+    def writeRows( self, rows ):
+        '''Writes rows of counts to the output file.'''
+        self.outFile.write( rows.astype( np.int32 ).tostring() )
+        self.rowCount += rows.shape[0]
+
+    def consume( self, frame, idx, frameSet ):
+        self.count += 1
+        pos = self.positions[ self.count ]
+        pos.fill( np.nan )
+        ids = frameAgentIDs( frameSet, frame )
+        pos[ ids, 0 ] = frame[ :, 0 ]
+        pos[ ids, 1 ] = frame[ :, self.Y_COL ]
+        self.indices[ self.count ] = idx
+        if ( self.count == self.positions.shape[0] - 1 ):
+            self.countBlock()
+
+    def countBlock( self ):
+        '''Counts the crossings in the buffered frames and writes their rows.'''
+        F = self.count
+        if ( F < 1 ):
+            return
+        P = self.positions[ :F+1 ]
+        # An (F + 1) x N x M array: the signed distance of each agent from each line
+        err = np.seterr( invalid='ignore' )
+        try:
+            dist = self.A * P[ :, :, :1 ] + self.B * P[ :, :, 1: ] + self.C
+            # the displacements which go from the negative to the positive side of a line
+            f, agent, line = np.nonzero( ( dist[ :-1 ] < 0 ) & ( dist[ 1: ] >= 0 ) )
+        finally:
+            np.seterr( **err )
+        # the point at which the displacement crosses the line must lie on the segment
+        d0 = dist[ f, agent, line ]
+        u = d0 / ( d0 - dist[ f + 1, agent, line ] )
+        p0 = P[ f, agent ]
+        q = p0 + u[ :, np.newaxis ] * ( P[ f + 1, agent ] - p0 ) - self.S0[ line ]
+        T = np.sum( q * self.D[ line ], axis=1 )
+        onSeg = ( T >= 0 ) & ( T <= self.L[ line ] )
+        f = f[ onSeg ]
+        agent = agent[ onSeg ]
+        line = line[ onSeg ]
+        # only the first crossing of each agent counts (the crossings are ordered by frame)
+        pair, first = np.unique( agent * self.segCount + line, return_index=True )
+        first = first[ ~self.alreadyCrossed[ agent[ first ], line[ first ] ] ]
+        self.alreadyCrossed[ agent[ first ], line[ first ] ] = True
+        perFrame = np.bincount( f[ first ] * self.segCount + line[ first ], minlength=F * self.segCount )
+        rows = np.empty( ( F, self.segCount + 1 ), dtype=np.int32 )
+        rows[ :, 0 ] = self.indices[ 1:F+1 ]
+        rows[ :, 1: ] = self.crossed + np.cumsum( perFrame.reshape( F, self.segCount ), axis=0 )
+        self.crossed = rows[ -1, 1: ].copy()
+        self.writeRows( rows )
+        # the last frame precedes the next block
+        self.positions[ 0 ] = self.positions[ F ]
+        self.indices[ 0 ] = self.indices[ F ]
+        self.count = 0
+
+    def finish( self ):
+        self.countBlock()
+        self.outFile.seek( 0 )
+        writeNPYHeader( self.outFile, np.int32, ( self.rowCount, self.segCount + 1 ) )
+        self.outFile.close()
+        crossings = self.alreadyCrossed.sum( axis=1 )
+        print "The following agents never crossed:", np.where( crossings == 0 )
+
+def readFlow( outFileName ):
+    '''Reads the results of computeFlow.  Results in the older text format (a .flow file)
+    are also read.
+
+    @param      outFileName     The base name of the flow results.
+    @returns    A 2-tuple ( names, data ).  names is a list of strings, one per line.  data is
+                a numpy array of shape (T, M + 1) for T rows and M lines (see FlowCounter).
+    '''
+    if ( os.path.exists( outFileName + FLOW_EXT ) ):
+        f = open( outFileName + FLOW_NAMES_EXT, 'r' )
+        names = [ line.rstrip( '\n' ) for line in f.readlines() ]
+        f.close()
+        return names, np.load( outFileName + FLOW_EXT )
+    dFile = open( outFileName + ".flow", 'r' )
+    names = dFile.readline()[2:].strip().split( '~' )
+    data = np.loadtxt( dFile )
+    dFile.close()
+    return names, data
+
 def computeFlow( frameSet, segments, outFileName, names=None ):
     '''Compute the flow of agents past the indicated line segments.
-    Output is an NxM array where there are N time steps and M segments.
+    Output is an NxM array where there are N time steps and M segments (see FlowCounter and
+    readFlow).
     Each segment has direction and every agent will only be counted at most once w.r.t.
     each segment.
 
@@ -272,180 +410,107 @@ def computeFlow( frameSet, segments, outFileName, names=None ):
                             one string for each Segment (in segments).  If none are
                             provided, line names will be generated.
     '''
-    if ( names is None ):
-        names = [ 'Line %d' % i for i in xrange( len( segments ) ) ]
-    # In this scenario, there are N agents and M segments
-
-    # compute parameters for each segment
-    segCount = len( segments )
-    agtCount = frameSet.agentCount()
-    # these are the x and y values of each segment's 0th and 1st points
-    S0X = np.zeros( (1, segCount ) )
-    S0Y = np.zeros( (1, segCount ) )
-    S1X = np.zeros( (1, segCount ) )
-    S1Y = np.zeros( (1, segCount ) )
-    for i, seg in enumerate( segments ):
-        S0X[ 0, i ] = seg.p1.x
-        S0Y[ 0, i ] = seg.p1.y
-        S1X[ 0, i ] = seg.p2.x
-        S1Y[ 0, i ] = seg.p2.y
-    dX = S1X - S0X
-    dY = S1Y - S0Y
-    L = np.sqrt( dX * dX + dY * dY )
-    # this (plus S0X/S0Y) used to determine if position lies between
-    dX /= L
-    dY /= L
-    # this computes signed distance to LINE on which segment lies
-    A = -dY
-    B = dX
-    C = dY * S0X - dX * S0Y
-        
-    outFile = open( outFileName + '.flow', 'w' )
-
-    # write names
-    outFile.write( '# %s\n' % '~'.join( names ) )
-    frameSet.setNext( 0 )
-    # the number of agents who have crossed each segment
-    crossed = np.zeros( segCount, dtype=np.int )
-    # An NxM array indicating which segment each agent has already crossed
-    alreadyCrossed = np.zeros( ( agtCount, segCount ), dtype=np.bool )
-    
-    outFile.write('{0:10d}'.format( 0 ) )
-    for val in crossed:
-        outFile.write('{0:10d}'.format( val ) )
-    outFile.write('\n')
-
-    # prime the set by computing the data for the first frame
-    frame, idx = frameSet.next()
-    ids = frameSet.getFrameIds()   # mapping from frame IDs to global IDs
-    frameIDs = map( lambda x: ids[ x ], xrange( frame.shape[0] ) )
-    
-    # note: I'm doing this strange syntax so that they are Nx1 arrays (instead of just N arrays)
-    #   this makes the broadcasting work better.
-    pX = frame[:, :1 ]
-    if ( frameSet.is3D ):
-        pY = frame[:, 2:3 ]
-    else:
-        pY = frame[:, 1:2 ]
-
-    # SDIST: an N x M array.  The cell[i, j] reports if agent i is on the right side of
-    #   segment j to cross it (according to indicated flow direction)
-    PREV_SDIST = ( A * pX + B * pY + C ) < 0 
-    T = (pX - S0X) * dX + (pY - S0Y) * dY
-    # BETWEEN: an N x M array.  The cell[i, j] reports if the agent i lies between the endpoints
-    #   of segment j.
-    BETWEEN = ( T >= 0 ) & ( T <= L )
-    # COULD_CROSS: an N x M array.  The cell[i, j] reports if the agent i is in a position to
-    #   cross segment j.  (i.e., it lies between the endpoints and is on the negative side.)
-    COULD_CROSS = np.zeros( ( agtCount, segCount ), dtype=np.bool )
-    
-    # Only process the agents that are in the frame
-    COULD_CROSS[ frameIDs, : ] = PREV_SDIST & BETWEEN
-##    COULD_CROSS = PREV_SDIST & BETWEEN
-    
-    while ( True ):
-        try:
-            frame, idx = frameSet.next()
-        except StopIteration:
-            break
-        else:
-            ids = frameSet.getFrameIds()   # mapping from frame IDs to global IDs
-            frameIDs = map( lambda x: ids[ x ], xrange( frame.shape[0] ) )
-        # compute crossability for the current frame
-        pX = frame[:, :1 ]
+    consumeFrames( frameSet, [ FlowCounter( segments, outFileName, names ) ] )
+
+class PopulationCounter( FrameConsumer ):
+    '''Counts the agents in a set of rectangular domains as part of a pass over pedestrian
+    data (see FramePass.consumeFrames).  The counts are written to a .pop file (see
+    computePopulation).'''
+    def __init__( self, rectDomains, outFileName, names=None ):
+        '''Constructor.
+
+        @param  rectDomains     A list of RectDomain instances.
+        @param  outFileName     The name of the file to write the population results to.
+        @param  names           An optional list of strings.  If provided, there must be
+                                one string for each domain (in rectDomains).  If none are
+                                provided, region names will be generated.
+        '''
+        if ( names is None ):
+            names = [ 'Region %d' % i for i in xrange( len( rectDomains ) ) ]
+        self.names = names
+        self.outFileName = outFileName
+        self.rectDomains = rectDomains
+        # pre-compute max corner to facilitate the test
+        for i, rect in enumerate( rectDomains ):
+            rect.maxCorner = ( rect.minCorner[0] + rect.size[0], rect.minCorner[1] + rect.size[1] )
+        # M x 2 arrays of the rects' corners
+        self.minCorners = np.array( [ ( rect.minCorner[0], rect.minCorner[1] ) for rect in rectDomains ], dtype=np.float64 ).reshape( -1, 2 )
+        self.maxCorners = np.array( [ rect.maxCorner for rect in rectDomains ], dtype=np.float64 ).reshape( -1, 2 )
+
+    def start( self, frameSet ):
+        self.outFile = open( self.outFileName + '.pop', 'w' )
+        # write names
+        self.outFile.write( '# %s\n' % '~'.join( self.names ) )
+        self.Y_COL = 1
         if ( frameSet.is3D ):
-            pY = frame[:, 2:3 ]
-        else:
-            pY = frame[:, 1:2 ]
-##        if ( idx > 30 and idx < 40 ):
-##            print "Frame:", idx
-##            print "\tAgents in frame: ", frameIDs
-##            print "\tx:", pX.T
-##            print "\ty:", pY.T
-        SDIST = ( A * pX + B * pY + C ) < 0 
-        T = (pX - S0X) * dX + (pY - S0Y) * dY
-        BETWEEN = ( T >= 0 ) & ( T <= L )
-##        if ( idx > 30 and idx < 40 ):
-##            print "\tSDIST:", SDIST
-##            print "\tBETWEEN:", BETWEEN
-##            print "\tCOULD_CROSS:", COULD_CROSS[ frameIDs,: ]
-        # in order to cross, in the previous time step, I had to be in a position to cross
-        #   and in this frame, my sign has to reversed AND I have to not already crossed it.
-        CROSSED = COULD_CROSS[ frameIDs, : ] & ~SDIST & ~alreadyCrossed[ frameIDs, : ]
-        alreadyCrossed[ frameIDs, : ] |= CROSSED
-        crossed += CROSSED.sum( axis=0 )
-        outFile.write('{0:10d}'.format( idx ) )
-        for val in crossed:
-            outFile.write('{0:10d}'.format( val ) )
-        outFile.write('\n')
-        COULD_CROSS[ frameIDs, : ] = SDIST & BETWEEN
-##        prevIdx = idx
-##        frame, idx = frameSet.next()
-
-    outFile.close()
-
-    crossings = alreadyCrossed.sum( axis=1 )
-    print "The following agents never crossed:", np.where( crossings == 0 )
-    
+            self.Y_COL = 2
+
+    def framePositions( self, frame ):
+        '''Returns the N x 2 positions of the agents in the frame.'''
+        return frame[ :, ( 0, self.Y_COL ) ]
+
+    def insideRects( self, pos ):
+        '''Reports which rects each agent is in.  Agents on the boundary of a rect are inside.
+
+        @param      pos         An N x 2 numpy array.  The positions of N agents.
+        @returns    An N x M numpy array of bools.  True if the agent is in the rect.
+        '''
+        # the corners are compared at the precision of the positions
+        minCorners = self.minCorners.astype( pos.dtype )
+        maxCorners = self.maxCorners.astype( pos.dtype )
+        pX = pos[ :, :1 ]
+        pY = pos[ :, 1: ]
+        return ( pX >= minCorners[ :, 0 ] ) & ( pX <= maxCorners[ :, 0 ] ) & ( pY >= minCorners[ :, 1 ] ) & ( pY <= maxCorners[ :, 1 ] )
+
+    def writePopulation( self, idx, population ):
+        '''Writes the number of agents in each rect in the indicated frame.'''
+        self.outFile.write('{0:10d}'.format( idx ) )
+        for val in population:
+            self.outFile.write('{0:10d}'.format( val ) )
+        self.outFile.write('\n')
+
+    def consume( self, frame, idx, frameSet ):
+        inside = self.insideRects( self.framePositions( frame ) )
+        self.writePopulation( idx, inside.sum( axis=0 ) )
+
+    def finish( self ):
+        self.outFile.close()
+
 def computePopulation( frameSet, rectDomains, outFileName, names=None ):
     '''Computes the time-dependent population for a set of rectangular domains.
     Output is an NxM array where there are N time steps and M rectangular regions.
 
     @param  frameSet        An instance of trajectory data (currently scb data)
-    @param  rectDomains     A list of Segment instances.
-    @param  outFileName     The name of the file to write the flow results to.
+    @param  rectDomains     A list of RectDomain instances.
+    @param  outFileName     The name of the file to write the population results to.
     @param  names           An optional list of strings.  If provided, there must be
-                            one string for each Segment (in segments).  If none are
-                            provided, line names will be generated.
+                            one string for each domain (in rectDomains).  If none are
+                            provided, region names will be generated.
     '''
-    if ( names is None ):
-        names = [ 'Region %d' % i for i in xrange( len( rectDomains ) ) ]
-    # In this scenario, there are N agents and M segments
+    consumeFrames( frameSet, [ PopulationCounter( rectDomains, outFileName, names ) ] )
 
-    outFile = open( outFileName + '.pop', 'w' )
-    rectCount = len( rectDomains )
+def dwellInRegion( region, data, keepAll=False ):
+    '''Tracks the intervals of time agents spend in the region over all of the data.
 
-    # write names
-    outFile.write( '# %s\n' % '~'.join( names ) )
-    frameSet.setNext( 0 )
-    X_COL_LIMIT = 1
-    Y_COL = 1
-    if ( frameSet.is3D ):
-        Y_COL = 2
-    
-    # pre-compute max corner to facilitate the test    
-    for i, rect in enumerate( rectDomains ):
-        rect.maxCorner = ( rect.minCorner[0] + rect.size[0], rect.minCorner[1] + rect.size[1] )
-
-    for i, rect in enumerate( rectDomains ):
-    
-     while ( True ):
+    @param      region      An instance of RectDomain.
+    @param      data        An instance of trajectory data with N agents.
+    @param      keepAll     A boolean.  If True, every interval is recorded (see
+                            RegionDwell.allIntervals), not just the longest.
+    @returns    An instance of RegionDwell for the single region.
+    '''
+    data.setNext( 0 )
+    dwell = RegionDwell( data.agentCount(), 1, keepAll )
+    while ( True ):
         try:
-            frame, idx = frameSet.next()
+            frame, idx = data.next()
         except StopIteration:
             break
-        else:
-            ids = frameSet.getFrameIds()   # mapping from frame IDs to global IDs
-            frameIDs = map( lambda x: ids[ x ], xrange( frame.shape[0] ) )
-        # compute crossability for the current frame
-        
-        pX = frame[:, :X_COL_LIMIT ]
-        pY = frame[:, Y_COL:Y_COL+1 ]
-
-        # the number of agents in each rect
-        population = np.zeros( rectCount, dtype=np.int )
-        
-        for i, rect in enumerate( rectDomains ):
-            inside = ( pX >= rect.minCorner[0] ) & ( pX <= rect.maxCorner[0] ) & ( pY >= rect.minCorner[1] ) & ( pY <= rect.maxCorner[1] )
-            population[ i ] = np.sum( inside )
-
-        outFile.write('{0:10d}'.format( idx ) )
-        for val in population:
-            outFile.write('{0:10d}'.format( val ) )
-        outFile.write('\n')
-
-    outFile.close()
-    
+        posData = frame[:, :2 ]
+        if ( data.is3D ):
+            posData = frame[:, :3:2 ]
+        isInside = region.pointsInside( posData )
+        dwell.update( idx, frameAgentIDs( data, frame ), posData, isInside[ :, np.newaxis ] )
+    return dwell
 
 def framesInRegion( region, data ):
     '''For each agent in data, computes the largest interval of time during which
@@ -462,43 +527,19 @@ def framesInRegion( region, data ):
                         interval.
                     if the interval duration is zero, the distance value will be meaningless.
     '''
-    data.setNext( 0 )
-    # The entrance and duration times of each agent
-    agtTime = np.zeros( ( data.agentCount(), 2 ), dtype=np.int )
-    inRegion = {}   # map from the agent id to the time it entered
+    dwell = dwellInRegion( region, data )
+    return dwell.intervals[ :, 0 ], np.sqrt( dwell.distSq[ :, 0 ] )
 
-    enterPt = np.empty( ( data.agentCount(), 2 ), dtype=np.float32 )
-    distance = np.empty( data.agentCount(), dtype=np.float32 )
-    
-    while ( True ):
-        try:
-            frame, idx = data.next()
-        except StopIteration:
-            break
-        IDs = data.getFrameIds()  # a mapping from frame ID to data ID
-        posData = frame[:, :2 ]
-        if ( data.is3D ):
-            posData = frame[:, :3:2 ]
-        isInside = region.pointsInside( posData )
-        for fID, state in enumerate( isInside ):
-            simID = IDs[ fID ]
-            if ( state ):
-                if ( not inRegion.has_key( simID ) ):
-                    inRegion[ simID ] = idx
-                    enterPt[ simID, : ] = posData[ fID, : ]
-            else:
-                if ( inRegion.has_key( simID ) ):
-                    enter = inRegion.pop( simID )
-                    elapsed = idx - enter
-                    if ( elapsed > agtTime[ simID, 1 ] ):
-                        agtTime[ simID, : ] = ( enter, elapsed )
-                        exit = posData[ fID, : ]
-                        delta = exit - enterPt[ simID, : ]
-                        distSq = np.dot( delta, delta )
-                        distance[ simID ] = distSq
-    distance = np.sqrt( distance )
-    
-    return agtTime, distance
+def intervalsInRegion( region, data ):
+    '''Computes every interval of time during which an agent is in the region (an agent
+    may enter and leave the region several times).
+
+    @param      region      An instance of RectDomain.
+    @param      data        An instance of trajectory data.
+    @returns    A numpy array with dtype INTERVAL_DTYPE.  One record per interval, in the
+                order in which the agents left the region.
+    '''
+    return dwellInRegion( region, data, True ).allIntervals()
 
 def calcSpeeds( intervals, distances, timeStep ):
     '''Compute the average speed for each agent crossing the rectangular region.
@@ -537,11 +578,13 @@ def calcIntervalDensityRegion( intervals, density ):
     @returns    A numpy array of floats with shape (N, 1).  The average density in the region over
                     each non-zero interval.
     '''
-    densities = np.empty( intervals.shape[0], dtype=np.float32 )
-    for i, iVal in enumerate( intervals ):
-        start, length = iVal
-        if ( length > 0 ):
-            densities[ i ] = np.mean( density[ start:(start+length) ] )
+    densities = np.zeros( intervals.shape[0], dtype=np.float32 )
+    start = intervals[ :, 0 ]
+    length = intervals[ :, 1 ]
+    valid = length > 0
+    # the mean over each interval is the difference of the running sums at its ends
+    total = np.concatenate( ( [ 0.0 ], np.cumsum( density, dtype=np.float64 ) ) )
+    densities[ valid ] = ( total[ start[ valid ] + length[ valid ] ] - total[ start[ valid ] ] ) / length[ valid ]
     return densities
 
 def defaultRegionNames( regionCount, forFileName=True ):
@@ -552,14 +595,146 @@ def defaultRegionNames( regionCount, forFileName=True ):
                                 (True) or for display (False).
     '''
     if ( forFileName ):
-        return [ 'Region_%d' % i for i in xrange( len( rectDomains ) ) ]
+        return [ 'Region_%d' % i for i in xrange( regionCount ) ]
     else:
-        [ 'Region %d' % i for i in xrange( len( rectDomains ) ) ]
+        return [ 'Region %d' % i for i in xrange( regionCount ) ]
                                 
 
+# The record of a single interval an agent spends in a region
+INTERVAL_DTYPE = np.dtype( [ ( 'agent', np.int32 ), ( 'region', np.int32 ), ( 'enter', np.int32 ),
+                             ( 'duration', np.int32 ), ( 'distance', np.float32 ) ] )
+
+class RegionDwell:
+    '''Tracks the intervals of time agents spend inside a set of regions.  For each agent and
+    region, the longest interval is kept: the frame in which the agent entered the region,
+    the number of frames until it left, and the distance between the positions at which it
+    entered and left.  A stay which doesn't end before the data does has no interval.'''
+    def __init__( self, agtCount, regionCount, keepAll=False ):
+        '''Constructor.
+
+        @param      agtCount        An int.  The number of agents, N.
+        @param      regionCount     An int.  The number of regions, M.
+        @param      keepAll         A boolean.  If True, every interval is recorded, not just
+                                    the longest (see allIntervals).
+        '''
+        # N x M arrays: whether the agent is inside the region and when it entered
+        self.inside = np.zeros( ( agtCount, regionCount ), dtype=np.bool )
+        self.enterFrame = np.zeros( ( agtCount, regionCount ), dtype=np.int )
+        self.enterPt = np.zeros( ( agtCount, regionCount, 2 ), dtype=np.float32 )
+        # N x M x 2: the entrance frame and duration of the longest interval
+        self.intervals = np.zeros( ( agtCount, regionCount, 2 ), dtype=np.int )
+        # N x M: the squared distance traveled over the longest interval
+        self.distSq = np.zeros( ( agtCount, regionCount ), dtype=np.float32 )
+        # the records of all intervals, one array per frame with exits
+        self.records = None
+        if ( keepAll ):
+            self.records = []
+
+    def update( self, idx, ids, pos, isInside ):
+        '''Updates the intervals with a frame of data.  Agents missing from the frame keep
+        their state.
+
+        @param      idx             An int.  The index of the frame.
+        @param      ids             A numpy array of ints.  The identifiers of the K agents in
+                                    the frame (see frameAgentIDs).
+        @param      pos             A K x 2 numpy array.  The positions of the agents.
+        @param      isInside        A K x M numpy array of bools.  True if the agent is in the
+                                    region.
+        '''
+        wasInside = self.inside[ ids ]
+        changed = isInside ^ wasInside
+        row, region = np.nonzero( changed & isInside )
+        agent = ids[ row ]
+        self.enterFrame[ agent, region ] = idx
+        self.enterPt[ agent, region ] = pos[ row ]
+
+        row, region = np.nonzero( changed & wasInside )
+        if ( row.size ):
+            agent = ids[ row ]
+            enter = self.enterFrame[ agent, region ]
+            elapsed = idx - enter
+            delta = pos[ row ] - self.enterPt[ agent, region ]
+            distSq = np.sum( delta * delta, axis=1 )
+            if ( self.records is not None ):
+                record = np.empty( row.size, dtype=INTERVAL_DTYPE )
+                record[ 'agent' ] = agent
+                record[ 'region' ] = region
+                record[ 'enter' ] = enter
+                record[ 'duration' ] = elapsed
+                record[ 'distance' ] = np.sqrt( distSq )
+                self.records.append( record )
+            longest = self.intervals[ agent, region, 1 ]
+            longer = elapsed > longest
+            self.intervals[ agent, region, 1 ] = np.maximum( longest, elapsed )
+            agent = agent[ longer ]
+            region = region[ longer ]
+            self.intervals[ agent, region, 0 ] = enter[ longer ]
+            self.distSq[ agent, region ] = distSq[ longer ]
+
+        self.inside[ ids ] = isInside
+
+    def allIntervals( self ):
+        '''Reports every interval recorded so far (the tracker must keep all intervals).
+
+        @returns    A numpy array with dtype INTERVAL_DTYPE.  One record per interval, in the
+                    order in which the agents left the regions.
+        '''
+        assert( self.records is not None )
+        if ( not self.records ):
+            return np.empty( 0, dtype=INTERVAL_DTYPE )
+        return np.concatenate( self.records )
+
+class FundDiagCounter( PopulationCounter ):
+    '''Computes the fundamental diagram in a set of rectangular domains as part of a pass over
+    pedestrian data (see FramePass.consumeFrames).  The population of the domains and the
+    intervals agents spend in them are accumulated together.  The population is written to a
+    .pop file (see computePopulation) and the diagram of each domain to a .npy file (see
+    computeFundDiag).'''
+    def __init__( self, rectDomains, outFileName, names=None ):
+        '''Constructor.
+
+        @param      rectDomains     A list of RectDomain instances.
+        @param      outFileName     The base name for the output files.
+        @param      names           A list of strings.  Names for the rectangular domains.
+        '''
+        PopulationCounter.__init__( self, rectDomains, outFileName, names )
+        if ( names is None ):
+            names = defaultRegionNames( len( rectDomains ) )
+        else:
+            assert( len( names ) == len( rectDomains ) )
+        self.fileNames = [ outFileName + '_%s.npy' % name for name in names ]
+
+    def start( self, frameSet ):
+        PopulationCounter.start( self, frameSet )
+        self.dwell = RegionDwell( frameSet.agentCount(), len( self.rectDomains ) )
+        self.population = []
+        self.timeStep = frameSet.simStepSize
+
+    def consume( self, frame, idx, frameSet ):
+        pos = self.framePositions( frame )
+        inside = self.insideRects( pos )
+        population = inside.sum( axis=0 )
+        self.writePopulation( idx, population )
+        self.population.append( population )
+        self.dwell.update( idx, frameAgentIDs( frameSet, frame ), pos, inside )
+
+    def finish( self ):
+        PopulationCounter.finish( self )
+        areas = np.array( [ rect.area for rect in self.rectDomains ], dtype=np.float32 )
+        areas.shape = (1, -1)
+        density = np.array( self.population, dtype=np.float64 ).reshape( -1, len( self.rectDomains ) ) / areas
+        for i, fdFileName in enumerate( self.fileNames ):
+            intervals = self.dwell.intervals[ :, i ]
+            distances = np.sqrt( self.dwell.distSq[ :, i ] )
+            # For each interval, determine the agent's average speed and the average density
+            speeds, valid = calcSpeeds( intervals, distances, self.timeStep )
+            densities = calcIntervalDensityRegion( intervals, density[ :, i ] )
+            data = np.column_stack( ( densities[valid], speeds[valid] ) )
+            np.save( fdFileName, data )
+
 def computeFundDiag( frameSet, rectDomains, outFileName, names=None ):
     '''Computes the fundamental diagram in one or more regions for the given agent data and
-    writes it to files.
+    writes it to files.  The data is read once (see FundDiagCounter).
 
     @param      frameSet        An instance of trajectory data.
     @param      rectDomains     A list of RectDomain instances.  Compute the fundamental diagram for
@@ -569,31 +744,7 @@ def computeFundDiag( frameSet, rectDomains, outFileName, names=None ):
     @param      names           A list of strings.  Names for the rectangular domains.
     '''
     #   TODO: Offer up alternative density computation
-    # compute population of region over the time.
-    computePopulation( frameSet, rectDomains, outFileName, names )
-    # read population data
-    dataFile = outFileName + ".pop"
-    dFile = open( dataFile, 'r' )
-    nameLine = dFile.readline()[2:]
-    areas = np.array( [ rect.area for rect in rectDomains ], dtype=np.float32 )
-    areas.shape = (1, -1)
-    density = np.loadtxt( dFile )[:,1:] / areas
-
-    if ( names is None ):
-        names = defaultRegionNames( len( rectDomains ) ) 
-    else:
-        assert( len( names ) == len( rectDomains ) )
-    
-    # For each region
-    for i, rect in enumerate( rectDomains ):
-        # Compute intervals of agents crossing the regions
-        intervals, distances = framesInRegion( rect, frameSet )
-        # For each interval, determine the agent's average speed and the average density
-        speeds, valid = calcSpeeds( intervals, distances, frameSet.simStepSize )
-        densities = calcIntervalDensityRegion( intervals, density[ :, i ] )
-        data = np.column_stack( ( densities[valid], speeds[valid] ) )
-        fdFileName = outFileName + '_%s.npy' % names[ i ] 
-        np.save( fdFileName, data )
+    consumeFrames( frameSet, [ FundDiagCounter( rectDomains, outFileName, names ) ] )
 
 def plotFundDiag( outFileName, rectDomains, names=None ):
     '''Creates plots of fundamental diagram analysis.
@@ -904,7 +1055,9 @@ def main():
             for id in ids:
                 p.vertices.append( vertices[id] )
             polygons.append( p )
-        grids.computeRegionSpeed( frameSet, polygons, timeStep, EXCLUDE_STATES )
+        # the regions are assigned to whole frames of positions at once (see RegionSpeedCounter)
+        regionFrames = NPFrameSet( path, START_FRAME, MAX_FRAMES, MAX_AGENTS, FRAME_STEP )
+        grids.computeRegionSpeed( regionFrames, polygons, timeStep, EXCLUDE_STATES )
         print "Took", (time.clock() - s), "seconds"
         # output image
         imagePath = os.path.join( outPath, 'regionSpeed', 'region' )
@@ -1,6 +1,7 @@
 # Class for performing the work of crowd analysis
 
 from PyQt4 import QtGui, QtCore
+from AnalysisTask import executeTasks
 
 class CrowdAnalyzeThread( QtCore.QThread ):
     '''Class to perform the crowd analysis'''
@@ -14,5 +15,4 @@ class CrowdAnalyzeThread( QtCore.QThread ):
 
     def run( self ):
         '''Execute the task list'''
-        for task in self.tasks:
-            task.execute()
+        executeTasks( self.tasks )
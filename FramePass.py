@@ -0,0 +1,61 @@
+# This file contains the machinery for a single pass over pedestrian data shared by
+#   several analyses.
+#
+# Each analysis which consumes the frames of pedestrian data in order (convolving them
+#   into grids, counting the agents crossing lines, etc.) is expressed as a FrameConsumer.
+#   consumeFrames reads each frame of the data once and hands it to every consumer, so
+#   any number of analyses of the same data cost a single read of the data.
+#
+# The consumers run one after another in the reading process.  A shared pass saves the
+#   reading of the data, not the computation; an analysis which is faster with worker
+#   processes (e.g., density with several workers) is better performed on its own.
+
+class FrameConsumer:
+    '''The base class for an analysis which processes the frames of pedestrian data in
+    order.'''
+    def start( self, frameSet ):
+        '''Called before the first frame is consumed.
+
+        @param      frameSet        An instance of pedestrian data.  The data whose frames
+                                    will be consumed.
+        '''
+        pass
+
+    def consume( self, frame, index, frameSet ):
+        '''Processes a single frame of data.  The frame is shared by all consumers; it
+        must not be modified and must be copied if it is to be kept beyond this call.
+
+        @param      frame           A numpy array.  The frame's data, one row per agent.
+        @param      index           An int.  The index of the frame.
+        @param      frameSet        An instance of pedestrian data.  The data being consumed;
+                                    its per-frame queries (e.g., getFrameIds) refer to this frame.
+        '''
+        raise AttributeError, "consume not instantiated for this class: %s" % ( str( self.__class__ ) )
+
+    def finish( self ):
+        '''Called after the last frame has been consumed.'''
+        pass
+
+def consumeFrames( frameSet, consumers ):
+    '''Reads every frame of the pedestrian data once, handing each frame to all of the
+    consumers.
+
+    @param      frameSet        An instance of pedestrian data.
+    @param      consumers       A list of FrameConsumer instances.
+    @returns    An int.  The number of frames consumed.
+    '''
+    frameSet.setNext( 0 )
+    for c in consumers:
+        c.start( frameSet )
+    count = 0
+    while ( True ):
+        try:
+            frame, idx = frameSet.next()
+        except StopIteration:
+            break
+        for c in consumers:
+            c.consume( frame, idx, frameSet )
+        count += 1
+    for c in consumers:
+        c.finish()
+    return count
@@ -0,0 +1,400 @@
+# This file contains the compressed container for grid file sequences.
+# It is imported into GridFileSequence file.
+#
+# A compressed grid file sequence begins with MAGIC and the container version, followed by
+#   the same fields as the raw header (see GridFileSequence.header) and the compression
+#   parameters.  The grids are grouped into blocks of consecutive grids and each block is
+#   compressed independently.  A table at the end of the file records the position and size
+#   of every block, so any grid can be read without reading the grids which precede it.
+#
+# Before compression, the values can be converted to float16 or quantized to 16 bits (with
+#   a scale and offset per block) and their bytes are shuffled so that the corresponding
+#   bytes of all values are adjacent (which compresses far better than interleaved bytes).
+
+import collections
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import lzma
+    HAS_LZMA = True
+except ImportError:
+    try:
+        from backports import lzma
+        HAS_LZMA = True
+    except ImportError:
+        HAS_LZMA = False
+
+MAGIC = 'GFSZ'
+VERSION = 1
+
+# The compression codecs
+ZLIB = 0
+LZMA = 1
+CODEC_NAMES = { 'zlib':ZLIB, 'lzma':LZMA }
+
+# The storage of the values
+STORE_NATIVE = 0        # the values are stored with the sequence's type
+STORE_FLOAT16 = 1       # the values are stored as half-precision floats
+STORE_QUANTIZED = 2     # the values are quantized to 16 bits over the range of each block
+STORAGE_NAMES = { 'native':STORE_NATIVE, 'float16':STORE_FLOAT16, 'quantized':STORE_QUANTIZED }
+QUANTIZED_LEVELS = 65535
+
+# The size, in bytes, of the compression parameters following the raw header:
+#   codec, level, storage, block size (ints) and the offset of the block table (long long)
+PARAM_SIZE = 24
+# The position of the grid count in the header (following the magic and version)
+COUNT_OFFSET = 36
+# An entry in the block table
+BLOCK_TYPE = np.dtype( [ ( 'offset', '<i8' ), ( 'length', '<i8' ), ( 'low', '<f8' ), ( 'scale', '<f8' ) ] )
+# The number of decompressed blocks kept by CompressedGrids
+CACHE_BLOCKS = 4
+
+class GridCompression:
+    '''The parameters of the compression of a grid file sequence.'''
+    def __init__( self, codec='zlib', level=6, storage='native', blockSize=1 ):
+        '''Constructor.
+
+        @param      codec       A string.  The name of the compression codec (see CODEC_NAMES).
+        @param      level       An int.  The compression level.  For zlib, in the range [0, 9].
+                                For lzma, in the range [0, 9].
+        @param      storage     A string.  The storage of the values (see STORAGE_NAMES).
+                                float16 and quantized storage are lossy.
+        @param      blockSize   An int.  The number of consecutive grids compressed together.
+                                Larger blocks compress better, but any grid access decompresses
+                                the whole block.
+        @raises     ValueError if the parameters are invalid.
+        '''
+        if ( not codec in CODEC_NAMES ):
+            raise ValueError, "Unknown compression codec: %s" % ( codec )
+        if ( CODEC_NAMES[ codec ] == LZMA and not HAS_LZMA ):
+            raise ValueError, "The lzma codec requires the lzma module"
+        if ( not storage in STORAGE_NAMES ):
+            raise ValueError, "Unknown storage: %s" % ( storage )
+        if ( blockSize < 1 ):
+            raise ValueError, "The block size must be at least one grid"
+        self.codec = CODEC_NAMES[ codec ]
+        self.level = level
+        self.storage = STORAGE_NAMES[ storage ]
+        self.blockSize = blockSize
+
+def shuffleBytes( data ):
+    '''Arranges the bytes of an array by significance: the first byte of every value, followed
+    by the second byte of every value, etc.
+
+    @param      data        A numpy array.
+    @returns    A binary string.  The shuffled bytes.
+    '''
+    size = data.dtype.itemsize
+    return np.ascontiguousarray( data ).reshape( -1 ).view( np.uint8 ).reshape( -1, size ).T.tostring()
+
+def unshuffleBytes( binary, dtype ):
+    '''Restores the values shuffled by shuffleBytes.
+
+    @param      binary      A binary string.  The shuffled bytes.
+    @param      dtype       A numpy dtype.  The type of the values.
+    @returns    A one-dimensional numpy array of the values.
+    '''
+    size = np.dtype( dtype ).itemsize
+    planes = np.frombuffer( binary, np.uint8 ).reshape( size, -1 )
+    return np.ascontiguousarray( planes.T ).view( dtype ).reshape( -1 )
+
+def storageType( storage, arrayType ):
+    '''Reports the type in which the values are stored.
+
+    @param      storage     An int.  The storage of the values (e.g., STORE_NATIVE).
+    @param      arrayType   A numpy dtype.  The type of the sequence.
+    @returns    A numpy dtype.
+    '''
+    if ( storage == STORE_FLOAT16 ):
+        return np.dtype( np.float16 )
+    elif ( storage == STORE_QUANTIZED ):
+        return np.dtype( np.uint16 )
+    return np.dtype( arrayType )
+
+def encodeBlock( grids, compression ):
+    '''Compresses a block of grids.
+
+    @param      grids           A numpy array with shape ( count, w, h ).  The grids.
+    @param      compression     An instance of GridCompression.
+    @returns    A 3-tuple ( binary, low, scale ).  The compressed block and the offset and scale
+                of the quantization (zero and one for other storage).
+    '''
+    low = 0.0
+    scale = 1.0
+    if ( compression.storage == STORE_FLOAT16 ):
+        values = grids.astype( np.float16 )
+    elif ( compression.storage == STORE_QUANTIZED ):
+        low = float( grids.min() )
+        high = float( grids.max() )
+        if ( high > low ):
+            scale = ( high - low ) / QUANTIZED_LEVELS
+        values = np.round( ( grids - low ) / scale ).astype( np.uint16 )
+    else:
+        values = grids
+    binary = shuffleBytes( values )
+    if ( compression.codec == LZMA ):
+        binary = lzma.compress( binary, preset=compression.level )
+    else:
+        binary = zlib.compress( binary, compression.level )
+    return binary, low, scale
+
+def decodeBlock( binary, codec, storage, arrayType, low, scale ):
+    '''Decompresses a block of grids.
+
+    @param      binary      A binary string.  The compressed block.
+    @param      codec       An int.  The compression codec (e.g., ZLIB).
+    @param      storage     An int.  The storage of the values (e.g., STORE_NATIVE).
+    @param      arrayType   A numpy dtype.  The type of the sequence.
+    @param      low         A float.  The offset of the quantization.
+    @param      scale       A float.  The scale of the quantization.
+    @returns    A one-dimensional numpy array of arrayType.  The values of the block's grids.
+    '''
+    if ( codec == LZMA ):
+        if ( not HAS_LZMA ):
+            raise IOError, "The grid file sequence is compressed with lzma which is unavailable"
+        binary = lzma.decompress( binary )
+    else:
+        binary = zlib.decompress( binary )
+    values = unshuffleBytes( binary, storageType( storage, arrayType ) )
+    if ( storage == STORE_QUANTIZED ):
+        values = values * scale + low
+        if ( np.dtype( arrayType ).kind in 'iu' ):
+            values = np.round( values )
+    return values.astype( arrayType )
+
+class CompressedGridWriter:
+    '''Writes a compressed grid file sequence.  It serves as the output file of a
+    GridFileSequence: the grids are written as binary strings (see write) and the header is
+    completed with fillInHeader.'''
+    def __init__( self, fileName, header, arrayType, resolution, compression ):
+        '''Constructor.  Writes the header.
+
+        @param      fileName        A string.  The path to the file to write.
+        @param      header          A binary string.  The raw header of the grid file sequence
+                                    (see GridFileSequence.header).
+        @param      arrayType       A numpy dtype.  The type of the grids.
+        @param      resolution      A 2-tuple of ints.  The resolution of the grids.
+        @param      compression     An instance of GridCompression.
+        '''
+        self.file = open( fileName, 'wb' )
+        self.arrayType = np.dtype( arrayType )
+        self.resolution = ( int( resolution[0] ), int( resolution[1] ) )
+        self.gridSize = self.resolution[0] * self.resolution[1] * self.arrayType.itemsize
+        self.compression = compression
+        self.file.write( MAGIC )
+        self.file.write( struct.pack( 'i', VERSION ) )
+        self.file.write( header )
+        self.paramOffset = self.file.tell()
+        self.file.write( struct.pack( 'iiii', compression.codec, compression.level,
+                                      compression.storage, compression.blockSize ) )
+        self.file.write( struct.pack( 'q', 0 ) )
+        # the bytes of the grids which haven't been compressed yet
+        self.pending = []
+        self.pendingSize = 0
+        self.blocks = []
+
+    def write( self, binary ):
+        '''Writes grid data to the sequence.  The data is compressed once a block is complete.
+
+        @param      binary      A binary string.  The data of one or more grids (a grid may be
+                                split across calls).
+        '''
+        self.pending.append( binary )
+        self.pendingSize += len( binary )
+        if ( self.pendingSize >= self.gridSize * self.compression.blockSize ):
+            self.writeBlocks( False )
+
+    def writeBlocks( self, final ):
+        '''Compresses and writes the complete blocks of pending grids.
+
+        @param      final       A boolean.  If True, the remaining grids are written as a
+                                partial block.
+        '''
+        data = ''.join( self.pending )
+        blockBytes = self.gridSize * self.compression.blockSize
+        start = 0
+        while ( len( data ) - start >= blockBytes or ( final and len( data ) - start >= self.gridSize ) ):
+            count = min( self.compression.blockSize, ( len( data ) - start ) // self.gridSize )
+            end = start + count * self.gridSize
+            grids = np.frombuffer( data[ start:end ], self.arrayType ).reshape( ( count, ) + self.resolution )
+            binary, low, scale = encodeBlock( grids, self.compression )
+            self.blocks.append( ( self.file.tell(), len( binary ), low, scale ) )
+            self.file.write( binary )
+            start = end
+        self.pending = [ data[ start: ] ]
+        self.pendingSize = len( data ) - start
+
+    def fillInHeader( self, gridCount, minVal, maxVal ):
+        '''Writes the remaining grids and the block table and completes the header.
+
+        @param      gridCount   An int.  The number of grids in the file.
+        @param      minVal      A value of type arrayType. The minimum value across all grids.
+        @param      maxVal      A value of type arrayType. The maximum value across all grids.
+        '''
+        self.writeBlocks( True )
+        tableOffset = self.file.tell()
+        self.file.write( np.array( self.blocks, dtype=BLOCK_TYPE ).tostring() )
+        self.file.seek( COUNT_OFFSET )
+        self.file.write( struct.pack( 'i', gridCount ) )
+        self.file.write( struct.pack( 2 * self.arrayType.char, minVal, maxVal ) )
+        self.file.seek( self.paramOffset + 16 )
+        self.file.write( struct.pack( 'q', tableOffset ) )
+        self.file.seek( 0, 2 )
+
+    def close( self ):
+        '''Closes the file.'''
+        self.file.close()
+
+class CompressedGrids:
+    '''The grids of a compressed grid file sequence.  It is indexed like the array of grids of
+    a raw grid file sequence: with an int (a single grid) or a slice (an array of grids).  The
+    grids are decompressed on demand and the most recently used blocks are cached.  The
+    grids it returns are read-only.'''
+    def __init__( self, file, arrayType, count, resolution, cacheSize=CACHE_BLOCKS ):
+        '''Constructor.
+
+        @param      file            An open file object.  A compressed grid file sequence,
+                                    positioned at the compression parameters (following the
+                                    raw header).  The file is owned by this object.
+        @param      arrayType       A numpy dtype.  The type of the grids.
+        @param      count           An int.  The number of grids in the file.
+        @param      resolution      A 2-tuple of ints.  The resolution of the grids.
+        @param      cacheSize       An int.  The number of decompressed blocks to keep.
+        '''
+        self.file = file
+        self.arrayType = np.dtype( arrayType )
+        self.resolution = ( int( resolution[0] ), int( resolution[1] ) )
+        self.codec, self.level, self.storage, self.blockSize = struct.unpack( 'iiii', file.read( 16 ) )
+        tableOffset = struct.unpack( 'q', file.read( 8 ) )[0]
+        self.count = count if tableOffset > 0 else 0
+        blockCount = ( self.count + self.blockSize - 1 ) // self.blockSize
+        self.blocks = np.zeros( 0, dtype=BLOCK_TYPE )
+        if ( blockCount > 0 ):
+            file.seek( tableOffset )
+            self.blocks = np.fromstring( file.read( blockCount * BLOCK_TYPE.itemsize ), BLOCK_TYPE )
+        self.cacheSize = max( 1, cacheSize )
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__( self ):
+        return self.count
+
+    def getBlock( self, block ):
+        '''Returns the grids of a block.
+
+        @param      block       An int.  The index of the block.
+        @returns    A read-only numpy array with shape ( count, w, h ).
+        '''
+        self.lock.acquire()
+        try:
+            if ( block in self.cache ):
+                grids = self.cache.pop( block )
+                self.cache[ block ] = grids
+                return grids
+            entry = self.blocks[ block ]
+            self.file.seek( int( entry[ 'offset' ] ) )
+            binary = self.file.read( int( entry[ 'length' ] ) )
+        finally:
+            self.lock.release()
+        values = decodeBlock( binary, self.codec, self.storage, self.arrayType, entry[ 'low' ], entry[ 'scale' ] )
+        grids = values.reshape( ( -1, ) + self.resolution )
+        grids.flags.writeable = False
+        self.lock.acquire()
+        try:
+            self.cache[ block ] = grids
+            while ( len( self.cache ) > self.cacheSize ):
+                self.cache.popitem( False )
+        finally:
+            self.lock.release()
+        return grids
+
+    def __getitem__( self, index ):
+        '''Returns a grid or a range of grids.
+
+        @param      index       An int or a slice.  The grids to return.
+        @returns    A numpy array.  For an int, the grid (with shape ( w, h )).  For a slice,
+                    the grids (with shape ( count, w, h )).
+        @raises     IndexError if an int index is out of range.
+        '''
+        if ( isinstance( index, slice ) ):
+            indices = xrange( *index.indices( self.count ) )
+            grids = np.empty( ( len( indices ), ) + self.resolution, dtype=self.arrayType )
+            for i, gridID in enumerate( indices ):
+                grids[ i ] = self[ gridID ]
+            return grids
+        if ( index < 0 ):
+            index += self.count
+        if ( index < 0 or index >= self.count ):
+            raise IndexError, "Grid index out of range: %d" % ( index )
+        return self.getBlock( index // self.blockSize )[ index % self.blockSize ]
+
+    def close( self ):
+        '''Closes the file.'''
+        self.file.close()
+        self.cache.clear()
+
+def convertGridFile( inName, outName, compression=None ):
+    '''Converts a grid file sequence between the raw and compressed formats.
+
+    @param      inName          A string.  The path to the grid file sequence to convert (in
+                                either format).
+    @param      outName         A string.  The path to the file to write.
+    @param      compression     An instance of GridCompression.  If None, the output is a raw
+                                grid file sequence.
+    @returns    A 2-tuple of ints ( inBytes, outBytes ).  The sizes of the two files.
+    '''
+    import os
+    from GridFileSequence import GridFileSequence, GridFileSequenceReader
+    reader = GridFileSequenceReader( inName )
+    gfs = GridFileSequence( os.path.splitext( outName )[0], arrayType=reader.arrayType, compression=compression )
+    outFile = gfs.openGrids( outName, reader.corner, reader.size, ( reader.w, reader.h ) )
+    for grid, gridID in reader:
+        outFile.write( grid.cells.tostring() )
+    gfs.fillInHeader( outFile, reader.gridCount(), reader.range[0], reader.range[1] )
+    outFile.close()
+    reader.close()
+    return os.path.getsize( inName ), os.path.getsize( outName )
+
+def main():
+    import optparse
+    import sys
+    parser = optparse.OptionParser()
+    parser.set_description( 'Converts a grid file sequence between the raw and compressed formats' )
+    parser.add_option( '-i', '--input', help='The path to the grid file sequence to convert.',
+                       action='store', dest='input', default='' )
+    parser.add_option( '-o', '--output', help='The path to the converted grid file sequence.',
+                       action='store', dest='output', default='' )
+    parser.add_option( '-c', '--codec', help='The compression codec: %s.  Default is zlib.' % ( ', '.join( CODEC_NAMES.keys() ) ),
+                       action='store', dest='codec', default='zlib' )
+    parser.add_option( '-l', '--level', help='The compression level.  Default is 6.',
+                       action='store', type='int', dest='level', default=6 )
+    parser.add_option( '-s', '--storage', help='The storage of the values: %s.  Default is native.' % ( ', '.join( STORAGE_NAMES.keys() ) ),
+                       action='store', dest='storage', default='native' )
+    parser.add_option( '-b', '--blockSize', help='The number of grids compressed together.  Default is 1.',
+                       action='store', type='int', dest='blockSize', default=1 )
+    parser.add_option( '-r', '--raw', help='Indicates that the output should be a raw (uncompressed) grid file sequence.',
+                       action='store_true', dest='raw', default=False )
+    options, args = parser.parse_args()
+
+    if ( options.input == '' or options.output == '' ):
+        print '\n *** You must specify an input and an output file'
+        parser.print_help()
+        sys.exit(1)
+
+    compression = None
+    if ( not options.raw ):
+        try:
+            compression = GridCompression( options.codec, options.level, options.storage, options.blockSize )
+        except ValueError as e:
+            print '\n *** %s' % ( e )
+            parser.print_help()
+            sys.exit(1)
+    inBytes, outBytes = convertGridFile( options.input, options.output, compression )
+    print 'Converted %s (%d bytes) to %s (%d bytes)' % ( options.input, inBytes, options.output, outBytes )
+
+if __name__ == '__main__':
+    main()
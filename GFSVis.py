@@ -1,11 +1,35 @@
 # Script for visualizing a grid file sequence
 import GridFileSequence as GFS
+import multiprocessing
 import numpy as np
 import os
 import pygame
+import time
+import traceback
 from primitives import Vector2
 import ColorMap
+import PNGWriter
+from ProcessRasterization import canProcess, waitForMessage
 from trajectory import loadTrajectory
+from trajectory.scbData import NPFrameSet
+from Voronoi import rasterizeObstacles
+
+# The number of grids the readers created here page in ahead of the grid being drawn.
+PREFETCH_GRIDS = 4
+
+# The image output backends.  The pygame backend draws on pygame surfaces and saves them
+#   with pygame.  The numpy backend colors and draws into numpy arrays and writes them with
+#   PNGWriter; it doesn't need a display and only writes png images.  It still requires
+#   pygame: the color bar (and its labels) is drawn on a pygame surface.
+PYGAME_BACKEND = 'pygame'
+NUMPY_BACKEND = 'numpy'
+IMAGE_BACKENDS = ( PYGAME_BACKEND, NUMPY_BACKEND )
+
+OBST_COLOR = ( 128, 128, 128 )
+
+# Messages passed from the image export workers to the main process
+EXPORT_DONE_MSG = 0     # ( EXPORT_DONE_MSG, workerID, imageCount, seconds )
+EXPORT_ERROR_MSG = 1    # ( EXPORT_ERROR_MSG, workerID, traceback string )
 
 def drawSites( sites, surface, grid, radius=3 ):
     '''Draws dots at the site locations onto the provided surface.
@@ -34,19 +58,71 @@ def drawObstacles( obstacles, surface, grid ):
     @param  grid            An instance of AbstractGrid (see Grid.py).  Used to map
                             from world to image coordinates.
     '''
-    OBST_COLOR = np.array( (128,128,128), dtype=np.uint8 )
     OBST_WIDTH = 1
+    def imgSpace( point ):
+        x, y = grid.getCenter( Vector2( point[0], point[1] ) )
+        return x, grid.resolution[1] - y
     for obst in obstacles.polys:
         if ( obst.closed ):
-            verts = map( lambda x: grid.getCenter( Vector2( x[0], x[1] ) ), obst.vertices )
+            verts = map( imgSpace, obst.vertices )
             pygame.draw.polygon( surface, OBST_COLOR, verts )
         else:
             for seg in obst.segments:
-                p0 = grid.getCenter( Vector2( seg.p1[0], seg.p1[1] ) )
-                p1 = grid.getCenter( Vector2( seg.p2[0], seg.p2[1] ) )
-                pygame.draw.line( surface, OBST_COLOR, (p0[0],p0[1]), (p1[0], p1[1]), OBST_WIDTH )
+                p0 = imgSpace( seg.p1 )
+                p1 = imgSpace( seg.p2 )
+                pygame.draw.line( surface, OBST_COLOR, p0, p1, OBST_WIDTH )
+
+def drawSitesNP( sites, pixels, grid, radius=3 ):
+    '''Draws dots at the site locations into an image array (see drawSites).
+
+    @param      sites       An Nx2 numpy array of locations in world coordinates.
+    @param      pixels      A WxHx3 numpy array of uint8s.  The image (in surfarray layout).
+                            The sites will be drawn into it.
+    @param      grid        An instance of AbstractGrid (see Grid.py)  Used to map
+                            from world to image coordinates.
+    @param      radius      An int.  The radius of the sites (in pixels)
+    '''
+    W, H = pixels.shape[:2]
+    x = np.floor( ( sites[:, 0] - grid.minCorner[0] ) / grid.cellSize[0] ).astype( np.int64 )
+    y = H - np.floor( ( sites[:, 1] - grid.minCorner[1] ) / grid.cellSize[1] ).astype( np.int64 )
+    for r, color in ( ( radius + 2, 0 ), ( radius, 255 ) ):
+        dx, dy = np.mgrid[ -r:r + 1, -r:r + 1 ]
+        disc = dx * dx + dy * dy <= r * r
+        px = ( x[:, np.newaxis] + dx[ disc ] ).ravel()
+        py = ( y[:, np.newaxis] + dy[ disc ] ).ravel()
+        inside = ( px >= 0 ) & ( px < W ) & ( py >= 0 ) & ( py < H )
+        pixels[ px[ inside ], py[ inside ] ] = color
+
+# The most recently rasterized obstacles (see obstacleMask): [ obstacles, domain, mask ]
+LAST_OBSTACLE_MASK = [ None, None, None ]
+
+def obstacleMask( obstacles, grid ):
+    '''Returns the cells of the grid covered by the obstacles (see Voronoi.rasterizeObstacles).
+    The mask of the last obstacles and grid domain is reused.
+
+    @param  obstacles       An instance of ObstacleSet (see obstacles.py)
+    @param  grid            An instance of AbstractGrid (see Grid.py).
+    @returns    A WxH numpy array of bools.  True for the cells covered by obstacles.
+    '''
+    domain = ( grid.minCorner[0], grid.minCorner[1], grid.size[0], grid.size[1],
+               grid.resolution[0], grid.resolution[1] )
+    if ( LAST_OBSTACLE_MASK[0] is not obstacles or LAST_OBSTACLE_MASK[1] != domain ):
+        LAST_OBSTACLE_MASK[:] = [ obstacles, domain, rasterizeObstacles( grid, obstacles.polys ) ]
+    return LAST_OBSTACLE_MASK[2]
+
+def drawObstaclesNP( obstacles, pixels, grid ):
+    '''Draws the obstacles into an image array (see drawObstacles).
+
+    @param  obstacles       An instance of ObstacleSet (see obstacles.py)
+    @param  pixels          A WxHx3 numpy array of uint8s.  The image (in surfarray layout).
+                            The obstacles will be drawn into it.
+    @param  grid            An instance of AbstractGrid (see Grid.py).  Used to map
+                            from world to image coordinates.
+    '''
+    pixels[ :, ::-1 ][ obstacleMask( obstacles, grid ) ] = OBST_COLOR
     
-def visualizeGrid( grid, cMap, outFileName, minVal, maxVal, sites=None, obstacles=None ):
+def visualizeGrid( grid, cMap, outFileName, minVal, maxVal, sites=None, obstacles=None,
+                   backend=PYGAME_BACKEND, level=PNGWriter.DEFAULT_LEVEL ):
     '''Visualizes a grid file sequence with the given color map.
 
     @param      grid            An instance of a DataGrid.  A single grid to visualize.
@@ -58,7 +134,17 @@ def visualizeGrid( grid, cMap, outFileName, minVal, maxVal, sites=None, obstacle
     @param      sites           An Nx2 numpy array of locations in world coordinates.
     @param      obstacles       An instance of ObstacleSet (optional).  If obstacle are provided,
                                 Then they will be drawn over the top of the data.
+    @param      backend         A string.  The image output backend (one of IMAGE_BACKENDS).
+    @param      level           An int.  The png compression level of the numpy backend.
     '''
+    if ( backend == NUMPY_BACKEND ):
+        pixels = cMap.colorArray( ( minVal, maxVal ), grid.cells )
+        if ( not sites is None ):
+            drawSitesNP( sites, pixels, grid )
+        if ( not obstacles is None ):
+            drawObstaclesNP( obstacles, pixels, grid )
+        PNGWriter.writePNG( outFileName, pixels, level )
+        return
     s = grid.surface( cMap, minVal, maxVal )
     if ( not sites is None ):
         drawSites( sites, s, grid )
@@ -66,6 +152,32 @@ def visualizeGrid( grid, cMap, outFileName, minVal, maxVal, sites=None, obstacle
         drawObstacles( obstacles, s, grid )
     pygame.image.save( s, outFileName )
 
+def saveMapBar( cMap, fileName, backend=PYGAME_BACKEND, dataRange=None ):
+    '''Saves the color bar of the last data mapped by the color map.
+
+    @param      cMap            An instance of ColorMap.
+    @param      fileName        A string.  The name of the file to save the image as.
+    @param      backend         A string.  The image output backend (one of IMAGE_BACKENDS).
+    @param      dataRange       A 2-tuple of floats (minVal, maxVal) (optional).  If given, the
+                                bar is drawn for data mapped with this range (as by
+                                visualizeGrid), even if the color map itself mapped no data
+                                (e.g., the images were exported by worker processes).
+    '''
+    if ( dataRange is not None ):
+        # map a single value so the color map records the range exactly as it does when it
+        #   maps a grid
+        data = np.empty( ( 1, 1 ), dtype=np.float32 )
+        data.fill( dataRange[0] )
+        if ( backend == NUMPY_BACKEND ):
+            cMap.colorArray( dataRange, data )
+        else:
+            cMap.colorOnSurface( dataRange, data )
+    bar = cMap.lastMapBar(7)
+    if ( backend == NUMPY_BACKEND ):
+        PNGWriter.writePNG( fileName, pygame.surfarray.array3d( bar ) )
+    else:
+        pygame.image.save( bar, fileName )
+
 def visualizeMultiGFS( gfsFiles, cMap, outFileBases, imgFormat, mapRange=1.0, mapLimits=None, sites=None, obstacles=None ):
     '''Visualizes multiple grid file sequence with the given color map (including a single, commmon range).
 
@@ -97,8 +209,9 @@ def visualizeMultiGFS( gfsFiles, cMap, outFileBases, imgFormat, mapRange=1.0, ma
     
     
     digits = map( lambda x: int( np.ceil( np.log10( x.gridCount() ) ) ), gfsFiles )
-    minVal = min( map( lambda x: x.range[0], gfsFiles ) )
-    maxVal = max( map( lambda x: x.range[1], gfsFiles ) )
+    ranges = [ gfs.dataRange() for gfs in gfsFiles ]
+    minVal = min( map( lambda x: x[0], ranges ) )
+    maxVal = max( map( lambda x: x[1], ranges ) )
     maxVal = ( maxVal - minVal ) * mapRange + minVal
 
     if ( not mapLimits is None ):
@@ -125,8 +238,104 @@ def visualizeMultiGFS( gfsFiles, cMap, outFileBases, imgFormat, mapRange=1.0, ma
                 print "Error on frame", gridID
                 raise
         pygame.image.save( cMap.lastMapBar(7), '%s_bar.png' % ( outFileBase ) )
+
+def canExport( gfsFile, sites=None ):
+    '''Reports if the images of a grid file sequence can be exported by worker processes.  Each
+    worker must be able to open its own reader (and its own copy of the sites).
+
+    @param      gfsFile         An instance of a GridFileSequenceReader.
+    @param      sites           An instance of pedestrian trajectory (optional).
+    @returns    A boolean.  True if the export can be done by worker processes.
+    '''
+    return hasattr( gfsFile, 'fileName' ) and ( sites is None or canProcess( sites ) )
+
+def exportGrids( workerID, readerArgs, firstGrid, lastGrid, siteArgs, cMap, outFileBase, digits,
+                 imgFormat, minVal, maxVal, obstacles, backend, level, doneQueue ):
+    '''The body of an image export worker process.  The worker writes the images of the grids
+    in the range [ firstGrid, lastGrid ) (see visualizeGFS).
+
+    @param      workerID        An int.  The index of this worker.
+    @param      readerArgs      A tuple.  The arguments to open the worker's GridFileSequenceReader.
+    @param      firstGrid       An int.  The index of the first grid to export.
+    @param      lastGrid        An int.  The index of the grid after the last grid to export.
+    @param      siteArgs        A 2-tuple ( openArgs, frame ).  The arguments to open the worker's
+                                NPFrameSet and the index of the frame drawn over the first grid.
+                                If None, no sites are drawn.
+    @param      doneQueue       A multiprocessing.Queue.  The messages to the main process.
+
+    The remaining parameters are as in visualizeGrid.
+    '''
+    try:
+        start = time.time()
+        if ( backend == PYGAME_BACKEND ):
+            pygame.init()
+        reader = GFS.GridFileSequenceReader( *readerArgs, prefetch=PREFETCH_GRIDS )
+        reader.setNext( firstGrid )
+        sites = None
+        if ( siteArgs is not None ):
+            sites = NPFrameSet( *siteArgs[0] )
+            sites.setNext( siteArgs[1] )
+        for i in xrange( firstGrid, lastGrid ):
+            grid, gridID = reader.next()
+            frame = None
+            if ( sites is not None ):
+                frame, frameID = sites.next()
+            fileName = '{0}{1:0{2}d}.{3}'.format( outFileBase, gridID, digits, imgFormat )
+            visualizeGrid( grid, cMap, fileName, minVal, maxVal, frame, obstacles, backend, level )
+        reader.close()
+        doneQueue.put( ( EXPORT_DONE_MSG, workerID, lastGrid - firstGrid, time.time() - start ) )
+    except Exception:
+        doneQueue.put( ( EXPORT_ERROR_MSG, workerID, traceback.format_exc() ) )
+
+def exportParallel( gfsFile, cMap, outFileBase, digits, imgFormat, minVal, maxVal, sites, obstacles,
+                    backend, level, workerCount ):
+    '''Exports the remaining grids of a grid file sequence with worker processes.  The grids
+    are partitioned into contiguous ranges, one per worker; each worker opens its own reader
+    (and sites) and writes the images of its range (see exportGrids).
+
+    @param      gfsFile         An instance of a GridFileSequenceReader which satisfies canExport.
+                                The export starts at its next grid.
+    @param      workerCount     An int.  The number of worker processes.
+    @returns    An int.  The number of exported images.
+    @raises     RuntimeError if a worker process fails or exits without reporting.
+
+    The remaining parameters are as in visualizeGFS.
+    '''
+    firstGrid = gfsFile.currGridID + 1
+    gridCount = max( 0, gfsFile.gridCount() - firstGrid )
+    workerCount = max( 1, min( workerCount, gridCount ) )
+    readerArgs = ( gfsFile.fileName, gfsFile.startGrid, gfsFile.maxGrids, gfsFile.gridStep )
+    doneQueue = multiprocessing.Queue()
+    workers = []
+    for w in xrange( workerCount ):
+        first = firstGrid + gridCount * w / workerCount
+        last = firstGrid + gridCount * ( w + 1 ) / workerCount
+        siteArgs = None
+        if ( sites is not None ):
+            siteArgs = ( sites.openArgs, sites.currFrameIndex + 1 + first - firstGrid )
+        args = ( w, readerArgs, first, last, siteArgs, cMap, outFileBase, digits, imgFormat,
+                 minVal, maxVal, obstacles, backend, level, doneQueue )
+        workers.append( multiprocessing.Process( target=exportGrids, args=args ) )
+    for p in workers:
+        p.start()
+    finished = set()
+    try:
+        for w in xrange( workerCount ):
+            msg = waitForMessage( doneQueue, workers, finished )
+            if ( msg[0] == EXPORT_ERROR_MSG ):
+                raise RuntimeError, "Image export worker %d failed:\n%s" % ( msg[1], msg[2] )
+            msgType, workerID, count, seconds = msg
+            finished.add( workerID )
+            print "\t\tWorker %d exported %d images in %.2f s" % ( workerID, count, seconds )
+    finally:
+        for p in workers:
+            if ( p.is_alive() ):
+                p.terminate()
+            p.join()
+    return gridCount
     
-def visualizeGFS( gfsFile, cMap, outFileBase, imgFormat, mapRange=1.0, mapLimits=None, sites=None, obstacles=None ):
+def visualizeGFS( gfsFile, cMap, outFileBase, imgFormat, mapRange=1.0, mapLimits=None, sites=None, obstacles=None, workerCount=1,
+                  backend=PYGAME_BACKEND, level=PNGWriter.DEFAULT_LEVEL ):
     '''Visualizes a grid file sequence with the given color map.
 
     @param      gfsFile         An instance of a GridFileSequenceReader.  The grids to visualize.
@@ -146,8 +355,20 @@ def visualizeGFS( gfsFile, cMap, outFileBase, imgFormat, mapRange=1.0, mapLimits
                                 of data as there are grids in the sequence.
     @param      obstacles       An instance of ObstacleSet (optional).  If obstacle are provided,
                                 Then they will be drawn over the top of the data.
+    @param      workerCount     An int.  The number of worker processes which export the images.
+                                If greater than one (and the export can be done by workers, see
+                                canExport), the grids are partitioned across the workers.
+    @param      backend         A string.  The image output backend (one of IMAGE_BACKENDS).
+    @param      level           An int.  The png compression level of the numpy backend.
+    @raises     ValueError if the backend is unknown or can't write the image format.
     '''
-    pygame.init()
+    if ( not backend in IMAGE_BACKENDS ):
+        raise ValueError, "Unknown image backend: %s" % ( backend )
+    if ( backend == NUMPY_BACKEND ):
+        if ( imgFormat.lower() != 'png' ):
+            raise ValueError, "The numpy image backend only writes png images"
+    else:
+        pygame.init()
 
     # make sure the path exists
     path, name = os.path.split( outFileBase )
@@ -156,35 +377,43 @@ def visualizeGFS( gfsFile, cMap, outFileBase, imgFormat, mapRange=1.0, mapLimits
     
     print gfsFile.summary()
     digits = int( np.ceil( np.log10( gfsFile.gridCount() ) ) )
+    # the range of the grids being visualized (see GridFileSequenceReader.dataRange)
+    minVal, maxVal = gfsFile.dataRange()
     if ( not mapLimits is None ):
         if ( not isinstance( mapLimits, tuple ) ):
             raise ValueError, "The parmeter mapLimits must be a tuple"
         elif ( len( mapLimits ) != 2 ):
             raise ValueError, "The parameter mapLimits must have two values"
-        minVal = gfsFile.range[0]
         if ( not mapLimits[0] is None ):
             minVal = mapLimits[0]
-        maxVal = gfsFile.range[1]
         if ( not mapLimits[1] is None ):
             maxVal = mapLimits[1]
     else:
-        minVal = gfsFile.range[0]
-        maxVal = gfsFile.range[1]
         maxVal = ( maxVal - minVal ) * mapRange + minVal
-    
-    for grid, gridID in gfsFile:
-        try:
-            frame = None
-            if ( sites is not None ):
-                frame, frameID = sites.next()
-            fileName = '{0}{1:0{2}d}.{3}'.format( outFileBase, gridID, digits, imgFormat )
-            visualizeGrid( grid, cMap, fileName, minVal, maxVal, frame, obstacles )
-        except MemoryError:
-            print "Error on frame", gridID
-            raise
-    pygame.image.save( cMap.lastMapBar(7), '%sbar.png' % ( outFileBase ) )
+
+    start = time.time()
+    imageCount = 0
+    if ( workerCount > 1 and canExport( gfsFile, sites ) ):
+        imageCount = exportParallel( gfsFile, cMap, outFileBase, digits, imgFormat, minVal, maxVal,
+                                     sites, obstacles, backend, level, workerCount )
+    else:
+        for grid, gridID in gfsFile:
+            try:
+                frame = None
+                if ( sites is not None ):
+                    frame, frameID = sites.next()
+                fileName = '{0}{1:0{2}d}.{3}'.format( outFileBase, gridID, digits, imgFormat )
+                visualizeGrid( grid, cMap, fileName, minVal, maxVal, frame, obstacles, backend, level )
+                imageCount += 1
+            except MemoryError:
+                print "Error on frame", gridID
+                raise
+    elapsed = time.time() - start
+    print "\tExported %d images in %.2f s (%.1f images/s)" % ( imageCount, elapsed, imageCount / max( elapsed, 1e-6 ) )
+    saveMapBar( cMap, '%sbar.png' % ( outFileBase ), backend, ( minVal, maxVal ) )
         
-def visualizeGFSName( gfsFileName, outFileBase, imgFormat='png', cMap=ColorMap.BlackBodyMap(), mapRange=1.0, mapLimits=None, sitesName=None, obstacles=None ):
+def visualizeGFSName( gfsFileName, outFileBase, imgFormat='png', cMap=ColorMap.BlackBodyMap(), mapRange=1.0, mapLimits=None, sitesName=None, obstacles=None, workerCount=1,
+                      backend=PYGAME_BACKEND, level=PNGWriter.DEFAULT_LEVEL ):
     '''Visualizes a grid file sequence with the given color map.
 
     @param      gfsFileName     A string.  The name of the GridFileSequence to visualize.
@@ -203,14 +432,19 @@ def visualizeGFSName( gfsFileName, outFileBase, imgFormat='png', cMap=ColorMap.B
     @param      sitesName       A string.  The path to a set of trajectory sites
     @param      obstacles       An instance of ObstacleSet (optional).  If obstacle are provided,
                                 Then they will be drawn over the top of the data.
+    @param      workerCount     An int.  The number of worker processes which export the images.
+    @param      backend         A string.  The image output backend (one of IMAGE_BACKENDS).
+    @param      level           An int.  The png compression level of the numpy backend.
     '''
-    reader = GFS.GridFileSequenceReader( gfsFileName )
+    reader = GFS.GridFileSequenceReader( gfsFileName, prefetch=PREFETCH_GRIDS )
     reader.setNext( 0 )
     try:
         sites = loadTrajectory( sitesName )
     except:
         sites = None
-    visualizeGFS( reader, cMap, outFileBase, imgFormat, mapRange, mapLimits, sites, obstacles )
+    visualizeGFS( reader, cMap, outFileBase, imgFormat, mapRange, mapLimits, sites, obstacles, workerCount,
+                  backend, level )
+    reader.close()
 
 if __name__ == '__main__':
     def main():
@@ -232,6 +466,12 @@ if __name__ == '__main__':
                            action='store', dest='ext', default='png' )
         parser.add_option( '-b', '--obstacles', help='Path to an obstacle xml file',
                            action='store', dest='obstXML', default=None )
+        parser.add_option( '-w', '--workers', help='The number of worker processes which export the images (default is 1)',
+                           action='store', dest='workers', type='int', default=1 )
+        parser.add_option( '-k', '--backend', help='The image output backend: %s (default is pygame).  The numpy backend only writes png images and doesn\'t require a display.' % ( ', '.join( IMAGE_BACKENDS ) ),
+                           action='store', dest='backend', default=PYGAME_BACKEND )
+        parser.add_option( '-z', '--level', help='The png compression level (0-9) of the numpy backend (default is %d, %d is fastest)' % ( PNGWriter.DEFAULT_LEVEL, PNGWriter.FAST_LEVEL ),
+                           action='store', dest='level', type='int', default=PNGWriter.DEFAULT_LEVEL )
         options, args = parser.parse_args()
 
         if ( options.input == '' ):
@@ -251,6 +491,11 @@ if __name__ == '__main__':
             parser.print_help()
             sys.exit(1)
 
+        if ( not options.backend in IMAGE_BACKENDS ):
+            print '\n *** You have selected an invalid image backend: %s' % ( options.backend )
+            parser.print_help()
+            sys.exit(1)
+
         trajData = None
         if ( not options.trajName is None ):
             try:
@@ -263,14 +508,15 @@ if __name__ == '__main__':
             if ( not os.path.exists( folder ) ):
                 os.makedirs( folder )
 
-        reader = GFS.GridFileSequenceReader( options.input )
+        reader = GFS.GridFileSequenceReader( options.input, prefetch=PREFETCH_GRIDS )
         reader.setNext( 0 )    
 
         obstacles = None
         if ( options.obstXML ):
             obstacles, bb = obstacles.readObstacles( options.obstXML )
 
-        visualizeGFS( reader, colorMap, options.output, options.ext, 1.0, trajData, obstacles )
+        visualizeGFS( reader, colorMap, options.output, options.ext, 1.0, sites=trajData, obstacles=obstacles,
+                      workerCount=options.workers, backend=options.backend, level=options.level )
         
     main()    
     
\ No newline at end of file
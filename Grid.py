@@ -310,6 +310,14 @@ class DataGrid( AbstractGrid) :
         """Returns the maximum value of the grid"""
         return self.cells.min()
 
+    def statistics( self ):
+        """Returns the statistics of the grid's values.
+
+        @returns    A 5-tuple ( min, max, mean, sum, nonzero ).  The minimum, maximum, mean and
+                    sum of the values and the number of non-zero values."""
+        total = self.cells.sum( dtype=np.float64 )
+        return ( self.cells.min(), self.cells.max(), total / self.cells.size, total, np.count_nonzero( self.cells ) )
+
     def clear( self, arrayType=np.float32, leaveEmpty=False ):
         # Cells are a 2D array accessible with (x, y) values
         #   x = column, y = row
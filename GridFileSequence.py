@@ -1,42 +1,61 @@
 # This file contain GridFileSquence class which create grid for squence of frame
 
+import mmap
 import numpy as np
 import struct
 import threading
 import time
 import multiprocessing
 import os
+import traceback
 
 from stats import StatRecord
 from Grid import *
 from RasterGrid import RasterGrid
 from primitives import Vector2
 from ThreadRasterization import *
+from ProcessRasterization import *
+from GFSCompression import CompressedGridWriter, CompressedGrids
+from FramePass import FrameConsumer, consumeFrames
+from RegionRaster import RegionRaster, RegionSpeedCounter
+import GFSCompression
 import Kernels
 import Signals
 
 THREAD_COUNT = 1#max( 1, multiprocessing.cpu_count() / 2 )
 ##THREAD_COUNT = multiprocessing.cpu_count() - 1
+# The maximum number of finished grids waiting to be written
+BUFFER_CAPACITY = 2 * THREAD_COUNT
+
+# The per-grid statistics stored alongside a grid file sequence (see DataGrid.statistics)
+STATS_TYPE = np.dtype( [ ( 'min', np.float64 ), ( 'max', np.float64 ), ( 'mean', np.float64 ),
+                         ( 'sum', np.float64 ), ( 'nonzero', np.int64 ) ] )
+# The extension appended to a grid file sequence's name for its statistics file
+STATS_EXT = '.stats'
         
 # the thread that does the file output
-def threadOutput( outFile, buffer, bufferLock, startTime, gfs ):
-    """Reads grids from the buffer and writes them to the output file"""
+def threadOutput( outFile, buffer, startTime, log ):
+    """Reads grids from the buffer and writes them to the output file.  The statistics of each
+    grid are recorded in the log (an instance of RasterReport).  If the buffer or the output
+    fails, the buffer is marked failed (see GridBuffer.fail)."""
     nextGrid = 0
-    while ( buffer or gfs.activeThreadCount ):
-        # keep doing the work as long as the buffer has contents or there are active raster threads
-        bufferLock.acquire()
-        try:
-            i = buffer.index( nextGrid )
-            bg = buffer.pop( i )
-            bufferLock.release()
+    try:
+        entry = buffer.get()
+        while ( entry is not None ):
+            index, grid = entry
             if ( nextGrid & 0xFF == 0 ):
                 print "\t\tWriting buffer %d at time %f s" % ( nextGrid, time.clock() - startTime )
-            outFile.write( bg.grid.binaryString() )
+            log.recordGrid( index, grid.statistics() )
+            log.incCount()
+            outFile.write( grid.binaryString() )
             nextGrid += 1
-        except ValueError:
-            bufferLock.release()
-            time.sleep( 1.0 )
+            entry = buffer.get()
+    except Exception:
+        # the rasterization threads mustn't wait for an output thread which has stopped
+        buffer.fail( traceback.format_exc() )
+        return
     print "\t\tLast grid %d at time %f s" % ( nextGrid - 1, time.clock() - startTime )
+    print "\t\tBuffer depth: %d (capacity %d), writer waited %.3f s, rasterizers waited %.3f s" % ( buffer.maxDepth, buffer.capacity, buffer.writerStall, buffer.producerStall )
     
 class RasterReport:
     """Simple class to return the results of rasterization"""
@@ -44,10 +63,31 @@ class RasterReport:
         self.maxVal = 0.0
         self.minVal = 1e6
         self.count = 0
+        # ( index, min, max, mean, sum, nonzero ) for each recorded grid
+        self.gridStats = []
 
     def incCount( self ):
         self.count += 1
 
+    def recordGrid( self, index, stats ):
+        '''Records the statistics of a single grid.
+
+        @param      index       An int.  The index of the grid in the sequence.
+        @param      stats       A 5-tuple.  The grid's statistics (see DataGrid.statistics).
+        '''
+        self.gridStats.append( ( index, ) + tuple( stats ) )
+
+    def statsTable( self ):
+        '''Returns the recorded statistics, ordered by grid index.
+
+        @returns    A numpy array of STATS_TYPE with one entry per recorded grid.
+        '''
+        rows = sorted( self.gridStats )
+        table = np.zeros( len( rows ), dtype=STATS_TYPE )
+        for i, name in enumerate( STATS_TYPE.names ):
+            table[ name ] = [ r[ i + 1 ] for r in rows ]
+        return table
+
     def setMax( self, val ):
         if ( val > self.maxVal ):
             self.maxVal = val
@@ -56,14 +96,148 @@ class RasterReport:
         if ( val < self.minVal ):
             self.minVal = val
 
+class GridWriter( FrameConsumer ):
+    """Writes a grid file sequence as part of a shared pass over pedestrian data (see
+    FramePass.consumeFrames).  Each frame is mapped to a grid by the grid function:
+    gridFunc( frame, index, frameSet ) returns an instance of DataGrid, or None if the
+    frame doesn't produce a grid."""
+    def __init__( self, gfs, fileExt, gridDomain, gridFunc, minVal=None, writeEmpty=True ):
+        '''Constructor.
+
+        @param      gfs             An instance of GridFileSequence.  The sequence which
+                                    determines the output file name and format.
+        @param      fileExt         A string.  The extension applied to the GFS file.
+        @param      gridDomain      An instance of AbstractGrid, specifying the grid domain
+                                    and resolution of the grids.
+        @param      gridFunc        A callable object.  Computes the grid for a frame.
+        @param      minVal          A float.  If provided, the minimum value written in the
+                                    header, otherwise, the minimum value of the grids.
+        @param      writeEmpty      A boolean.  If False, the file is only created once the
+                                    first grid is computed; no grids means no file.
+        '''
+        self.gfs = gfs
+        self.fileName = '%s.%s' % ( gfs.outFileName, fileExt )
+        self.gridDomain = gridDomain
+        self.gridFunc = gridFunc
+        self.minVal = minVal
+        self.writeEmpty = writeEmpty
+        self.outFile = None
+        self.log = None
+
+    def start( self, frameSet ):
+        self.outFile = None
+        self.log = RasterReport()
+
+    def openFile( self ):
+        '''Creates the output file and writes its header.'''
+        d = self.gridDomain
+        self.outFile = self.gfs.openGrids( self.fileName, d.minCorner, d.size, d.resolution )
+
+    def consume( self, frame, index, frameSet ):
+        g = self.gridFunc( frame, index, frameSet )
+        if ( g is None ):
+            return
+        if ( self.outFile is None ):
+            self.openFile()
+        self.log.setMax( g.maxVal() )
+        self.log.setMin( g.minVal() )
+        self.log.recordGrid( self.log.count, g.statistics() )
+        self.log.incCount()
+        self.outFile.write( g.binaryString() )
+
+    def finish( self ):
+        if ( self.outFile is None ):
+            if ( not self.writeEmpty ):
+                return
+            self.openFile()
+        minVal = self.minVal
+        if ( minVal is None ):
+            minVal = self.log.minVal
+        self.gfs.fillInHeader( self.outFile, self.log.count, minVal, self.log.maxVal )
+        self.outFile.close()
+        self.gfs.writeStats( self.fileName, self.log.statsTable() )
+
+class ConvolveFrames:
+    """A grid function (see GridWriter) which convolves each frame of pedestrian data
+    with a kernel."""
+    def __init__( self, gridDomain, kernel, signal ):
+        '''Constructor.
+
+        @param      gridDomain      An instance of AbstractGrid defining the extents and resolution
+                                    of the convolution domain.
+        @param      kernel          An instance of a BaseKernel (see Kernels.py).
+        @param      signal          An instance of PedestrianSignal.  Its data is set from
+                                    each frame.
+        '''
+        self.gridDomain = gridDomain
+        self.kernel = kernel
+        self.signal = signal.copyEmpty()
+
+    def __call__( self, frame, index, frameSet ):
+        self.signal.setFrame( frame, index )
+        needInit, iValue = self.kernel.needsInitOutput( self.signal )
+        g = self.gridDomain.getDataGrid( initVal=iValue, leaveEmpty=not needInit )
+        self.kernel.convolve( self.signal, g )
+        return g
+
+class SpeedFrames:
+    """A grid function (see GridWriter) which rasterizes the agent speeds between each frame
+    and the frame timeWindow frames before it.  The first timeWindow frames produce no grid."""
+    def __init__( self, speedFunc, kernel, gridFunc, distFunc, maxRad, timeStep, timeWindow, excludeStates, stats, maxSpeed ):
+        '''Constructor.  The arguments are those of GridFileSequence.computeSpeeds and the
+        RasterGrid speed functions.
+
+        @param      speedFunc       The RasterGrid function which rasterizes the speeds.
+        @param      gridFunc        A callable object.  Creates an empty RasterGrid.
+        @param      stats           An instance of StatRecord.  The per-frame speed statistics.
+        '''
+        self.speedFunc = speedFunc
+        self.kernel = kernel
+        self.gridFunc = gridFunc
+        self.distFunc = distFunc
+        self.maxRad = maxRad
+        self.timeStep = timeStep
+        self.timeWindow = timeWindow
+        self.excludeStates = excludeStates
+        self.stats = stats
+        self.maxSpeed = maxSpeed
+        self.window = []
+        self.gridCount = 0
+
+    def __call__( self, frame, index, frameSet ):
+        self.window.append( frame.copy() )
+        if ( len( self.window ) <= self.timeWindow ):
+            return None
+        if ( self.gridCount > 0 ):
+            self.stats.nextFrame()
+        f1 = self.window.pop( 0 )
+        f2 = self.window[ -1 ]
+        g = self.gridFunc()
+        self.speedFunc( g, self.kernel, f2, f1, self.distFunc, self.maxRad, self.timeStep * self.timeWindow, self.excludeStates, self.stats, self.maxSpeed )
+        self.gridCount += 1
+        return g
+
 # A mapping of numpy array type to an int iterator for storing in the file
 NP_TYPES = ( np.float32, np.float64, np.int8, np.int16, np.int32, np.int64 )
 TYPE_ID_MAP = dict( map( lambda x: ( x[1], x[0] ), enumerate( NP_TYPES ) ) )
 
 
 class GridFileSequenceReader:
-    '''A simple class for reading and iterating through a GridFileSequence'''
-    def __init__( self, fileName, startGrid=0, maxGrids=-1, gridStep=1 ):
+    '''A simple class for reading and iterating through a GridFileSequence.
+
+    The grids are memory mapped; the grids it returns are views into the file (copy on write,
+    so changes to them never reach the file).  Any grid can be accessed directly (see getGrid)
+    and a range of grids can be accessed as a single 3-D array (see gridRange).  For sequential
+    consumers, the next grids can be paged in on a background thread (see prefetch).
+
+    The statistics of each grid (see getStats) are read from the statistics file written with
+    the sequence, so questions like "which grid has the peak value" (see peakGrid) or "what is
+    the range of these grids" (see dataRange) don't touch the grids.
+
+    Compressed grid file sequences (see GFSCompression) are read transparently.  Their grids
+    are decompressed on demand (and are read-only).
+    '''
+    def __init__( self, fileName, startGrid=0, maxGrids=-1, gridStep=1, prefetch=0 ):
         '''Initializes the reader to a particular file.
 
         @param      fileName        A string.  The path to a grid file sequence file.
@@ -74,21 +248,55 @@ class GridFileSequenceReader:
                                     non-negative, it iterates through min( maxGrids, count).
         @param      gridStep        An int.  The stride between accessible grids.
                                     The default is 1 (every grid.)
+        @param      prefetch        An int.  The number of grids following the current grid
+                                    which are paged in by a background thread.  If zero, no
+                                    thread is used.
         @raises     IOError if the file doesn't exist.
         '''
+        self.fileName = fileName
+        # the per-grid statistics of every grid in the file (see getStats)
+        self.stats = None
         self.file = open( fileName, 'rb' )
+        self.compressed = self.file.read( len( GFSCompression.MAGIC ) ) == GFSCompression.MAGIC
+        if ( self.compressed ):
+            self.version = struct.unpack( 'i', self.file.read( 4 ) )[0]
+        else:
+            self.file.seek( 0 )
         # read the header
         self.readHeader()
-        self.currGridID = 0
-        self.startGrid = startGrid
-        if ( maxGrids == -1 ):
-            self.maxGrids = self.count
+        if ( self.compressed ):
+            self.data = CompressedGrids( self.file, self.arrayType, self.count, ( self.w, self.h ),
+                                         max( GFSCompression.CACHE_BLOCKS, prefetch + 2 ) )
+            self.count = len( self.data )
         else:
-            self.maxGrids = min( self.count, self.maxGrids )
+            self.file.close()
+            # the header's count is only filled in once the sequence is complete
+            stored = ( os.path.getsize( fileName ) - self.headerSize ) // max( 1, self.gridSize() )
+            self.count = min( self.count, stored )
+            if ( self.count > 0 ):
+                self.data = np.memmap( fileName, dtype=self.arrayType, mode='c', offset=self.headerSize,
+                                       shape=( self.count, self.w, self.h ) )
+            else:
+                self.data = np.zeros( ( 0, self.w, self.h ), dtype=self.arrayType )
         assert( gridStep > 0 )
-        self.gridStride = self.gridSize() * ( gridStep - 1 )
+        self.startGrid = startGrid
+        self.gridStep = gridStep
+        self.maxGrids = len( xrange( startGrid, self.count, gridStep ) )
+        if ( maxGrids >= 0 ):
+            self.maxGrids = min( self.maxGrids, maxGrids )
         self.currGrid = DataGrid( self.corner, self.size, ( self.w, self.h ), arrayType=self.arrayType, leaveEmpty=True )
-        self.activeThreadCount = 0
+        self.currGridID = -1
+
+        self.prefetchCount = prefetch
+        self.prefetchThread = None
+        if ( prefetch > 0 ):
+            # the range of grids [ prefetchNext, prefetchEnd ) the prefetch thread should page in
+            self.prefetchNext = 0
+            self.prefetchEnd = min( prefetch, self.maxGrids )
+            self.prefetchCondition = threading.Condition()
+            self.prefetchThread = threading.Thread( target=self.prefetchGrids )
+            self.prefetchThread.daemon = True
+            self.prefetchThread.start()
 
     def __str__( self ):
         return self.summary()
@@ -123,11 +331,11 @@ class GridFileSequenceReader:
         self.headerSize = 32 + self.arrayType.itemsize * 2
 
     def gridSize( self ):
-        '''Returns the size of a grid in bytes.capitalize
+        '''Returns the size of a grid in bytes.
 
         @returns    The number of bytes in a single frame
         '''
-        return self.w * self.h * 4
+        return self.w * self.h * self.arrayType.itemsize
 
     def gridCount( self ):
         '''Returns the number of grids in the sequence.
@@ -136,6 +344,102 @@ class GridFileSequenceReader:
                     to be iterated across accounting for startGrid, maxGrids and gridStep.'''
         return self.maxGrids
 
+    def fileIndex( self, gridID ):
+        '''Reports the index in the file of a grid.
+
+        @param      gridID      An int.  The index of the grid with respect to the stride and
+                                starting grid.  Should be in the range [0, self.gridCount() ).
+        @returns    An int.  The index of the grid in the file.
+        @raises     IndexError if the grid is not in the sequence.
+        '''
+        if ( gridID < 0 or gridID >= self.maxGrids ):
+            raise IndexError, "Grid %d is not in the range [0, %d)" % ( gridID, self.maxGrids )
+        return self.startGrid + gridID * self.gridStep
+
+    def getGrid( self, gridID ):
+        '''Returns the given grid.  The grid's cells are a view into the file.
+
+        @param      gridID      An int.  The index of the grid with respect to the stride and
+                                starting grid.  Should be in the range [0, self.gridCount() ).
+        @returns    An instance of DataGrid.
+        @raises     IndexError if the grid is not in the sequence.
+        '''
+        grid = DataGrid( self.corner, self.size, ( self.w, self.h ), arrayType=self.arrayType, leaveEmpty=True )
+        grid.cells = self.data[ self.fileIndex( gridID ) ]
+        return grid
+
+    def gridRange( self, start=0, stop=None ):
+        '''Returns a range of grids as a single array.  The array is a view into the file.
+
+        @param      start       An int.  The index of the first grid (with respect to the stride
+                                and starting grid).
+        @param      stop        An int.  The index of the grid after the last grid.  If None,
+                                the range extends to the end of the sequence.
+        @returns    A numpy array with shape ( grids, w, h ).
+        '''
+        start, stop, step = slice( start, stop ).indices( self.maxGrids )
+        first = self.startGrid + start * self.gridStep
+        last = self.startGrid + stop * self.gridStep
+        return self.data[ first:max( first, last ):self.gridStep ]
+
+    def getStats( self ):
+        '''Returns the statistics of the grids in the sequence.  They are read from the
+        statistics file written with the sequence (see GridFileSequence.writeStats).  If there is
+        no such file (or it doesn't cover every grid in the file), they are computed from the grids.
+
+        @returns    A numpy array of STATS_TYPE with gridCount() entries.  The statistics of each
+                    grid with respect to the stride and starting grid.
+        '''
+        if ( self.stats is None and not self.readStats() ):
+            table = np.zeros( self.count, dtype=STATS_TYPE )
+            grid = DataGrid( self.corner, self.size, ( self.w, self.h ), arrayType=self.arrayType, leaveEmpty=True )
+            for i in xrange( self.count ):
+                grid.cells = self.data[ i ]
+                table[ i ] = grid.statistics()
+            self.stats = table
+        last = self.startGrid + self.maxGrids * self.gridStep
+        return self.stats[ self.startGrid:max( self.startGrid, last ):self.gridStep ]
+
+    def readStats( self ):
+        '''Reads the statistics file written with the sequence (see getStats).
+
+        @returns    A boolean.  True if the statistics of every grid in the file were read.
+        '''
+        statsName = self.fileName + STATS_EXT
+        if ( not os.path.exists( statsName ) ):
+            return False
+        table = np.load( statsName )
+        if ( table.dtype != STATS_TYPE or len( table ) < self.count ):
+            return False
+        self.stats = table[ :self.count ]
+        return True
+
+    def dataRange( self ):
+        '''Reports the range of the values in the grids (with respect to the stride and starting
+        grid).  The range comes from the statistics file (see getStats).  Without a statistics
+        file, the range of every grid in the file is taken from the header; the grids are not read.
+
+        @returns    A 2-tuple of floats ( minVal, maxVal ).
+        '''
+        if ( self.stats is None and not self.readStats() ):
+            return ( float( self.range[0] ), float( self.range[1] ) )
+        stats = self.getStats()
+        if ( len( stats ) == 0 ):
+            return ( float( self.range[0] ), float( self.range[1] ) )
+        return ( float( stats[ 'min' ].min() ), float( stats[ 'max' ].max() ) )
+
+    def peakGrid( self, field='max' ):
+        '''Reports the grid with the largest value of a statistic (see getStats).
+
+        @param      field       A string.  The name of the statistic (one of STATS_TYPE.names).
+        @returns    An int.  The index of the grid (with respect to the stride and starting
+                    grid) with the largest value, or -1 if the sequence is empty.
+        '''
+        stats = self.getStats()
+        if ( len( stats ) == 0 ):
+            return -1
+        return int( np.argmax( stats[ field ] ) )
+
     def __iter__( self ):
         '''Returns an iterator to the grids (it is itself).
 
@@ -152,34 +456,74 @@ class GridFileSequenceReader:
         @param      gridID      An int.  The index of the next next grid.  Should be in the range [0, self.count ).
         '''
         assert( gridID >= 0 and gridID <= self.maxGrids )
-        if ( gridID > self.maxGrids ):
-            self.currGridID = self.maxGrids
-        else:
-            self.currGridID = gridID - 1
-            size = self.gridSize()
-            byteAddr = self.headerSize + ( self.startGrid + gridID ) * size + ( gridID * self.gridStride )
-            self.file.seek( byteAddr, 0 )
+        self.currGridID = gridID - 1
+        self.requestPrefetch( gridID )
             
     def next( self ):
         '''Returns the next frame in the sequence.
 
-        @returns        A 2-tuple ( grid, gridID ).  It returns a numpy array consisting of the
-                        grid (with shape ( self.w, self.h )) and the index of that grid.  The
+        @returns        A 2-tuple ( grid, gridID ).  It returns a DataGrid (the same instance
+                        on every call) whose cells are a view of the grid (with shape
+                        ( self.w, self.h )) and the index of that grid.  The
                         index value is with respect to the stride and starting grid.
         @raises         StopIteration when there are no more grids.
         '''
         if ( self.currGridID + 1 >= self.maxGrids ):
             raise StopIteration
-        dataCount = self.w * self.h
-        try:
-            self.currGrid.cells[:, :] = np.reshape( np.fromstring( self.file.read( self.gridSize() ), self.arrayType, dataCount), ( self.w, self.h ) )
-        except ValueError:
-            raise StopIteration
         self.currGridID += 1
-        if ( self.gridStride ):
-            self.file.seek( self.gridStride, 1 )    # 1 = seek offset from current position
+        self.currGrid.cells = self.data[ self.fileIndex( self.currGridID ) ]
+        self.requestPrefetch( self.currGridID + 1 )
         return self.currGrid, self.currGridID
 
+    def requestPrefetch( self, gridID ):
+        '''Informs the prefetch thread of the next grid which will be read.
+
+        @param      gridID      An int.  The index of the next grid to be read.
+        '''
+        if ( self.prefetchThread is None ):
+            return
+        self.prefetchCondition.acquire()
+        try:
+            self.prefetchNext = max( self.prefetchNext, gridID )
+            if ( self.prefetchNext > gridID + self.prefetchCount ):
+                # the reader moved backwards
+                self.prefetchNext = gridID
+            self.prefetchEnd = min( gridID + self.prefetchCount, self.maxGrids )
+            self.prefetchCondition.notify()
+        finally:
+            self.prefetchCondition.release()
+
+    def prefetchGrids( self ):
+        '''The body of the prefetch thread.  Pages in the grids requested by requestPrefetch by
+        touching a single value in each page.'''
+        pageStride = max( 1, mmap.PAGESIZE // self.arrayType.itemsize )
+        while ( True ):
+            self.prefetchCondition.acquire()
+            try:
+                while ( self.prefetchThread is not None and self.prefetchNext >= self.prefetchEnd ):
+                    self.prefetchCondition.wait()
+                if ( self.prefetchThread is None ):
+                    return
+                gridID = self.prefetchNext
+                self.prefetchNext += 1
+            finally:
+                self.prefetchCondition.release()
+            self.data[ self.fileIndex( gridID ) ].reshape( -1 )[ ::pageStride ].sum()
+
+    def close( self ):
+        '''Stops the prefetch thread and releases the file.'''
+        if ( self.prefetchThread is not None ):
+            thread = self.prefetchThread
+            self.prefetchCondition.acquire()
+            self.prefetchThread = None
+            self.prefetchCondition.notify()
+            self.prefetchCondition.release()
+            thread.join()
+        self.currGrid.cells = None
+        if ( self.compressed ):
+            self.data.close()
+        self.data = None
+
     @property
     def domain( self ):
         '''Returns the domain of the GridFileSequence data.
@@ -199,19 +543,28 @@ class GridFileSequence:
     NORM_CONTRIB_SPEED = 4 # distribute speed with normalized gaussian and then divide by contribution matrix
     LAPLACE_SPEED = 5   # compute the magnitude of the laplacian of the velocity field
     
-    def __init__( self, outFileName, obstacles=None, arrayType=np.float32 ):
+    def __init__( self, outFileName, obstacles=None, arrayType=np.float32, workerCount=1, compression=None ):
         """Constructs a GridFileSequence which caches to the indicated file name.
 
         @param  outFileName     The name of the file to which the gridFileSequence writes.
         @param  obstacles       An optional obstacleHandler object.  Used for obstacle-dependent
                                 computations.
         @param  arrayType       A numpy datatype.  Defaults to np.float32.
+        @param  workerCount     An int.  The number of worker processes used to compute the
+                                grids.  If greater than one (and the pedestrian data supports it)
+                                the work is done in separate processes, otherwise it is done with
+                                THREAD_COUNT threads.
+        @param  compression     An instance of GFSCompression.GridCompression.  If given, the
+                                grids are written in the compressed format, otherwise, they are
+                                written raw.
         """
         self.outFileName = outFileName
+        self.workerCount = workerCount
         # TODO: This currently doesn't have any effect.  Eventually, it can be used for object-aware convolution
         #   or other operations.
         self.obstacles = obstacles
         self.arrayType = np.dtype( arrayType )
+        self.compression = compression
         self.headerSize = 40    # this assumes that the arrayType is np.float32
 
     def header( self, corner, size, resolution ):
@@ -235,6 +588,24 @@ class GridFileSequence:
         self.headerSize = len( s )
         return s
 
+    def openGrids( self, fileName, corner, size, resolution ):
+        '''Opens a grid file sequence for writing and writes its header.  The grids are written
+        to the returned file as binary strings and the header is completed with fillInHeader.
+
+        @param      fileName    A string.  The path to the file.
+        @param      corner      A Vector2 instance.  The left-bottom corner of the grid's domain.
+        @param      size        A Vector2 instance.  The width and height of the grid's domain.
+        @param      resolution  A 2-tuple of ints.  Indicates the (width, height) of the grid.
+        @returns    A file object (or an instance of GFSCompression.CompressedGridWriter if the
+                    sequence is compressed).
+        '''
+        header = self.header( corner, size, resolution )
+        if ( self.compression is not None ):
+            return CompressedGridWriter( fileName, header, self.arrayType, resolution, self.compression )
+        outFile = open( fileName, 'wb' )
+        outFile.write( header )
+        return outFile
+
     def fillInHeader( self, file, gridCount, minVal, maxVal ):
         '''Writes the final grid count, minimum and maximum values to the file's header section.
 
@@ -242,11 +613,14 @@ class GridFileSequence:
         fully created and written to the file.  Now, the post hoc derived values must be set into
         the header.
 
-        @param      file        An open file object.
+        @param      file        An open file object (see openGrids).
         @param      gridCount   An int.  The number of grids in the file.
         @param      minVal      A value of type self.arrayType. The minimum value across all grids.
         @param      maxVal      A value of type self.arrayType. The maximum value across all grids.
         '''
+        if ( isinstance( file, CompressedGridWriter ) ):
+            file.fillInHeader( gridCount, minVal, maxVal )
+            return
         file.seek( 28 )
         file.write( struct.pack( 'i', gridCount ) )
         file.write( struct.pack( 2 * self.arrayType.char, minVal, maxVal ) )
@@ -276,8 +650,7 @@ class GridFileSequence:
         assert( reader1.size == reader2.size )
 
         fileName = self.outFileName + '.error'
-        outFile = open( fileName, 'wb' )
-        outFile.write( self.header( reader1.corner, reader1.size, ( reader1.w, reader1.h ) ) )
+        outFile = self.openGrids( fileName, reader1.corner, reader1.size, ( reader1.w, reader1.h ) )
         reader1.setNext( 0 )
         reader2.setNext( 0 )
 
@@ -324,10 +697,25 @@ class GridFileSequence:
         print "\t", frameSet
         
         frameSet.setNext( 0 )
+        if ( self.useProcesses( frameSet ) ):
+            funcArgs = ( signal.copyEmpty(), gridDomain, kernel )
+            return self._processWork( 'density', rasterConvolve, funcArgs, frameSet, gridDomain, overwrite )
         argsFunc = lambda: ( signal.copyEmpty(), frameSet, gridDomain, kernel )
         return self._threadWork( 'density', threadConvolve, argsFunc, gridDomain, overwrite )
 
-    def computeVoronoiDensity( self, gridDomain, frameSet, obstacles=None, limit=-1 ):
+    def convolveConsumer( self, gridDomain, kernel, signal ):
+        '''Creates the consumer which computes the result of convolveSignal as part of a
+        shared pass over the pedestrian data (see FramePass.consumeFrames).
+
+        @param      gridDomain      An instance of AbstractGrid, specifying the grid domain
+                                    and resolution over which the density field is calculated.
+        @param      kernel          The kernel to be used to create the scalar field.
+        @param      signal          An instance of PedestrianSignal.  It includes the signal domain.
+        @returns    An instance of GridWriter.  Its fileName is the name of the output file.
+        '''
+        return GridWriter( self, 'density', gridDomain, ConvolveFrames( gridDomain, kernel, signal ) )
+
+    def computeVoronoiDensity( self, gridDomain, frameSet, obstacles=None, limit=-1, incremental=False ):
         '''Computes a density field for the frameset based on the voronoi diagram.
         The density of each voronoi region is the inverse of the area of that region.
 
@@ -339,13 +727,23 @@ class GridFileSequence:
                                     based on obstacles.
         @param      limit           A float.  The maximum distance a point can be and still lie
                                     in a voronoi region.
+        @param      incremental     A boolean.  If True, each worker derives the voronoi diagram
+                                    of a frame from the diagram of the previous frame it computed
+                                    (see Voronoi.IncrementalVoronoi).  Faster for long sequences
+                                    at fine resolutions, but the regions can be off by as much
+                                    as Voronoi.INCREMENTAL_TOLERANCE cells.
         @returns    A string.  The name of the output file.
         '''
         print "computeVoronoiDensity"
         print "\t", gridDomain
         print "\t", frameSet
         frameSet.setNext( 0 )
-        argsFunc = lambda: ( frameSet, gridDomain, obstacles, limit )
+        # each worker gets its own incremental state
+        makeState = lambda: IncrementalVoronoi() if incremental else None
+        if ( self.useProcesses( frameSet ) ):
+            funcArgs = ( gridDomain, obstacles, limit, makeState() )
+            return self._processWork( 'voronoiDensity', rasterVoronoiDensity, funcArgs, frameSet, gridDomain )
+        argsFunc = lambda: ( frameSet, gridDomain, obstacles, limit, makeState() )
         return self._threadWork( 'voronoiDensity', threadVoronoiDensity, argsFunc, gridDomain )
         
 
@@ -367,20 +765,70 @@ class GridFileSequence:
         print "\t", gridDomain
         print "\t", frameSet
         frameSet.setNext( 0 )
+        if ( self.useProcesses( frameSet ) ):
+            funcArgs = ( gridDomain, obstacles, limit )
+            return self._processWork( 'voronoi', rasterVoronoi, funcArgs, frameSet, gridDomain )
         argsFunc = lambda: ( frameSet, gridDomain, obstacles, limit )
         return self._threadWork( 'voronoi', threadVoronoi, argsFunc, gridDomain )
         
 
+    def useProcesses( self, frameSet ):
+        '''Reports if the grids for the given pedestrian data will be computed by worker processes.
+
+        @param      frameSet        An instance of a pedestrian data sequence.
+        @returns    A boolean.  True if the work is done with processes, False for threads.
+        '''
+        return self.workerCount > 1 and canProcess( frameSet )
+
+    def _processWork( self, fileExt, function, funcArgs, frameSet, gridDomain, overwrite=True ):
+        '''Sets up work in multiple processes.  See ProcessRasterization.processWork.
+
+        @param      fileExt         A string.  The extension applied to the GFS file.
+        @param      function        A function object.  The function which computes a single
+                                    grid (see ProcessRasterization.rasterConvolve).
+        @param      funcArgs        A tuple.  The additional arguments for the work function.
+                                    Each worker process gets its own copy.
+        @param      frameSet        An instance of a pedestrian data sequence.  It must satisfy
+                                    ProcessRasterization.canProcess.
+        @param      gridDomain      An instance of AbstractGrid, specifying the grid domain
+                                    and resolution over which the density field is calculated.
+        @param      overwrite       A boolean.  Indicates whether files should be created even if they
+                                    already exist or computed from scratch.  If True, they are always created,
+                                    if False, pre-existing files are used.
+        @returns    A string.  The name of the output file.
+        '''
+        fileName = '%s.%s' % ( self.outFileName, fileExt )
+        if ( not overwrite ):
+            if ( os.path.exists( fileName ) ):
+                return fileName
+        outFile = self.openGrids( fileName, gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
+        log = RasterReport()
+        processWork( outFile, function, funcArgs, frameSet, gridDomain, self.workerCount, log )
+        self.fillInHeader( outFile, log.count, log.minVal, log.maxVal )
+        outFile.close()
+        self.writeStats( fileName, log.statsTable() )
+        return fileName
+
+    def writeStats( self, fileName, table ):
+        '''Writes the per-grid statistics of a grid file sequence to its statistics file (the
+        sequence's file name with STATS_EXT appended).
+
+        @param      fileName        A string.  The name of the grid file sequence.
+        @param      table           A numpy array of STATS_TYPE.  One entry per grid.
+        '''
+        f = open( fileName + STATS_EXT, 'wb' )
+        np.save( f, table )
+        f.close()
+
     def _threadWork( self, fileExt, function, funcArgs, gridDomain, overwrite=True ):
         '''Sets up threaded work.
 
         @param      fileExt         A string.  The extension applied to the GFS file.
         @param      function        A function object.  The function executed by each thread.
-                                    For the function to work its first four args must be:
+                                    For the function to work its first three args must be:
                                        1. a RasterReport instance
-                                       2. a threading lock for the buffer
-                                       3. A buffer instance ( simply a python list)
-                                       4. A threading lock for the data
+                                       2. A GridBuffer instance (see ThreadRasterization.py)
+                                       3. A threading lock for the data
         @param      funcArgs        A callable object.  Its return value is a tuple of values.
                                     These values are the additional arguments for the work function.
                                     They will be concatenated to the arguments liated above.
@@ -392,18 +840,17 @@ class GridFileSequence:
                                     already exist or computed from scratch.  If True, they are always created,
                                     if False, pre-existing files are used.
         @returns    A string.  The name of the output file.
+        @raises     RuntimeError if a thread fails or not every grid is written.
         '''
         # file output
         fileName = '%s.%s' % ( self.outFileName, fileExt )
         if ( not overwrite ):
             if ( os.path.exists( fileName ) ):
                 return fileName
-        outFile = open( fileName, 'wb' )
-        outFile.write( self.header( gridDomain.minCorner, gridDomain.size, gridDomain.resolution ) )
-        buffer = []
-        bufferLock = threading.Lock()
-        saveThread = threading.Thread( target=threadOutput, args=(outFile, buffer, bufferLock, time.clock(), self ) )
-        self.activeThreadCount = THREAD_COUNT
+        outFile = self.openGrids( fileName, gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
+        buffer = GridBuffer( BUFFER_CAPACITY, THREAD_COUNT )
+        outputLog = RasterReport()
+        saveThread = threading.Thread( target=threadOutput, args=(outFile, buffer, time.clock(), outputLog ) )
         saveThread.start()
 
         # prepare rasterization        
@@ -413,15 +860,18 @@ class GridFileSequence:
         for i in range( THREAD_COUNT ):
             rasterLogs.append( RasterReport() )
             # This has self.obstacles
-            threadArgs = ( rasterLogs[-1], bufferLock, buffer, frameLock )
-            rasterThreads.append( threading.Thread( target=function, args=threadArgs + funcArgs() )  )
+            threadArgs = ( rasterLogs[-1], buffer, frameLock )
+            rasterThreads.append( threading.Thread( target=runProducer,
+                                                    args=( function, threadArgs + funcArgs(), buffer ) ) )
 
         for i in range( THREAD_COUNT ):
             rasterThreads[i].start()
         for i in range( THREAD_COUNT ):
             rasterThreads[i].join()
-            self.activeThreadCount -= 1
         saveThread.join()
+        if ( buffer.error is not None ):
+            outFile.close()
+            raise RuntimeError, "Rasterization failed:\n%s" % ( buffer.error )
 
         gridCount = 0
         maxVal = 0.0
@@ -432,10 +882,14 @@ class GridFileSequence:
                 maxVal = log.maxVal
             if ( log.minVal < minVal ):
                 minVal = log.minVal
+        if ( outputLog.count != gridCount ):
+            outFile.close()
+            raise RuntimeError, "Rasterization wrote %d of %d grids" % ( outputLog.count, gridCount )
 
         # add the additional information about grid count and maximum values
         self.fillInHeader( outFile, gridCount, minVal, maxVal )
         outFile.close()
+        self.writeStats( fileName, outputLog.statsTable() )
         return fileName
         
     def splatAgents( self, gridDomain, radius, pedData, overwrite=True ):
@@ -453,6 +907,9 @@ class GridFileSequence:
         kernel = Kernels.UniformCircleKernel( radius, gridDomain.cellSize[0], False ) # False on reflect
         signal = Signals.PedestrianSignal( gridDomain.rectDomain )
         pedData.setNext( 0 )
+        if ( self.useProcesses( pedData ) ):
+            funcArgs = ( signal.copyEmpty(), gridDomain, kernel )
+            return self._processWork( 'splat', rasterConvolve, funcArgs, pedData, gridDomain, overwrite )
         argsFunc = lambda: ( signal.copyEmpty(), pedData, gridDomain, kernel )
         return self._threadWork( 'splat', threadConvolve, argsFunc, gridDomain, overwrite )
         
@@ -464,7 +921,7 @@ class GridFileSequence:
         @param      timeStep        The duration of a single frame of data in the pedData.
         @param      pedData         The pedestrian data to splat (the product of a call to trajectory.loadTrajectory).
         @param      excludeStates   The state of agents to occlude.  This only applies if the data has state information.
-        @param      speedType       The exact visualization type.
+        @param      speedType       The exact visualization type.  Only BLIT_SPEED is supported.
         @param      timeWindow      The number of windows overwhich speed is computed - default is one frame, instantaneous speed.
         @param      overwrite       A boolean.  Indicates whether files should be created even if they
                                     already exist or computed from scratch.  If True, they are always created,
@@ -481,92 +938,31 @@ class GridFileSequence:
         print "\ttime step:  ", timeStep
         print "\ttime window:", timeWindow
 
-        fileName = self.outFileName + '.speed'
-        outFile = open( fileName, 'wb' )
-        outFile.write( self.header( gridDomain.minCorner, gridDomain.size, gridDomain.resolution ) )
-        
-        maxVal = -1e6
-        minVal = 1e6
-        gridCount = 0
-        gridSize = gridDomain.resolution[0] * gridDomain.resolution[1]
-        cellSize = gridDomain.cellSize
-        pedData.setNext( 0 )
-        data = []
-        try:
-            data = [ pedData.next()[0].copy() for i in range( timeWindow + 1 ) ]
-        except StopIteration:
+        writer = self.speedConsumer( gridDomain, pedData, timeStep, excludeStates, speedType, timeWindow, maxSpeed )
+        consumeFrames( pedData, [ writer ] )
+        if ( writer.gridFunc.gridCount == 0 ):
             print "Unable to compute speed!  Insufficient frames of data for the given window!"
             return
-        # continue while the index of the last frame on the queue is greater than the index of the first frame
-        # TODO: THIS IS INCREDIBLY BROKEN!!!!  MOST OF THESE CODE PATHS DON'T WORK!
+        return writer.gridFunc.stats, writer.fileName
 
-        distFunc = lambda x, y: np.exp( -( (x * x + y *y) / ( maxRad * maxRad ) ) )
-        print "Speedy type:", speedType
-        if ( speedType == GridFileSequence.BLIT_SPEED ):
-            speedFunc = RasterGrid.rasterizeSpeedBlit
-            kernel = None
-            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution, -1.0 )
-        elif ( speedType == GridFileSequence.NORM_SPEED ):
-            speedFunc = RasterGrid.rasterizeSpeedGauss
-            kernel = Kernel( maxRad, distFunc, cellSize )
-            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
-        elif ( speedType == GridFileSequence.UNNORM_SPEED ):
-            speedFunc = RasterGrid.rasterizeSpeedGauss
-            kernel = Kernel( maxRad, distFunc, cellSize )
-            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
-        elif ( speedType == GridFileSequence.NORM_DENSE_SPEED ):
-##            try:
-##                denseFile = open( self.outFileName + ".density", "rb" )
-##            except:
-##                print "Can't open desnity file: %.density" % ( self.outFileName )
-##                raise
-##            else:
-##                w, h, count, minVal, maxVal = struct.unpack( 'iiiff', denseFile.read( self.headerSize ) )
-##                assert( w == resolution[0] and h == resolution[1] )
-##            speedFunc = lambda g, k, f2, f1, dist, rad, step: RasterGrid.rasterizeDenseSpeed( g, denseFile, k, f2, f1, dist, rad, step )
-##            kernel = Kernel( maxRad, distFunc, cellSize )
-##            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
-            raise ValueError, "This currently unsupported."
-        elif ( speedType == GridFileSequence.NORM_CONTRIB_SPEED ):
-            speedFunc = RasterGrid.rasterizeContribSpeed
-            kernel = Kernel( maxRad, distFunc, cellSize )
-            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
-        elif ( speedType == GridFileSequence.LAPLACE_SPEED ):
-            distFunc = lambda x, y: 1.0 / ( np.pi * maxRad * maxRad ) * ((x * x + y * y - maxRad * maxRad) / (0.25 * maxRad ** 4 ) ) * np.exp( -( (x * x + y *y) / ( maxRad * maxRad ) ) )
-            gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution )
-            X = np.zeros( resolution, dtype=np.float32 )
-            Y = np.zeros( resolution, dtype=np.float32 )
-            speedFunc = lambda g, k, f2, f1, dist, rad, step: RasterGrid.rasterizeVelocity( g, X, Y, k, f2, f1, dist, rad, step )
-            kernel = Kernel( maxRad, distFunc, cellSize )
-
-        maxRad = None
-        # TODO: This will probably break for some other speed vis method
-        stats = StatRecord( pedData.agentCount() )              
-        while ( True ):
-            f1 = data.pop(0)
-            f2 = data[ -1 ]
-            g = gridFunc() 
-            speedFunc( g, kernel, f2, f1, distFunc, maxRad, timeStep * timeWindow, excludeStates, stats, maxSpeed )
-            M = g.maxVal()
-            if ( M > maxVal ):
-                maxVal = M
-            m = g.minVal()
-            if ( m < minVal ):
-                minVal = m
-            outFile.write( g.binaryString() )
-            gridCount += 1
-            try:
-                data.append( pedData.next()[0].copy() )
-            except StopIteration:
-                break
-            stats.nextFrame()
+    def speedConsumer( self, gridDomain, pedData, timeStep, excludeStates=(), speedType=BLIT_SPEED, timeWindow=1, maxSpeed=3.0 ):
+        '''Creates the consumer which computes the result of computeSpeeds as part of a
+        shared pass over the pedestrian data (see FramePass.consumeFrames).  The arguments are
+        those of computeSpeeds.
 
-        if ( speedType != GridFileSequence.LAPLACE_SPEED ):
-            minVal = 0
-        # add the additional information about grid count and maximum values            
-        self.fillInHeader( outFile, gridCount, minVal, maxVal )
-        outFile.close()
-        return stats, fileName
+        @returns    An instance of GridWriter.  Its fileName is the name of the output file and
+                    its gridFunc (an instance of SpeedFrames) holds the StatRecord of the speeds.
+        @raises     ValueError if the speed type is not BLIT_SPEED.
+        '''
+        if ( speedType != GridFileSequence.BLIT_SPEED ):
+            # the other speed types distribute the speed with a kernel whose radius isn't
+            #   a parameter of this computation
+            raise ValueError, "Unsupported speed type: %s.  Only BLIT_SPEED can be computed." % ( str( speedType ) )
+        gridFunc = lambda: RasterGrid( gridDomain.minCorner, gridDomain.size, gridDomain.resolution, -1.0 )
+        stats = StatRecord( pedData.agentCount() )
+        speeds = SpeedFrames( RasterGrid.rasterizeSpeedBlit, None, gridFunc, None, None, timeStep, timeWindow, excludeStates, stats, maxSpeed )
+        # too few frames for the time window produce no speeds and no file
+        return GridWriter( self, 'speed', gridDomain, speeds, 0, False )
         
     def initProgress( self, frame ):
         '''A helper function for the progress compuation.  Creates an N x 3 array.ArrayType
@@ -591,8 +987,7 @@ class GridFileSequence:
         print "\tmaxRad:     ", maxRad
         print "\ttime step:  ", timeStep
         print "\ttime window:", timeWindow
-        outFile = open( self.outFileName + '.progress', 'wb' )
-        outFile.write( self.header( minCorner, size, resolution ) )
+        outFile = self.openGrids( self.outFileName + '.progress', minCorner, size, resolution )
         maxVal = -1e6
         minVal = 1e6
         gridCount = 0
@@ -638,8 +1033,7 @@ class GridFileSequence:
         print "\tmaxRad:     ", maxRad
         print "\ttime step:  ", timeStep
         print "\ttime window:", timeWindow
-        outFile = open( self.outFileName + '.omega', 'wb' )
-        outFile.write( self.header( minCorner, size, resolution ) )
+        outFile = self.openGrids( self.outFileName + '.omega', minCorner, size, resolution )
         maxVal = -1e6
         minVal = 1e6
         gridCount = 0
@@ -768,25 +1162,24 @@ class GridFileSequence:
         
     def computeRegionSpeed( self, frameSet, polygons, timeStep, excludeStates, timeWindow=1 ):
         '''Given an ordered set of polygons, computes the average speed for all agents in each polygon
-        per time step.'''
+        per time step.  The polygons are rasterized once (see RegionRaster) and the agents of each
+        frame are assigned to them together.
+
+        @param      frameSet        An instance of NPFrameSet.  The pedestrian data.  Its frames
+                                    must be numpy arrays (one row per agent).
+        @param      polygons        An ordered list of closed polygons (e.g., ObjSlice.Polygon).
+        @param      timeStep        A float.  The duration of a single frame of data.
+        @param      excludeStates   The states of agents to ignore.
+        @param      timeWindow      An int.  The number of frames over which speed is computed.
+        '''
         # NOTE: This only really applies to the tawaf.
         print "Computing regional speed:"
         print "\ttime step:       ", timeStep
         print "Number of polygons:", len(polygons)
 
-        frameSet.setNext( 0 )        
-        data = [ frameSet.next() for i in range( timeWindow + 1 ) ]
-
-        regions = None
-        speeds = []
-        while ( data[ -1 ][0] ):
-            f1, i1 = data.pop(0)
-            f2, i2 = data[ -1 ]
-            frameSpeeds, regions = findRegionSpeed( f1, f2, timeStep * timeWindow, polygons, excludeStates, regions )
-            speeds.append( frameSpeeds )
-            data.append( frameSet.next() )
-        data = np.array( speeds )
-        np.savetxt( self.outFileName + ".region", data, fmt='%.5f' )
+        counter = RegionSpeedCounter( RegionRaster( polygons ), timeStep, excludeStates, timeWindow )
+        consumeFrames( frameSet, [ counter ] )
+        np.savetxt( self.outFileName + ".region", counter.regionSpeeds(), fmt='%.5f' )
 
         
 if __name__ == '__main__':
@@ -49,6 +49,28 @@ def BIWEIGHT_FUNC( x, sigma ):
 
 TRIANGLE_FUNC = lambda x, sigma: ( 1 - np.abs( x ) / sigma ) / sigma
 
+def fftLength( n ):
+    '''Returns the smallest integer, greater than or equal to n, whose only prime factors
+    are 2, 3, and 5.  Fourier transforms of these lengths are efficient.
+
+    @param      n       An int.  The minimum length.
+    @returns    An int.  The efficient length.
+    '''
+    best = 1
+    while ( best < n ):
+        best *= 2
+    p5 = 1
+    while ( p5 < best ):
+        p35 = p5
+        while ( p35 < best ):
+            p235 = p35
+            while ( p235 < n ):
+                p235 *= 2
+            best = min( best, p235 )
+            p35 *= 3
+        p5 *= 5
+    return best
+
 class KernelBase( object ):
     '''The base class of a discrete convolution kernel.  It assumes uniform, square discretization of the domain'''
     # This is the class-wide function which defines the kernel.  Each instantiable sub-class must define a function
@@ -59,6 +81,19 @@ class KernelBase( object ):
     # with a cell size of 1 cm, this allows a compact support of 50 m
     #   For pedestrian analysis, this seems a reasonable limit
     MAX_KERNEL_WIDTH = 5000     
+
+    # The methods for convolving a kernel with a dirac signal (see splatImpulses)
+    DIRAC_AUTO = 0          # select the cheapest method based on the cost model
+    DIRAC_SCATTER = 1       # splat the kernel at each occupied cell
+    DIRAC_FFT = 2           # convolve the impulse histogram in the frequency domain
+    DIRAC_SEPARABLE = 3     # convolve the impulse histogram with two 1D passes
+
+    # The approximate costs (in nano-seconds) of the basic operations of the dirac convolution
+    #   methods.  Used by selectDiracMethod.
+    SCATTER_VALUE_COST = 15.0   # scattering a single kernel value
+    SHIFT_VALUE_COST = 3.0      # adding a single weighted value in a 1D pass
+    FFT_VALUE_COST = 5.0        # per F log F for a transform of size F
+    PASS_COST = 10000.0         # the overhead of a single vectorized operation
     
     def __init__( self, smoothParam, cellSize, reflect=True ):
         '''Initializes the kernel with the smoothing parameter and boundary behavior.
@@ -69,8 +104,10 @@ class KernelBase( object ):
         @param  reflect         A boolean.  Determines if the kernel reflects at boundaries.
                                 Only supports simple, convex boundaries.
         '''
+        self.fftCache = None
         self.sampleKernel( smoothParam, cellSize )
         self.reflectBoundaries = reflect
+        self.diracMethod = self.DIRAC_AUTO
 
     def __str__( self ):
         s = '%s: smooth: %f, cellSize: %f' % ( self.__class__.__name__, self._smoothParam, self._cellSize )
@@ -244,10 +281,178 @@ class KernelBase( object ):
         size = grid.size + ( 2 * expandDist )
         domain = domains.RectDomain( minPt, size )
 
+        impulses = signal.getDomainSignal( grid, domain, self.reflectBoundaries )
+        self.splatImpulses( impulses, w, h, self.data, grid )
+
+    def convolveDiracReference( self, signal, grid ):
+        '''The reference implementation of convolveDirac.  It splats the kernel for each
+        impulse, one at a time.  It is slow and only exists to validate the vectorized
+        convolution.
+
+        @param      signal      An instance of DiracSignal.  The kernel will be copied
+                                centered at each position in the signal.
+        @param      grid        The grid onto which the kernel is splatted.  It is assumed
+                                that the grid has been initialized to zero.
+        '''
+        w, h = self.data.shape
+        w /= 2
+        h /= 2
+        expandDist = Vector2( grid.cellSize[0] * w, grid.cellSize[1] * h )
+        minPt = grid.minCorner - expandDist
+        size = grid.size + ( 2 * expandDist )
+        domain = domains.RectDomain( minPt, size )
+
         impulses = signal.getDomainSignal( grid, domain, self.reflectBoundaries )
         for pos in impulses:
             self.splatKernel( pos, w, h, self.data, grid )               
 
+    def splatImpulses( self, impulses, halfW, halfH, kernelData, grid ):
+        '''Used by the dirac convolution.  Splats the kernel at every impulse position.
+
+        The result is the same as calling splatKernel for each impulse.  The impulses are
+        binned into a histogram of the cells they fall into.  The histogram is padded by the
+        kernel's half size so it includes every cell whose kernel reaches the grid.  The
+        histogram is then convolved with the kernel by the method given by self.diracMethod
+        (see selectDiracMethod).
+
+        @param  impulses    An Nx2 numpy array.  The positions of the N impulses.
+        @param  halfW       An int.  The width of the kernel / 2.  It should be true that halfW = kernelData.shape[0] / 2
+        @param  halfH       An int.  The height of the kernel / 2.  It should be true that halfH = kernelData.shape[1] / 2
+        @param  kernelData  A kxk numpy array of the kernel data.
+        @param  grid        An instance of DataGrid.  The kernels are added into its cells.
+        '''
+        if ( len( impulses ) == 0 ):
+            return
+        gW = int( grid.resolution[0] )
+        gH = int( grid.resolution[1] )
+        # the cell of every impulse (see AbstractGrid.getCenter) in histogram coordinates
+        pos = np.asarray( impulses, dtype=np.float64 )
+        cX = np.floor( ( pos[:, 0] - grid.minCorner[0] ) / grid.cellSize[0] ).astype( np.int64 ) + halfW
+        cY = np.floor( ( pos[:, 1] - grid.minCorner[1] ) / grid.cellSize[1] ).astype( np.int64 ) + halfH
+        hW = gW + 2 * halfW
+        hH = gH + 2 * halfH
+        # only the kernels which overlap the grid contribute
+        inside = ( cX >= 0 ) & ( cX < hW ) & ( cY >= 0 ) & ( cY < hH )
+        if ( not inside.any() ):
+            return
+        hist = np.bincount( cX[ inside ] * hH + cY[ inside ], minlength=hW * hH ).astype( np.float64 )
+        hist.shape = ( hW, hH )
+
+        method = self.diracMethod
+        separable = kernelData is self.data and self.separableFactors() is not None
+        if ( method == self.DIRAC_AUTO ):
+            method = self.selectDiracMethod( np.count_nonzero( hist ), kernelData.shape, ( gW, gH ), separable )
+        if ( method == self.DIRAC_SCATTER ):
+            result = self.scatterHistogram( hist, kernelData, ( gW, gH ) )
+        elif ( method == self.DIRAC_FFT ):
+            result = self.fftHistogram( hist, kernelData, ( gW, gH ) )
+        elif ( method == self.DIRAC_SEPARABLE and separable ):
+            result = self.separableHistogram( hist, self.separableFactors(), ( gW, gH ) )
+        else:
+            raise KernelImplementationError, "Dirac convolution method %s is not available for %s" % ( str( method ), self.__class__.__name__ )
+        grid.cells += result
+
+    def selectDiracMethod( self, cellCount, kernelShape, resolution, separable ):
+        '''Selects the cheapest method of convolving a histogram of impulses with the kernel.
+        The cost of each method is estimated from the number of occupied cells, the kernel
+        size and the grid resolution:
+            DIRAC_SCATTER: proportional to occupied cells x kernel cells.
+            DIRAC_FFT: proportional to F log F, for F, the size of the padded grid.
+            DIRAC_SEPARABLE: proportional to grid cells x kernel width.
+
+        @param      cellCount       An int.  The number of cells in the histogram which
+                                    contain impulses.
+        @param      kernelShape     A 2-tuple of ints.  The size of the kernel.
+        @param      resolution      A 2-tuple of ints.  The resolution of the grid.
+        @param      separable       A boolean.  True if the kernel can be applied as two 1D passes.
+        @returns    An int.  One of DIRAC_SCATTER, DIRAC_FFT or DIRAC_SEPARABLE.
+        '''
+        kW, kH = kernelShape
+        gW, gH = resolution
+        hW = gW + kW - 1
+        hH = gH + kH - 1
+        costs = { self.DIRAC_SCATTER: kW * kH * ( cellCount * self.SCATTER_VALUE_COST + self.PASS_COST ) }
+        fftSize = fftLength( hW ) * fftLength( hH )
+        costs[ self.DIRAC_FFT ] = fftSize * np.log2( fftSize ) * self.FFT_VALUE_COST
+        if ( separable ):
+            costs[ self.DIRAC_SEPARABLE ] = ( ( kW * gW * hH + kH * gW * gH ) * self.SHIFT_VALUE_COST +
+                                              ( kW + kH ) * self.PASS_COST )
+        return min( costs, key=costs.get )
+
+    def separableFactors( self ):
+        '''Reports the 1D factors of the kernel data, if the kernel is separable.
+
+        @returns    A 2-tuple of 1D numpy arrays (x, y) such that self.data is the outer product
+                    of x and y.  None if the kernel isn't separable.
+        '''
+        return None
+
+    def scatterHistogram( self, hist, kernelData, resolution ):
+        '''Convolves the impulse histogram with the kernel by splatting the kernel at every
+        occupied cell.  For each cell of the kernel, its value is scattered to all of the
+        occupied cells at once.  The occupied cells are unique, so a single fancy-indexed
+        addition per kernel cell is correct (there are no repeated indices within it).
+
+        @param      hist            A numpy array.  The padded impulse histogram (see splatImpulses).
+        @param      kernelData      A kxk numpy array of the kernel data.
+        @param      resolution      A 2-tuple of ints.  The resolution of the grid.
+        @returns    A numpy array with the given resolution.  The convolution on the grid.
+        '''
+        kW, kH = kernelData.shape
+        hW, hH = hist.shape
+        fullH = hH + kH - 1
+        full = np.zeros( ( hW + kW - 1 ) * fullH, dtype=np.float64 )
+        occupied = np.flatnonzero( hist )
+        counts = hist.ravel()[ occupied ]
+        corners = ( occupied / hH ) * fullH + occupied % hH
+        for x in xrange( kW ):
+            for y in xrange( kH ):
+                full[ corners + ( x * fullH + y ) ] += kernelData[ x, y ] * counts
+        full.shape = ( hW + kW - 1, fullH )
+        return full[ kW - 1:kW - 1 + resolution[0], kH - 1:kH - 1 + resolution[1] ]
+
+    def separableHistogram( self, hist, factors, resolution ):
+        '''Convolves the impulse histogram with the kernel as two 1D passes.
+
+        @param      hist            A numpy array.  The padded impulse histogram (see splatImpulses).
+        @param      factors         A 2-tuple of 1D numpy arrays.  The x- and y-factors of the
+                                    kernel (see separableFactors).
+        @param      resolution      A 2-tuple of ints.  The resolution of the grid.
+        @returns    A numpy array with the given resolution.  The convolution on the grid.
+        '''
+        kX, kY = factors
+        gW, gH = resolution
+        temp = np.zeros( ( gW, hist.shape[1] ), dtype=np.float64 )
+        for i in xrange( kX.size ):
+            start = kX.size - 1 - i
+            temp += kX[ i ] * hist[ start:start + gW, : ]
+        result = np.zeros( ( gW, gH ), dtype=np.float64 )
+        for j in xrange( kY.size ):
+            start = kY.size - 1 - j
+            result += kY[ j ] * temp[ :, start:start + gH ]
+        return result
+
+    def fftHistogram( self, hist, kernelData, resolution ):
+        '''Convolves the impulse histogram with the kernel in the frequency domain.
+
+        @param      hist            A numpy array.  The padded impulse histogram (see splatImpulses).
+        @param      kernelData      A kxk numpy array of the kernel data.
+        @param      resolution      A 2-tuple of ints.  The resolution of the grid.
+        @returns    A numpy array with the given resolution.  The convolution on the grid.
+        '''
+        kW, kH = kernelData.shape
+        # The transform only needs to be as large as the histogram; the circular
+        #   wrap-around doesn't reach the cells which map to the grid.
+        shape = ( fftLength( hist.shape[0] ), fftLength( hist.shape[1] ) )
+        if ( self.fftCache is None or self.fftCache[0] is not kernelData or self.fftCache[1] != shape ):
+            self.fftCache = ( kernelData, shape, np.fft.rfft2( kernelData, shape ) )
+        full = np.fft.irfft2( np.fft.rfft2( hist, shape ) * self.fftCache[2], shape )
+        result = full[ kW - 1:kW - 1 + resolution[0], kH - 1:kH - 1 + resolution[1] ]
+        if ( kernelData.min() >= 0 ):
+            # remove the round-off noise from cells which should be empty
+            np.maximum( result, 0.0, result )
+        return result
+
     def splatKernel( self, pos, halfW, halfH, kernelData, grid ):
         '''Used by the dirac convolution.  Splats the kernel at the given position.
 
@@ -306,6 +511,15 @@ class SeparableKernel( KernelBase ):
         #TODO: Validate that the func has the correct interface
         KernelBase.__init__( self, smoothParam, cellSize, reflect )
 
+    def separableFactors( self ):
+        '''Reports the 1D factors of the kernel data.
+
+        @returns    A 2-tuple of 1D numpy arrays (x, y) such that self.data is the outer product
+                    of x and y.
+        '''
+        factor = self.data1D / self._cellSize
+        return factor, factor
+
     def convolveField( self, signal, grid ):
         sigData = signal.getDomainSignal( grid, self.data1D.size / 2, self.reflectBoundaries )
         
@@ -442,9 +656,9 @@ class UniformKernel( SeparableKernel ):
         '''
         return 1 / np.sqrt( 3.0 )
         
-    def convolveDirac( self, signal, grid ):
-        '''Convolve the kernel against a dirac signal.  It is "fast" because it approximates
-        the agent's position by the nearest grid cell center.
+    def convolveDiracReference( self, signal, grid ):
+        '''The reference implementation of convolveDirac.  It splats the kernel for each
+        impulse, one at a time.
 
         @param      signal      An instance of DiracSignal.  The kernel will be copied
                                 centered at each position in the signal.
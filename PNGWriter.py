@@ -0,0 +1,80 @@
+# This file contains a PNG encoder built on numpy and zlib.
+#
+# It allows grid images to be written without pygame (and, therefore, without SDL).  The
+#   images are arrays in pygame's surfarray layout: the first index is the column (x) and the
+#   second is the row (y), with row zero at the top of the image.  Each row is encoded with
+#   PNG's "up" filter (the difference from the row above), which is computed for the whole
+#   image at once and compresses smoothly varying grids well.
+
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# The zlib compression levels
+DEFAULT_LEVEL = 6
+FAST_LEVEL = 1
+
+# The PNG color types
+GREY = 0
+RGB = 2
+RGBA = 6
+COLOR_TYPES = { 1:GREY, 3:RGB, 4:RGBA }
+
+# The PNG row filters
+FILTER_NONE = 0
+FILTER_UP = 2
+
+def pngChunk( chunkType, data ):
+    '''Creates a PNG chunk.
+
+    @param      chunkType       A 4-character string.  The type of the chunk.
+    @param      data            A string.  The chunk's data.
+    @returns    A string.  The chunk: its length, type, data and checksum.
+    '''
+    crc = zlib.crc32( chunkType + data ) & 0xFFFFFFFF
+    return struct.pack( '>I', len( data ) ) + chunkType + data + struct.pack( '>I', crc )
+
+def encodePNG( pixels, level=DEFAULT_LEVEL, rowFilter=FILTER_UP ):
+    '''Encodes an image as a PNG.
+
+    @param      pixels          A WxH or WxHxC numpy array of uint8s (with C = 1, 3 or 4 for
+                                grey, RGB and RGBA images, respectively).  The image, in
+                                surfarray layout.
+    @param      level           An int.  The zlib compression level (0-9).
+    @param      rowFilter       An int.  The PNG filter applied to every row (FILTER_NONE or
+                                FILTER_UP).
+    @returns    A string.  The PNG file's contents.
+    @raises     ValueError if the image can't be encoded.
+    '''
+    if ( pixels.ndim == 2 ):
+        pixels = pixels[ :, :, np.newaxis ]
+    if ( pixels.ndim != 3 or not COLOR_TYPES.has_key( pixels.shape[2] ) ):
+        raise ValueError, "Images must be WxH or WxHxC arrays with 1, 3 or 4 channels: %s" % ( str( pixels.shape ) )
+    W, H, C = pixels.shape
+    rows = np.ascontiguousarray( pixels.swapaxes( 0, 1 ), dtype=np.uint8 ).reshape( H, W * C )
+    raw = np.empty( ( H, W * C + 1 ), dtype=np.uint8 )
+    raw[ :, 0 ] = rowFilter
+    raw[ :, 1: ] = rows
+    if ( rowFilter == FILTER_UP ):
+        # the first row's predecessor is zero; the subtraction wraps, as the filter requires
+        np.subtract( rows[ 1: ], rows[ :-1 ], out=raw[ 1:, 1: ] )
+    elif ( rowFilter != FILTER_NONE ):
+        raise ValueError, "Unsupported PNG row filter: %d" % ( rowFilter )
+    header = struct.pack( '>IIBBBBB', W, H, 8, COLOR_TYPES[ C ], 0, 0, 0 )
+    return ( PNG_SIGNATURE + pngChunk( 'IHDR', header ) +
+             pngChunk( 'IDAT', zlib.compress( raw.tostring(), level ) ) +
+             pngChunk( 'IEND', '' ) )
+
+def writePNG( fileName, pixels, level=DEFAULT_LEVEL ):
+    '''Writes an image to a PNG file (see encodePNG).
+
+    @param      fileName        A string.  The name of the file to write.
+    @param      pixels          A numpy array of uint8s.  The image, in surfarray layout.
+    @param      level           An int.  The zlib compression level (0-9).
+    '''
+    f = open( fileName, 'wb' )
+    f.write( encodePNG( pixels, level ) )
+    f.close()
@@ -0,0 +1,228 @@
+# This file contains the functions which perform rasterization in worker processes.
+# It is imported into GridFileSequence file.
+#
+# It is the multi-process counterpart to ThreadRasterization.  The kernels and the voronoi
+#   computations are largely python loops and don't benefit from threads.  Instead, the frames
+#   are partitioned across worker processes.  Each worker opens its own reader on the
+#   trajectory file, computes its grids and copies them into shared memory buffers which it
+#   owns.  The main process writes the grids, in order, to the output file and hands the
+#   buffers back to the workers.  A worker can only compute as far ahead of the writer as it
+#   has free buffers, which bounds the memory used by the whole pipeline.
+
+import heapq
+import multiprocessing
+import Queue
+from multiprocessing.sharedctypes import RawArray
+import traceback
+import time
+
+import numpy as np
+
+from Voronoi import computeVoronoi, computeVoronoiDensity
+from trajectory.scbData import NPFrameSet
+
+# The number of shared grid buffers owned by each worker process.  It is the maximum
+#   number of grids each worker can have waiting for the writer.
+SLOTS_PER_WORKER = 2
+# The largest item size (in bytes) of the grid types which can be written (see NP_TYPES in
+#   GridFileSequence.py).
+MAX_ITEM_SIZE = 8
+
+# Messages passed from the workers to the writer
+GRID_MSG = 0        # ( GRID_MSG, gridIndex, workerID, slot, byteCount, stats ) (see DataGrid.statistics)
+DONE_MSG = 1        # ( DONE_MSG, workerID )
+ERROR_MSG = 2       # ( ERROR_MSG, workerID, traceback string )
+
+# The interval (in seconds) at which the writer checks that the workers are still alive
+POLL_SECONDS = 1.0
+
+def canProcess( frameSet ):
+    '''Reports if the given frame set can be processed by worker processes.  The worker
+    processes must be able to open their own, independent copy of the frame set.
+
+    @param      frameSet        An instance of pedestrian data.
+    @returns    A boolean.  True if the frame set can be re-opened in a worker process.
+    '''
+    return hasattr( frameSet, 'openArgs' )
+
+def waitForMessage( queue, workers, finished, timeout=POLL_SECONDS ):
+    '''Waits for the next message from worker processes.  While waiting, the workers are
+    checked; a worker which exits without reporting that it is done (e.g., it crashed or was
+    killed) is an error.
+
+    @param      queue           A multiprocessing.Queue.  The messages from the workers.
+    @param      workers         A list of multiprocessing.Process instances.  The workers.
+    @param      finished        A set of ints.  The indices of the workers which have reported
+                                that they are done.
+    @param      timeout         A float.  The interval (in seconds) between checks of the workers.
+    @returns    The next message.
+    @raises     RuntimeError if a worker exited without reporting.
+    '''
+    while ( True ):
+        try:
+            return queue.get( True, timeout )
+        except Queue.Empty:
+            pass
+        for w, p in enumerate( workers ):
+            if ( not w in finished and not p.is_alive() ):
+                # a message sent just before the worker exited may still be in transit
+                try:
+                    return queue.get( True, timeout )
+                except Queue.Empty:
+                    raise RuntimeError, "Worker %d exited (exit code %s) without reporting" % ( w, p.exitcode )
+
+# The work functions.  Each computes the grid for a single frame.  The first two arguments
+#   are always the worker's frame set and the index of the frame to process.
+
+def rasterConvolve( frameSet, index, signal, gridDomain, kernel ):
+    '''Convolves a single frame of pedestrian data with the kernel.
+
+    @param      frameSet        The worker's instance of pedestrian data.
+    @param      index           An int.  The index of the frame to process.
+    @param      signal          An instance of the signal.  Its data is set from frameSet.
+    @param      gridDomain      An instance of AbstractGrid defining the extents and resolution
+                                of the convolution domain.
+    @param      kernel          An instance of a BaseKernel (see Kernels.py).
+    @returns    An instance of DataGrid.  The convolution result.
+    '''
+    frameSet.setNext( index )
+    signal.setData( frameSet )
+    needInit, iValue = kernel.needsInitOutput( signal )
+    g = gridDomain.getDataGrid( initVal=iValue, leaveEmpty=not needInit )
+    kernel.convolve( signal, g )
+    return g
+
+def rasterVoronoiDensity( frameSet, index, gridDomain, obstacles=None, limit=-1, incremental=None ):
+    '''Computes the voronoi density for a single frame of pedestrian data.
+
+    @param      frameSet        The worker's instance of pedestrian data.
+    @param      index           An int.  The index of the frame to process.
+    @param      gridDomain      An instance of AbstractGrid defining the extents and resolution
+                                of the domain in which the Voronoi is computed.
+    @param      obstacles       The optional obstacles (see Voronoi.computeVoronoiDensity).
+    @param      limit           A float.  The maximum distance a point can be and still lie
+                                in a voronoi region.
+    @param      incremental     An instance of IncrementalVoronoi.  If given, the diagram is
+                                derived from the diagram of the previous frame this worker
+                                computed.
+    @returns    An instance of DataGrid.  The density.
+    '''
+    frameSet.setNext( index )
+    frame, index = frameSet.next()
+    return computeVoronoiDensity( gridDomain, frame, frameSet.getFrameIds(), obstacles, limit,
+                                  incremental )
+
+def rasterVoronoi( frameSet, index, gridDomain, obstacles=None, limit=10.0 ):
+    '''Computes the voronoi diagram for a single frame of pedestrian data.
+
+    @param      frameSet        The worker's instance of pedestrian data.
+    @param      index           An int.  The index of the frame to process.
+    @param      gridDomain      An instance of AbstractGrid defining the extents and resolution
+                                of the domain in which the Voronoi is computed.
+    @param      obstacles       The optional obstacles (see Voronoi.computeVoronoi).
+    @param      limit           A float.  The maximum distance a point can be and still lie
+                                in a voronoi region.
+    @returns    An instance of DataGrid.  The voronoi diagram.
+    '''
+    frameSet.setNext( index )
+    frame, index = frameSet.next()
+    return computeVoronoi( gridDomain, frame, frameSet.getFrameIds(), obstacles, limit )
+
+def processRaster( workerID, workerCount, frameCount, openArgs, function, funcArgs,
+                   slots, freeSlots, doneQueue ):
+    '''The body of a worker process.  The worker processes the frames:
+    workerID, workerID + workerCount, workerID + 2 * workerCount, ...
+    in increasing order.
+
+    @param      workerID        An int.  The index of this worker.
+    @param      workerCount     An int.  The total number of workers.
+    @param      frameCount      An int.  The total number of frames to process.
+    @param      openArgs        A tuple.  The arguments to open the worker's NPFrameSet.
+    @param      function        The work function (e.g., rasterConvolve).
+    @param      funcArgs        A tuple.  The additional arguments to the work function.
+    @param      slots           A list of RawArrays.  The shared grid buffers of this worker.
+    @param      freeSlots       A multiprocessing.Queue.  The indices of the worker's available
+                                grid buffers.
+    @param      doneQueue       A multiprocessing.Queue.  The messages to the writer.
+    '''
+    try:
+        frameSet = NPFrameSet( *openArgs )
+        for index in xrange( workerID, frameCount, workerCount ):
+            g = function( frameSet, index, *funcArgs )
+            s = freeSlots.get()
+            cells = np.frombuffer( slots[ s ], dtype=g.cells.dtype, count=g.cells.size )
+            cells[:] = g.cells.ravel()
+            doneQueue.put( ( GRID_MSG, index, workerID, s, g.cells.nbytes, g.statistics() ) )
+        frameSet.close()
+    except Exception:
+        doneQueue.put( ( ERROR_MSG, workerID, traceback.format_exc() ) )
+    else:
+        doneQueue.put( ( DONE_MSG, workerID ) )
+
+def processWork( outFile, function, funcArgs, frameSet, gridDomain, workerCount, log ):
+    '''Computes a grid for every frame of the frame set in worker processes and writes them,
+    in order, to the given file.
+
+    @param      outFile         An open file object.  The grids are written at the current
+                                position.
+    @param      function        The work function (e.g., rasterConvolve).
+    @param      funcArgs        A tuple.  The additional arguments to the work function.
+    @param      frameSet        An instance of pedestrian data which satisfies canProcess.
+    @param      gridDomain      An instance of AbstractGrid.  The domain of the computed grids.
+    @param      workerCount     An int.  The number of worker processes.
+    @param      log             An instance of RasterReport (see GridFileSequence.py).  The
+                                statistics of the written grids are accumulated into it.
+    @raises     RuntimeError if a worker process fails.
+    '''
+    startTime = time.clock()
+    frameCount = frameSet.totalFrames()
+    workerCount = max( 1, min( workerCount, frameCount ) )
+    slotSize = gridDomain.resolution[0] * gridDomain.resolution[1] * MAX_ITEM_SIZE
+    doneQueue = multiprocessing.Queue()
+    slots = []
+    freeSlots = []
+    workers = []
+    for w in xrange( workerCount ):
+        slots.append( [ RawArray( 'b', slotSize ) for s in xrange( SLOTS_PER_WORKER ) ] )
+        freeSlots.append( multiprocessing.Queue() )
+        for s in xrange( SLOTS_PER_WORKER ):
+            freeSlots[ w ].put( s )
+        args = ( w, workerCount, frameCount, frameSet.openArgs, function, funcArgs,
+                 slots[ w ], freeSlots[ w ], doneQueue )
+        workers.append( multiprocessing.Process( target=processRaster, args=args ) )
+    for p in workers:
+        p.start()
+
+    # grids which have been computed but not yet written, ordered by grid index
+    pending = []
+    nextGrid = 0
+    activeCount = workerCount
+    finished = set()
+    try:
+        while ( activeCount ):
+            msg = waitForMessage( doneQueue, workers, finished )
+            if ( msg[0] == GRID_MSG ):
+                msgType, index, w, s, byteCount, stats = msg
+                heapq.heappush( pending, ( index, w, s, byteCount ) )
+                log.setMax( stats[1] )
+                log.setMin( stats[0] )
+                log.incCount()
+                log.recordGrid( index, stats )
+            elif ( msg[0] == DONE_MSG ):
+                finished.add( msg[1] )
+                activeCount -= 1
+            else:
+                raise RuntimeError, "Rasterization worker %d failed:\n%s" % ( msg[1], msg[2] )
+            while ( pending and pending[0][0] == nextGrid ):
+                index, w, s, byteCount = heapq.heappop( pending )
+                if ( nextGrid & 0xFF == 0 ):
+                    print "\t\tWriting buffer %d at time %f s" % ( nextGrid, time.clock() - startTime )
+                outFile.write( np.frombuffer( slots[ w ][ s ], np.int8, byteCount ).tostring() )
+                freeSlots[ w ].put( s )
+                nextGrid += 1
+        print "\t\tLast grid %d at time %f s" % ( nextGrid - 1, time.clock() - startTime )
+    finally:
+        for p in workers:
+            if ( p.is_alive() ):
+                p.terminate()
+            p.join()
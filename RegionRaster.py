@@ -0,0 +1,216 @@
+# This file contains an accelerator for assigning agents to polygonal regions.
+#
+# The regions are rasterized, once, onto a grid of integer labels.  A cell lying entirely
+#   inside a region holds the index of that region; a cell lying outside of all regions holds
+#   NO_REGION.  A cell which a region's boundary passes through holds BOUNDARY.  Agents are
+#   assigned to regions by looking up the label of the cell they are in; only the agents in
+#   boundary cells are tested exactly against the polygons.
+
+import numpy as np
+
+from FramePass import FrameConsumer
+
+# The labels of cells which aren't assigned to a single region
+NO_REGION = -1
+BOUNDARY = -2
+
+# The default number of cells along the longest side of the raster
+DEFAULT_RESOLUTION = 256
+
+def pointsInPolygon( points, polygon ):
+    '''Reports which points lie inside the polygon.  This is the test of
+    ObjSlice.Polygon.pointInside (counting the crossings of a ray towards -x), applied to
+    all of the points at once.
+
+    @param      points      An N x 2 numpy array of floats.  The x- and y-values of the points.
+    @param      polygon     A closed polygon.  Its vertices have x- and y-attributes.
+    @returns    A numpy array of N bools.  True if the corresponding point lies inside.
+    '''
+    x = points[ :, 0 ]
+    y = points[ :, 1 ]
+    count = np.zeros( points.shape[0], dtype=np.int )
+    for i in xrange( len( polygon.vertices ) ):
+        v1 = polygon.vertices[ i - 1 ]
+        v2 = polygon.vertices[ i ]
+        dy = v2.y - v1.y
+        if ( dy == 0 ):
+            # a horizontal edge is only reached by a ray along it; it isn't crossed
+            continue
+        test = ~( ( ( v1.x > x ) & ( v2.x > x ) ) |
+                  ( ( v1.y < y ) & ( v2.y < y ) ) |
+                  ( ( v1.y > y ) & ( v2.y > y ) ) )
+        t = ( y[ test ] - v1.y ) / dy
+        dx = t * ( v2.x - v1.x ) + v1.x
+        count[ test ] += dx < x[ test ]
+    return count % 2 == 1
+
+def polygonsContaining( points, polygons ):
+    '''Determines the first polygon containing each point.
+
+    @param      points      An N x 2 numpy array of floats.  The x- and y-values of the points.
+    @param      polygons    An ordered list of closed polygons.
+    @returns    A numpy array of N ints.  The index of the first polygon containing each point,
+                or NO_REGION if no polygon does.
+    '''
+    labels = np.empty( points.shape[0], dtype=np.int )
+    labels[:] = NO_REGION
+    for i, polygon in enumerate( polygons ):
+        untested = np.nonzero( labels == NO_REGION )[0]
+        if ( untested.size == 0 ):
+            break
+        labels[ untested[ pointsInPolygon( points[ untested ], polygon ) ] ] = i
+    return labels
+
+class RegionRaster:
+    '''A grid of region labels for an ordered set of polygons.  Where polygons overlap, a
+    point belongs to the first of them.'''
+    def __init__( self, polygons, resolution=DEFAULT_RESOLUTION ):
+        '''Constructor.
+
+        @param      polygons        An ordered list of closed polygons (e.g., ObjSlice.Polygon)
+                                    whose vertices have x- and y-attributes.
+        @param      resolution      An int.  The number of cells along the longest side of the
+                                    polygons' bounding box.
+        '''
+        self.polygons = polygons
+        vertices = np.array( [ ( v.x, v.y ) for p in polygons for v in p.vertices ], dtype=np.float64 )
+        minCorner = vertices.min( axis=0 )
+        size = vertices.max( axis=0 ) - minCorner
+        cellSize = max( size.max(), 1e-6 ) / resolution
+        # pad the grid by a cell on every side; points outside of it are outside all polygons
+        self.cellSize = cellSize
+        self.minCorner = minCorner - cellSize
+        self.resolution = ( np.ceil( size / cellSize ).astype( np.int ) + 3 )
+        self.labels = self.rasterize()
+
+    @property
+    def regionCount( self ):
+        return len( self.polygons )
+
+    def cellIndices( self, points ):
+        '''Computes the cells containing the points.
+
+        @param      points      An N x 2 numpy array of floats.
+        @returns    A 2-tuple of N ints each: the x- and y-indices of the cells.  Points outside
+                    the grid produce indices outside of the range of the grid.
+        '''
+        idx = np.floor( ( points - self.minCorner ) / self.cellSize )
+        # clamp far away points to just outside the grid
+        idx = np.clip( idx, -1, self.resolution ).astype( np.int )
+        return idx[ :, 0 ], idx[ :, 1 ]
+
+    def rasterize( self ):
+        '''Computes the label of every cell.
+
+        @returns    A W x H numpy array of ints.  The region label of each cell.
+        '''
+        W, H = self.resolution
+        x = self.minCorner[0] + ( np.arange( W ) + 0.5 ) * self.cellSize
+        y = self.minCorner[1] + ( np.arange( H ) + 0.5 ) * self.cellSize
+        centers = np.column_stack( ( np.repeat( x, H ), np.tile( y, W ) ) )
+        # a cell which no boundary passes through lies entirely in the region of its center
+        labels = polygonsContaining( centers, self.polygons ).reshape( W, H )
+
+        # mark the cells along the edges; the edges are sampled at half the cell size so
+        #   every cell an edge passes through neighbors a cell containing a sample
+        boundary = np.zeros( ( W + 2, H + 2 ), dtype=np.bool )
+        for polygon in self.polygons:
+            for i in xrange( len( polygon.vertices ) ):
+                v1 = polygon.vertices[ i - 1 ]
+                v2 = polygon.vertices[ i ]
+                length = np.sqrt( ( v2.x - v1.x ) ** 2 + ( v2.y - v1.y ) ** 2 )
+                t = np.linspace( 0.0, 1.0, int( np.ceil( 2.0 * length / self.cellSize ) ) + 1 )
+                samples = np.column_stack( ( v1.x + t * ( v2.x - v1.x ), v1.y + t * ( v2.y - v1.y ) ) )
+                cX, cY = self.cellIndices( samples )
+                boundary[ cX + 1, cY + 1 ] = True
+        near = np.zeros( ( W, H ), dtype=np.bool )
+        for dx in xrange( 3 ):
+            for dy in xrange( 3 ):
+                near |= boundary[ dx:dx + W, dy:dy + H ]
+        labels[ near ] = BOUNDARY
+        return labels
+
+    def assign( self, points ):
+        '''Determines the region each point lies in.
+
+        @param      points      An N x 2 numpy array of floats.  The x- and y-values of the points.
+        @returns    A numpy array of N ints.  The index of the region (the first polygon)
+                    containing each point, or NO_REGION if no polygon does.
+        '''
+        cX, cY = self.cellIndices( points )
+        W, H = self.resolution
+        inGrid = ( cX >= 0 ) & ( cX < W ) & ( cY >= 0 ) & ( cY < H )
+        labels = np.empty( points.shape[0], dtype=np.int )
+        labels[:] = NO_REGION
+        labels[ inGrid ] = self.labels[ cX[ inGrid ], cY[ inGrid ] ]
+        exact = np.nonzero( labels == BOUNDARY )[0]
+        if ( exact.size ):
+            labels[ exact ] = polygonsContaining( points[ exact ], self.polygons )
+        return labels
+
+class RegionSpeedCounter( FrameConsumer ):
+    '''Computes the average speed of the agents in each region, per frame, as part of a pass
+    over pedestrian data (see FramePass.consumeFrames).  An agent's speed is its displacement
+    over the time window, attributed to the region it is in at the end of the window.'''
+    def __init__( self, raster, timeStep, excludeStates=(), timeWindow=1 ):
+        '''Constructor.
+
+        @param      raster          An instance of RegionRaster.  The regions.
+        @param      timeStep        A float.  The duration of a single frame of data.
+        @param      excludeStates   The states of agents to ignore.  This only applies if the
+                                    data has state information.
+        @param      timeWindow      An int.  The number of frames over which speed is computed.
+        '''
+        self.raster = raster
+        self.timeStep = timeStep
+        self.excludeStates = excludeStates
+        self.timeWindow = timeWindow
+
+    def start( self, frameSet ):
+        self.window = []
+        self.speeds = []
+        self.Y_COL = 1
+        if ( frameSet.is3D ):
+            self.Y_COL = 2
+        self.STATE_COL = None
+        if ( frameSet.hasStateData() and self.excludeStates ):
+            self.STATE_COL = 3
+
+    def consume( self, frame, index, frameSet ):
+        self.window.append( frame.copy() )
+        if ( len( self.window ) <= self.timeWindow ):
+            return
+        f1 = self.window.pop( 0 )
+        f2 = self.window[ -1 ]
+        self.speeds.append( self.frameSpeeds( f1, f2 ) )
+
+    def frameSpeeds( self, f1, f2 ):
+        '''Computes the average speed in each region between two frames.
+
+        @param      f1          A numpy array.  The frame at the start of the window.
+        @param      f2          A numpy array.  The frame at the end of the window.
+        @returns    A numpy array of M floats.  The average speed in each region (zero for
+                    regions without agents).
+        '''
+        p1 = f1[ :, ( 0, self.Y_COL ) ]
+        p2 = f2[ :, ( 0, self.Y_COL ) ]
+        disp = p2 - p1
+        speed = np.sqrt( np.sum( disp * disp, axis=1 ) ) / ( self.timeStep * self.timeWindow )
+        regions = self.raster.assign( p2 )
+        keep = regions >= 0
+        if ( self.STATE_COL is not None ):
+            keep &= ~np.in1d( f2[ :, self.STATE_COL ], self.excludeStates )
+        M = self.raster.regionCount
+        speeds = np.bincount( regions[ keep ], weights=speed[ keep ], minlength=M )
+        counts = np.bincount( regions[ keep ], minlength=M )
+        mask = counts != 0
+        speeds[ mask ] /= counts[ mask ]
+        return speeds.astype( np.float32 )
+
+    def regionSpeeds( self ):
+        '''Returns the speeds computed so far.
+
+        @returns    A K x M numpy array of floats.  The average speed in each of the M regions
+                    for each of the K windows.
+        '''
+        return np.array( self.speeds, dtype=np.float32 ).reshape( -1, self.raster.regionCount )
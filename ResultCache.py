@@ -0,0 +1,130 @@
+# This file contains a cache of analysis results on disk.
+#
+# Each cached result is a set of files stored under a key: a hash of everything the result
+#   depends on (the identity of the input files and the analysis parameters).  A result is
+#   reused by any later analysis with the same key; a change to any of the inputs changes the
+#   key, so stale results are never reused.  The total size of the cache is bounded; when it
+#   is exceeded, the least recently used results are discarded.
+#
+# The key doesn't capture the version of the analysis code.  A result computed by an older
+#   version of a task is reused as is; the cache must be cleared when a task's output changes.
+#   So, caching is off unless it is explicitly requested.
+
+import hashlib
+import os
+import shutil
+
+# The default bound on the size of a cache (in bytes)
+DEFAULT_SIZE = 4 * 1024 ** 3
+# The number of bytes at the start of a file which contribute to its identity
+HEADER_SIZE = 4096
+# The name of the cache's folder in an analysis output folder
+CACHE_FOLDER = '.resultCache'
+
+def fileIdentity( fileName ):
+    '''Summarizes a file such that the summary changes when the file does.
+
+    @param      fileName        A string.  The name of the file.
+    @returns    A 3-tuple ( size, modification time, hash of the file's header ), or None
+                if there is no such file.
+    '''
+    if ( not fileName or not os.path.isfile( fileName ) ):
+        return None
+    stat = os.stat( fileName )
+    f = open( fileName, 'rb' )
+    header = f.read( HEADER_SIZE )
+    f.close()
+    return ( stat.st_size, stat.st_mtime, hashlib.sha1( header ).hexdigest() )
+
+def makeKey( *parts ):
+    '''Creates a cache key from the values a result depends on.
+
+    @param      parts           Values with a stable string representation (numbers, strings,
+                                and tuples and lists of them).
+    @returns    A string.  The key.
+    '''
+    return hashlib.sha1( repr( parts ) ).hexdigest()
+
+class ResultCache:
+    '''A bounded cache of result files in a folder.  Each result is a folder, named by its
+    key, containing copies of the result's files.  The modification time of a result's
+    folder is the time it was last used.'''
+    def __init__( self, folder, maxSize=DEFAULT_SIZE ):
+        '''Constructor.
+
+        @param      folder          A string.  The folder in which the results are stored.
+        @param      maxSize         An int.  The maximum total size (in bytes) of the results.
+        '''
+        self.folder = folder
+        self.maxSize = maxSize
+
+    def entryPath( self, key ):
+        '''Returns the folder in which the result with the given key is stored.'''
+        return os.path.join( self.folder, key )
+
+    def fetch( self, key, fileNames ):
+        '''Copies a cached result to the given files.
+
+        @param      key             A string.  The result's key (see makeKey).
+        @param      fileNames       A list of strings.  The names of the result's files, in the
+                                    order in which they were stored.
+        @returns    A boolean.  True if the result was cached (and the files were written).
+        '''
+        entry = self.entryPath( key )
+        cached = [ os.path.join( entry, '%d' % i ) for i in xrange( len( fileNames ) ) ]
+        for c in cached:
+            if ( not os.path.isfile( c ) ):
+                return False
+        for c, fileName in zip( cached, fileNames ):
+            shutil.copyfile( c, fileName )
+        os.utime( entry, None )
+        return True
+
+    def store( self, key, fileNames ):
+        '''Stores copies of a result's files, replacing any result with the same key.  Least
+        recently used results are discarded to keep the cache within its size.
+
+        @param      key             A string.  The result's key (see makeKey).
+        @param      fileNames       A list of strings.  The names of the result's files.  If any
+                                    of them is missing, nothing is stored.
+        '''
+        for fileName in fileNames:
+            if ( not os.path.isfile( fileName ) ):
+                return
+        entry = self.entryPath( key )
+        # a partially written result is never visible under the key
+        temp = entry + '.tmp'
+        for path in ( temp, entry ):
+            if ( os.path.exists( path ) ):
+                shutil.rmtree( path )
+        os.makedirs( temp )
+        for i, fileName in enumerate( fileNames ):
+            shutil.copyfile( fileName, os.path.join( temp, '%d' % i ) )
+        os.rename( temp, entry )
+        self.evict()
+
+    def entries( self ):
+        '''Reports the cached results, least recently used first.
+
+        @returns    A list of 3-tuples ( last use time, size in bytes, folder ).
+        '''
+        if ( not os.path.isdir( self.folder ) ):
+            return []
+        entries = []
+        for name in os.listdir( self.folder ):
+            entry = os.path.join( self.folder, name )
+            if ( not os.path.isdir( entry ) or name.endswith( '.tmp' ) ):
+                continue
+            size = sum( [ os.path.getsize( os.path.join( entry, f ) ) for f in os.listdir( entry ) ] )
+            entries.append( ( os.path.getmtime( entry ), size, entry ) )
+        entries.sort()
+        return entries
+
+    def evict( self ):
+        '''Discards the least recently used results until the cache is within its size.'''
+        entries = self.entries()
+        total = sum( [ e[1] for e in entries ] )
+        while ( entries and total > self.maxSize ):
+            used, size, entry = entries.pop( 0 )
+            shutil.rmtree( entry )
+            total -= size
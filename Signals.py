@@ -127,26 +127,17 @@ class DiracSignal( Signal ):
         if ( not baseIntersection == convolveDomain ):
             raise SignalDataError, "The entire convolution domain must lie within the signal domain"
         
-        count = 0
+        inside = signalDomain.pointsInside( self._data )
         if ( not doReflection ):
-            point = np.empty_like( self._data )
-            for row in self._data :
-                if ( signalDomain.pointInside( row ) ):
-                    point[ count, : ] = row
-                    count += 1
+            return self._data[ inside ]
         else:
-            point = np.empty( ( self._data.shape[0] * 5, 2 ), dtype=np.float32 )
-            for row in self._data:
-                if ( signalDomain.pointInside( row ) ):   # the point is inside the signalDomain
-                    point[ count, : ] = row
-                    count += 1
-
-                    reflection = self.domain.reflectPoint( row )
-                    for r in reflection:
-                        if ( signalDomain.pointInside( r ) ):
-                            point[ count, : ] = r
-                            count += 1
-        return point[:count, : ]
+            # the reflections of the points which lie inside the signalDomain, in the order:
+            #   original, left, right, bottom, top
+            point = self._data[ inside ]
+            reflection = self.domain.reflectPoints( point )
+            valid = signalDomain.pointsInside( reflection.reshape( -1, 2 ) )
+            return np.concatenate( ( point.astype( np.float32 ),
+                                     reflection.reshape( -1, 2 )[ valid ] ) )
     
     def getDomain( self ):
         '''Reports the domain of the signal.
@@ -232,7 +223,16 @@ class PedestrianSignal( DiracSignal ):
                                 scbData or SeyfriedTrajectoryReader.)
         @raises     StopIteration if the frameSet is out of frames.
         '''
-        frameData, self.index = data.next()
+        frameData, index = data.next()
+        self.setFrame( frameData, index )
+
+    def setFrame( self, frameData, index ):
+        '''Sets the signal's data from a single frame of pedestrian data.
+
+        @param      frameData   A numpy array.  The frame's data, one row per agent.
+        @param      index       An int.  The index of the frame.
+        '''
+        self.index = index
         DiracSignal.setData( self, frameData[:, :2] )
         
 class FieldSignal( Signal ):
@@ -4,21 +4,144 @@
 from Grid import *
 from Voronoi import *
 import drawVoronoi
+import heapq
 import threading
+import time
+import traceback
 
 V_RAD = 1.0 # radius to compute constraint Voronoi
 
-class BufferGrid:
-    """Entry into a buffer for a grid"""
-    def __init__( self, id, grid ):
-        self.id = id
-        self.grid = grid
+class GridBuffer:
+    """A bounded buffer of finished grids, shared by the rasterization threads and the
+    output thread.  The grids are released to the output thread in grid-index order.
 
-    def __eq__( self, id ):
-        return self.id == id
+    Rasterization threads block when the buffer is full (unless they hold the very grid the
+    output thread is waiting for), so the memory used by finished grids is bounded.  The
+    output thread is woken as soon as the next grid arrives.
 
-    def __str__( self ):
-        return "BufferGrid %d, %f" % ( self.id, self.grid.maxVal() )
+    If a thread fails, the buffer is marked failed: every waiting thread is woken and every
+    later put or get raises a RuntimeError, so no thread waits for a grid which will never
+    arrive."""
+    def __init__( self, capacity, producerCount ):
+        '''Constructor.
+
+        @param      capacity        An int.  The maximum number of grids waiting to be written.
+        @param      producerCount   An int.  The number of rasterization threads which put
+                                    grids into the buffer.
+        '''
+        self.capacity = capacity
+        self.activeCount = producerCount
+        self.heap = []
+        self.nextIndex = 0
+        self.condition = threading.Condition()
+        # the report of the first failed thread, or None
+        self.error = None
+        # statistics
+        self.maxDepth = 0
+        self.producerStall = 0.0    # the total time rasterization threads waited for space
+        self.writerStall = 0.0      # the total time the output thread waited for the next grid
+
+    def put( self, index, grid ):
+        '''Adds a finished grid to the buffer.  Blocks while the buffer is full.
+
+        @param      index       An int.  The index of the grid in the sequence.
+        @param      grid        An instance of DataGrid.  The grid to write.
+        @raises     RuntimeError if the buffer has failed.
+        '''
+        self.condition.acquire()
+        try:
+            if ( self.isFull( index ) ):
+                start = time.time()
+                while ( self.isFull( index ) and self.error is None ):
+                    self.condition.wait()
+                self.producerStall += time.time() - start
+            if ( self.error is not None ):
+                raise RuntimeError, "The grid buffer has failed"
+            heapq.heappush( self.heap, ( index, grid ) )
+            self.maxDepth = max( self.maxDepth, len( self.heap ) )
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def isFull( self, index ):
+        '''Reports if a grid with the given index must wait to be put into the buffer.  The
+        grid the output thread is waiting for is always accepted.  The buffer's condition
+        must be held by the caller.
+
+        @param      index       An int.  The index of the grid to put into the buffer.
+        @returns    A boolean.  True if the grid must wait.
+        '''
+        return len( self.heap ) >= self.capacity and index != self.nextIndex
+
+    def producerFinished( self ):
+        '''Reports that one of the rasterization threads will put no more grids.'''
+        self.condition.acquire()
+        self.activeCount -= 1
+        self.condition.notifyAll()
+        self.condition.release()
+
+    def producerFailed( self, message ):
+        '''Reports that one of the rasterization threads failed; the grids it took will never
+        arrive.  The buffer fails.
+
+        @param      message     A string.  The report of the failure (e.g., a traceback).
+        '''
+        self.condition.acquire()
+        self.activeCount -= 1
+        self.condition.release()
+        self.fail( message )
+
+    def fail( self, message ):
+        '''Marks the buffer failed and wakes all of the waiting threads.  Only the first
+        failure is kept.
+
+        @param      message     A string.  The report of the failure (e.g., a traceback).
+        '''
+        self.condition.acquire()
+        if ( self.error is None ):
+            self.error = message
+        self.condition.notifyAll()
+        self.condition.release()
+
+    def get( self ):
+        '''Removes the next grid (in index order) from the buffer.  Blocks until it is available.
+
+        @returns    A 2-tuple ( index, grid ).  Or None if every rasterization thread is finished
+                    and the next grid will never arrive.
+        @raises     RuntimeError if the buffer has failed.
+        '''
+        self.condition.acquire()
+        try:
+            start = time.time()
+            while ( self.error is None and ( not self.heap or self.heap[0][0] != self.nextIndex ) ):
+                if ( self.activeCount == 0 ):
+                    return None
+                self.condition.wait()
+            if ( self.error is not None ):
+                raise RuntimeError, "The grid buffer has failed"
+            self.writerStall += time.time() - start
+            entry = heapq.heappop( self.heap )
+            self.nextIndex += 1
+            self.condition.notifyAll()
+            return entry
+        finally:
+            self.condition.release()
+
+def runProducer( function, args, buffer ):
+    '''The body of a rasterization thread.  Runs the work function and reports to the buffer
+    when it is done, or that it failed.
+
+    @param      function        The work function (e.g., threadConvolve).
+    @param      args            A tuple.  The arguments of the work function.
+    @param      buffer          An instance of GridBuffer.  The buffer the function puts its
+                                grids into.
+    '''
+    try:
+        function( *args )
+    except Exception:
+        buffer.producerFailed( traceback.format_exc() )
+    else:
+        buffer.producerFinished()
 
 # The function that does the rasterization work
 
@@ -44,16 +167,15 @@ def threadPrint( msg ):
 #   Then this could be a single function, with a single argument that is responsible for
 #   knowin what the work is.
 
-def threadConvolve( log, bufferLock, buffer, frameLock,     # thread info
+def threadConvolve( log, buffer, frameLock,                 # thread info
                     signal, frameSet,                       # the input signal
                     gridDomain, kernel ):                   # the convolution domain and convolution kernel
     '''Function for performing simple convolution across a sequence of pedestrian data.
     
     @param      log             An instance of RasterReport (see GridFileSequence.py).
                                 Each thread gets its own copy.
-    @param      bufferLock      A threading.Lock for accessing the buffer.
-    @param      buffer          The buffer for storing the finished convolution.  Shared
-                                across all threads.
+    @param      buffer          An instance of GridBuffer.  The buffer for storing the finished
+                                grids.  Shared across all threads.
     @param      frameLock       A threading.Lock for accessing the pedestrian data.
     @param      signal          An instance of the signal.  Each thread has a unique signal instance.
     @param      frameSet        An instance of signal data.  In each iteration, the signal's
@@ -87,24 +209,22 @@ def threadConvolve( log, bufferLock, buffer, frameLock,     # thread info
         log.incCount()
         threadPrint( "\tAfter convolve: min/max/mean values: %f, %f, %f" % ( g.minVal(), g.maxVal(), g.cells.mean() ) )
         # put into buffer
-        bufferLock.acquire()
-        buffer.append( BufferGrid( signal.index, g ) )
-        bufferLock.release()
+        buffer.put( signal.index, g )
 
 
-def threadVoronoiDensity( log, bufferLock, buffer, frameLock,  # thread management
+def threadVoronoiDensity( log, buffer, frameLock,  # thread management
                           frameSet,            # the iterable set of sites
                           gridDomain,          # the domain over which the voronoi is computed
                           obstacles=None,      # the optional set of obstacles (for the constraints)
-                          limit=-1                    
+                          limit=-1,
+                          incremental=None     # the optional incremental voronoi state of the thread
                    ):
     '''Function for computing the discrete, constrained voronoi diagram over a given domain.
 
     @param      log             An instance of RasterReport (see GridFileSequence.py).
                                 Each thread gets its own copy.
-    @param      bufferLock      A threading.Lock for accessing the buffer.
-    @param      buffer          The buffer for storing the finished convolution.  Shared
-                                across all threads.
+    @param      buffer          An instance of GridBuffer.  The buffer for storing the finished
+                                grids.  Shared across all threads.
     @param      frameLock       A threading.Lock for accessing the pedestrian data.
     @param      frameSet        An instance of site data.  Typically, it is pedestrian data
                                 (real or synthesized).
@@ -114,6 +234,9 @@ def threadVoronoiDensity( log, bufferLock, buffer, frameLock,  # thread manageme
                                 computations.  Currently not supported
     @param      limit           A float.  The maximum distance a point can be and still lie
                                 in a voronoi region.
+    @param      incremental     An instance of IncrementalVoronoi.  If given, each diagram is
+                                derived from the diagram of the previous frame this thread
+                                computed.  Each thread must have its own instance.
     '''
         
     while ( True ):
@@ -129,7 +252,7 @@ def threadVoronoiDensity( log, bufferLock, buffer, frameLock,  # thread manageme
             frameLock.release()
 
         try:
-            density = computeVoronoiDensity( gridDomain, frame, ids, obstacles, limit )
+            density = computeVoronoiDensity( gridDomain, frame, ids, obstacles, limit, incremental )
         except Exception as e:
             print "ERROR", e
             raise
@@ -140,11 +263,9 @@ def threadVoronoiDensity( log, bufferLock, buffer, frameLock,  # thread manageme
         log.incCount()
         threadPrint( "Grid %d has min/max/mean values: %f, %f, %f" % ( index, density.minVal(), density.maxVal(), density.cells.mean() ) )
         # put into buffer
-        bufferLock.acquire()
-        buffer.append( BufferGrid( index, density ) )
-        bufferLock.release()
+        buffer.put( index, density )
 
-def threadVoronoi( log, bufferLock, buffer, frameLock,  # thread management
+def threadVoronoi( log, buffer, frameLock,  # thread management
                    frameSet,            # the iterable set of sites
                    gridDomain,          # the domain over which the voronoi is computed
                    obstacles=None,      # the optional set of obstacles (for the constraints)
@@ -154,9 +275,8 @@ def threadVoronoi( log, bufferLock, buffer, frameLock,  # thread management
 
     @param      log             An instance of RasterReport (see GridFileSequence.py).
                                 Each thread gets its own copy.
-    @param      bufferLock      A threading.Lock for accessing the buffer.
-    @param      buffer          The buffer for storing the finished convolution.  Shared
-                                across all threads.
+    @param      buffer          An instance of GridBuffer.  The buffer for storing the finished
+                                grids.  Shared across all threads.
     @param      frameLock       A threading.Lock for accessing the pedestrian data.
     @param      frameSet        An instance of site data.  Typically, it is pedestrian data
                                 (real or synthesized).
@@ -188,6 +308,4 @@ def threadVoronoi( log, bufferLock, buffer, frameLock,  # thread management
         log.incCount()
         threadPrint( "Grid %d has min/max/mean values: %f, %f, %f" % ( index, voronoi.minVal(), voronoi.maxVal(), voronoi.cells.mean() ) )
         # put into buffer
-        bufferLock.acquire()
-        buffer.append( BufferGrid( index, voronoi ) )
-        bufferLock.release()
+        buffer.put( index, voronoi )
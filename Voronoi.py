@@ -3,8 +3,30 @@ from primitives import Vector2
 import numpy as np
 
 MAX_DIST = 100000.0
-
-#TODO: Actually include obstacles
+# The largest padding (as a fraction of the domain's larger dimension) added around the domain
+#   by floodNearestSites to seed sites which lie outside of the domain.
+FLOOD_PADDING = 0.25
+# The approximate costs (in seconds) of the basic operations of the voronoi engines.  Used by
+#   selectVoronoiEngine.
+STAMP_SITE_COST = 16e-6     # stamping a single site's distance template (computeFiniteVoronoi)
+STAMP_CELL_COST = 3e-9      # per cell of the distance template
+BRUTE_CELL_COST = 20e-9     # a single site's distance to a single cell (computeInfiniteVoronoi)
+FLOOD_CELL_COST = 15e-9     # a single cell considering a single neighbor (floodNearestSites)
+# The length (in cells) of the pieces of a line which traceBlocked tests for blocked cells
+#   before sampling them.
+TRACE_PIECE = 8
+# The largest site id for which regionLabels maps ids to sites through a table.
+LABEL_TABLE_SIZE = 1 << 22
+# The distance (in cells) a site can move before IncrementalVoronoi recomputes its region and
+#   the largest fraction of the sites which can change before it recomputes the whole diagram.
+INCREMENTAL_TOLERANCE = 1.0
+INCREMENTAL_MAX_CHANGE = 0.25
+# The padding (in cells) IncrementalVoronoi adds around the domain so sites can leave it
+#   without forcing the diagram to be recomputed.
+INCREMENTAL_MARGIN = 8
+# The number of attempts floodNearestSites makes to seed sites which share a cell with
+#   another site into neighboring cells.
+SEED_ATTEMPTS = 3
 
 def computeFiniteVoronoi( domain, sites, ids, voronoiLimit, obstacles=None ):
     '''Computes the DISCRETE constrained voronoi diagram for the given sites over the given
@@ -131,6 +153,898 @@ def computeInfiniteVoronoi( domain, sites, ids, obstacles=None ):
 
     return ownerGrid  
 
+def floodSteps( reach ):
+    '''Computes the step sizes of the jump flooding passes required to propagate sites the
+    given distance.
+
+    @param      reach       An int.  The distance, in cells, the sites must be propagated.
+    @returns    A list of ints.  The step size of each pass.
+    '''
+    step = 1
+    while ( 2 * step < reach ):
+        step *= 2
+    steps = []
+    while ( step >= 1 ):
+        steps.append( step )
+        step /= 2
+    steps.append( 1 )
+    return steps
+
+class SiteGrid:
+    '''The grid over which the voronoi engines propagate the sites.  It is the domain, padded
+    to include the cells of sites which lie outside of it, and the cells in which the sites
+    are seeded.
+
+    All positions are in cell units; cell (i, j) has its center at (i + 0.5, j + 0.5).  If
+    there is a voronoiLimit, the sites are snapped to the centers of the cells which contain
+    them (as in computeFiniteVoronoi) and sites which can't reach the domain are ignored.
+
+    Each site is seeded into the cell which contains it.  Of the sites which lie in a single
+    cell, the site nearest the cell's center is seeded in it; the others are seeded in nearby
+    free cells (see SEED_ATTEMPTS).  The padding is limited by the voronoiLimit (or by
+    FLOOD_PADDING for unbounded regions).  Sites beyond the padding are seeded at its boundary.
+    '''
+    def __init__( self, domain, sites, voronoiLimit=-1, margin=0 ):
+        '''Constructor.
+
+        @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                    The computation is performed.
+        @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                    in the 0th and 1st columns, respectively.
+        @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                    any site's voronoi region.  If negative, a site's region is
+                                    unbounded.
+        @param      margin          An int.  The minimum padding (in cells) on each side of
+                                    the domain (still limited as above).  Allows sites to move
+                                    out of the domain (see IncrementalVoronoi).
+        '''
+        self.domain = domain
+        self.W = int( domain.resolution[0] )
+        self.H = int( domain.resolution[1] )
+        self.cellX = float( domain.cellSize[0] )
+        self.cellY = float( domain.cellSize[1] )
+        self.padL = self.padB = 0
+        # the limit on the distance from a cell to its site and the distance (in cells) the
+        #   sites must be propagated
+        if ( voronoiLimit > 0.0 ):
+            self.limit = float( voronoiLimit )
+            self.reach = int( np.ceil( voronoiLimit / min( self.cellX, self.cellY ) ) ) + 1
+        else:
+            self.limit = np.inf
+            self.reach = max( self.W, self.H )
+        self.seedCell = np.zeros( 0, dtype=np.int64 )
+        self.seedSite = np.zeros( 0, dtype=np.int32 )
+        self.seedDistSq = np.zeros( 0, dtype=np.float64 )
+
+        pos = np.asarray( sites, dtype=np.float64 ).reshape( -1, 2 )
+        self.u = ( pos[:, 0] - domain.minCorner[0] ) / self.cellX
+        self.v = ( pos[:, 1] - domain.minCorner[1] ) / self.cellY
+        index = np.arange( self.u.size, dtype=np.int32 )
+        if ( voronoiLimit > 0.0 ):
+            self.u = np.floor( self.u ) + 0.5
+            self.v = np.floor( self.v ) + 0.5
+            outX = np.maximum( 0.0, np.maximum( 0.5 - self.u, self.u - ( self.W - 0.5 ) ) ) * self.cellX
+            outY = np.maximum( 0.0, np.maximum( 0.5 - self.v, self.v - ( self.H - 0.5 ) ) ) * self.cellY
+            index = index[ outX * outX + outY * outY <= self.limit * self.limit ]
+            maxPad = self.reach
+        else:
+            maxPad = int( np.ceil( FLOOD_PADDING * max( self.W, self.H ) ) )
+        self.maxPad = maxPad
+        if ( index.size == 0 ):
+            return
+
+        # pad the domain to include the cells of the sites outside of it
+        cellU = np.floor( self.u[ index ] ).astype( np.int64 )
+        cellV = np.floor( self.v[ index ] ).astype( np.int64 )
+        self.padL = int( min( maxPad, max( margin, -cellU.min() ) ) )
+        padR = int( min( maxPad, max( margin, cellU.max() - ( self.W - 1 ) ) ) )
+        self.padB = int( min( maxPad, max( margin, -cellV.min() ) ) )
+        padT = int( min( maxPad, max( margin, cellV.max() - ( self.H - 1 ) ) ) )
+        self.W += self.padL + padR
+        self.H += self.padB + padT
+        self.u += self.padL
+        self.v += self.padB
+        cellU += self.padL
+        cellV += self.padB
+        if ( voronoiLimit <= 0.0 ):
+            self.reach = max( self.W, self.H )
+
+        occupied = np.zeros( self.W * self.H, dtype=np.bool )
+        seedCells = []
+        seedSites = []
+        seedDists = []
+        pending = np.arange( index.size )
+        offsets = np.array( [ ( 0, 0 ), ( -1, 0 ), ( 1, 0 ), ( 0, -1 ), ( 0, 1 ),
+                              ( -1, -1 ), ( -1, 1 ), ( 1, -1 ), ( 1, 1 ) ], dtype=np.int64 )
+        for attempt in xrange( SEED_ATTEMPTS ):
+            neighbors = offsets[ :1 ] if ( attempt == 0 ) else offsets
+            seedX = np.clip( cellU[ pending ].reshape( -1, 1 ) + neighbors[ :, 0 ], 0, self.W - 1 )
+            seedY = np.clip( cellV[ pending ].reshape( -1, 1 ) + neighbors[ :, 1 ], 0, self.H - 1 )
+            seedCell = seedX * self.H + seedY
+            seedDist = ( ( ( seedX + 0.5 - self.u[ index[ pending ] ].reshape( -1, 1 ) ) * self.cellX ) ** 2 +
+                         ( ( seedY + 0.5 - self.v[ index[ pending ] ].reshape( -1, 1 ) ) * self.cellY ) ** 2 )
+            seedDist[ occupied[ seedCell ] ] = np.inf
+            nearest = np.argmin( seedDist, axis=1 )
+            rows = np.arange( pending.size )
+            seedCell = seedCell[ rows, nearest ]
+            seedDist = seedDist[ rows, nearest ]
+            free = np.isfinite( seedDist )
+            pending = pending[ free ]
+            seedCell = seedCell[ free ]
+            seedDist = seedDist[ free ]
+
+            # where several sites compete for a cell, the nearest wins
+            order = np.lexsort( ( index[ pending ], seedDist, seedCell ) )
+            first = np.zeros( order.size, dtype=np.bool )
+            first[ :1 ] = True
+            first[ 1: ] = seedCell[ order[ 1: ] ] != seedCell[ order[ :-1 ] ]
+            seeded = order[ first ]
+            occupied[ seedCell[ seeded ] ] = True
+            seedCells.append( seedCell[ seeded ] )
+            seedSites.append( index[ pending[ seeded ] ] )
+            seedDists.append( seedDist[ seeded ] )
+            pending = pending[ order[ ~first ] ]
+            if ( pending.size == 0 ):
+                break
+        self.seedCell = np.concatenate( seedCells )
+        self.seedSite = np.concatenate( seedSites )
+        self.seedDistSq = np.concatenate( seedDists )
+
+    def paddedDomain( self ):
+        '''Reports the padded domain.
+
+        @returns    An instance of AbstractGrid.  The domain with its padding.
+        '''
+        minCorner = Vector2( self.domain.minCorner[0] - self.padL * self.cellX,
+                             self.domain.minCorner[1] - self.padB * self.cellY )
+        size = Vector2( self.W * self.cellX, self.H * self.cellY )
+        return AbstractGrid( minCorner, size, ( self.W, self.H ) )
+
+    def crop( self, data ):
+        '''Extracts the domain from an array over the padded domain.
+
+        @param      data        A numpy array with shape (W, H), the padded resolution.
+        @returns    A numpy array with the domain's resolution.
+        '''
+        return data[ self.padL:self.padL + int( self.domain.resolution[0] ),
+                     self.padB:self.padB + int( self.domain.resolution[1] ) ]
+
+def floodNearestSites( domain, sites, voronoiLimit=-1 ):
+    '''Computes the nearest site to every cell center in the domain using the jump flooding
+    algorithm.  The sites are seeded into their cells (see SiteGrid).  Then, in a sequence of
+    passes of decreasing step size (k, k/2, ..., 1, followed by a final pass with step
+    size 1), every cell considers the sites owning the eight cells k cells away from it and
+    adopts the nearest.  Each pass is a whole-array operation so the cost is
+    O( cells * log( cells ) ), independent of the number of sites.  Equidistant sites are
+    resolved in favor of the lower site index.
+
+    The result is not guaranteed to be exact; in rare configurations a cell is assigned to
+    a site which is only nearly the nearest.
+
+    If voronoiLimit is positive, the sites are snapped to the centers of the cells which
+    contain them (as in computeFiniteVoronoi), and no cell farther than voronoiLimit
+    from a site is owned.
+
+    @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                The computation is performed.
+    @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                in the 0th and 1st columns, respectively.
+    @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                any site's voronoi region.  If negative, a site's region is
+                                unbounded.
+    @returns    A 2-tuple of numpy arrays, each with the domain's resolution, (owner, distSq).
+                owner is an array of int32s, the index of the site which owns each cell (-1
+                for cells which are owned by no site).  distSq is an array of float64s, the
+                squared distance from each cell center to its owning site.
+    '''
+    grid = SiteGrid( domain, sites, voronoiLimit )
+    owner, distSq, ownerU, ownerV = floodSiteGrid( grid )
+    return grid.crop( owner ), grid.crop( distSq )
+
+def floodSiteGrid( grid ):
+    '''Performs the jump flooding of floodNearestSites over the padded grid.
+
+    @param      grid        An instance of SiteGrid.  The grid and its seeded sites.
+    @returns    A 4-tuple of numpy arrays, each with the padded resolution,
+                (owner, distSq, ownerU, ownerV).  owner is an array of int32s, the index of
+                the site which owns each cell (-1 for cells which are owned by no site).
+                distSq is an array of float64s, the squared distance from each cell center to
+                its owning site.  ownerU and ownerV are arrays of float64s, the position of
+                the owning site (in cell units).
+    '''
+    W = grid.W
+    H = grid.H
+    cellX = grid.cellX
+    cellY = grid.cellY
+    owner = np.empty( ( W, H ), dtype=np.int32 )
+    owner.fill( -1 )
+    distSq = np.empty( ( W, H ), dtype=np.float64 )
+    distSq.fill( np.inf )
+    # The position of each cell's owner is shifted along with the owner so the passes never
+    #   have to gather the site positions.
+    ownerU = np.zeros( ( W, H ), dtype=np.float64 )
+    ownerV = np.zeros( ( W, H ), dtype=np.float64 )
+    if ( grid.seedCell.size == 0 ):
+        return owner, distSq, ownerU, ownerV
+
+    owner.flat[ grid.seedCell ] = grid.seedSite
+    distSq.flat[ grid.seedCell ] = grid.seedDistSq
+    ownerU.flat[ grid.seedCell ] = grid.u[ grid.seedSite ]
+    ownerV.flat[ grid.seedCell ] = grid.v[ grid.seedSite ]
+
+    centerX = np.arange( W, dtype=np.float64 ).reshape( W, 1 ) + 0.5
+    centerY = np.arange( H, dtype=np.float64 ).reshape( 1, H ) + 0.5
+
+    for step in floodSteps( grid.reach ):
+        for dx in ( -step, 0, step ):
+            if ( abs( dx ) >= W ):
+                continue
+            for dy in ( -step, 0, step ):
+                if ( ( dx == 0 and dy == 0 ) or abs( dy ) >= H ):
+                    continue
+                # cells [ dst ] consider the owners of cells [ src ] = [ dst + ( dx, dy ) ]
+                dst = ( slice( max( 0, -dx ), W - max( 0, dx ) ), slice( max( 0, -dy ), H - max( 0, dy ) ) )
+                src = ( slice( max( 0, dx ), W + min( 0, dx ) ), slice( max( 0, dy ), H + min( 0, dy ) ) )
+                candidate = owner[ src ]
+                candDist = ( ( ( centerX[ dst[0] ] - ownerU[ src ] ) * cellX ) ** 2 +
+                             ( ( centerY[ :, dst[1] ] - ownerV[ src ] ) * cellY ) ** 2 )
+                currDist = distSq[ dst ]
+                better = ( candidate >= 0 ) & ( ( candDist < currDist ) |
+                                                ( ( candDist == currDist ) & ( candidate < owner[ dst ] ) ) )
+                if ( better.any() ):
+                    owner[ dst ][ better ] = candidate[ better ]
+                    ownerU[ dst ][ better ] = ownerU[ src ][ better ]
+                    ownerV[ dst ][ better ] = ownerV[ src ][ better ]
+                    currDist[ better ] = candDist[ better ]
+
+    outside = distSq > grid.limit * grid.limit
+    owner[ outside ] = -1
+    distSq[ outside ] = np.inf
+    return owner, distSq, ownerU, ownerV
+
+def computeFloodVoronoi( domain, sites, ids, voronoiLimit=-1 ):
+    '''Computes the DISCRETE voronoi diagram for the given sites over the given domain with
+    the jump flooding algorithm (see floodNearestSites).  The cost is independent of the
+    number of sites.
+
+    Areas which belong to no one are given the value -1.  Otherwise, the ownership is
+    the same as the id in the data.
+
+    @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                The computation is performed.
+    @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                in the 0th and 1st columns, respectively.
+    @param      ids             A N-tuple-like instance of ints.  For each row in the sites,
+                                this tuple contains an int which is the sites id.
+    @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                any site's voronoi region.  If negative, a site's region is
+                                unbounded.
+    @returns    An instance of DataGrid.  The discrete voronoi diagram.
+    '''
+    ownerGrid = domain.getDataGrid( -1, np.int32 )
+    owner, distSq = floodNearestSites( domain, sites[:, :2], voronoiLimit )
+    owned = owner >= 0
+    idArray = np.array( [ ids[ i ] for i in xrange( len( sites ) ) ], dtype=np.int32 )
+    ownerGrid.cells[ owned ] = idArray[ owner[ owned ] ]
+    return ownerGrid
+
+def adjacentCells( cells, W, H ):
+    '''Reports the cells adjacent to the given cells of a grid.
+
+    @param      cells       A numpy array of ints.  The flat indices ( x * H + y ) of cells of
+                            the grid.
+    @param      W           An int.  The number of cells of the grid in the x-direction.
+    @param      H           An int.  The number of cells of the grid in the y-direction.
+    @returns    A numpy array of ints.  The sorted, unique flat indices of the cells adjacent
+                to the given cells.
+    '''
+    x = cells // H
+    y = cells % H
+    neighbors = []
+    for dx in ( -1, 0, 1 ):
+        for dy in ( -1, 0, 1 ):
+            if ( dx == 0 and dy == 0 ):
+                continue
+            valid = ( x + dx >= 0 ) & ( x + dx < W ) & ( y + dy >= 0 ) & ( y + dy < H )
+            neighbors.append( cells[ valid ] + dx * H + dy )
+    return np.unique( np.concatenate( neighbors ) )
+
+class IncrementalVoronoi:
+    '''Computes the discrete voronoi diagrams of a sequence of frames.  Consecutive frames
+    typically differ by small displacements of the sites, so the diagram of each frame is
+    derived from the diagram of the previous frame.
+
+    Each site has a reference position; the position at which its region was last resolved.
+    A site is considered to have moved if it lies more than tolerance cells from its reference
+    position.  The cells owned by sites which moved, or which left the frame, are released
+    and the moved sites, and the sites which entered the frame, are seeded at their new
+    positions.  Ownership is then propagated from cell to adjacent cell, starting from the
+    affected cells, until no cell changes (see relax).  The cost is proportional to the area
+    of the affected regions instead of the area of the domain.  On the grid, a thin region
+    can be split into pieces which don't touch; a piece which touches none of the affected
+    cells keeps its previous owner.  So, even without a tolerance, a few cells can differ
+    from the diagram computed from scratch.
+
+    The diagram of the first frame (and any frame in which more than maxChange of the sites
+    changed, or whose sites leave the padded domain) is computed from scratch with the jump
+    flooding engine (see floodNearestSites).  The site ids must be unique in each frame.
+
+    The resulting regions are those of the reference positions, so they can be off by as
+    much as tolerance cells from those of the current positions.  Frames with obstacles are
+    always computed from scratch (see computeConstrainedVoronoi).
+    '''
+    def __init__( self, tolerance=INCREMENTAL_TOLERANCE, maxChange=INCREMENTAL_MAX_CHANGE ):
+        '''Constructor.
+
+        @param      tolerance       A float.  The distance (in cells) a site can move from its
+                                    reference position before its region is recomputed.
+        @param      maxChange       A float.  The largest fraction of the sites which can move,
+                                    enter or leave between frames before the diagram is
+                                    recomputed from scratch.
+        '''
+        self.tolerance = tolerance
+        self.maxChange = maxChange
+        # the number of diagrams computed from scratch and computed incrementally
+        self.rebuildCount = 0
+        self.updateCount = 0
+        self.reset()
+
+    def reset( self ):
+        '''Discards the previous diagram; the next diagram will be computed from scratch.'''
+        self.grid = None
+        self.key = None
+
+    def computeVoronoi( self, domain, sites, ids, obstacles=None, voronoiLimit=-1 ):
+        '''Computes the DISCRETE voronoi diagram of the next frame.
+
+        Areas which belong to no one are given the value -1.  Otherwise, the ownership is
+        the same as the id in the data.
+
+        @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                    The computation is performed.
+        @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                    in the 0th and 1st columns, respectively.
+        @param      ids             A N-tuple-like instance of ints.  For each row in the sites,
+                                    this tuple contains an int which is the sites id.
+        @param      obstacles       An instance of ObstacleSet (or any iterable of polygons).
+                                    If given, the regions are constrained by the obstacles (see
+                                    computeConstrainedVoronoi).
+        @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                    any site's voronoi region.  If negative, a site's region is
+                                    unbounded.
+        @returns    An instance of DataGrid.  The discrete voronoi diagram.
+        '''
+        if ( obstacles is not None and len( obstacles ) > 0 ):
+            self.reset()
+            return computeVoronoi( domain, sites, ids, obstacles, voronoiLimit )
+        pos = np.asarray( sites, dtype=np.float64 )[ :, :2 ]
+        idArray = np.array( [ ids[ i ] for i in xrange( len( pos ) ) ], dtype=np.int32 )
+        key = ( domain.minCorner[0], domain.minCorner[1], domain.size[0], domain.size[1],
+                domain.resolution[0], domain.resolution[1], voronoiLimit )
+        if ( key != self.key or not self.update( pos, idArray ) ):
+            self.rebuild( domain, pos, idArray, voronoiLimit )
+            self.key = key
+            self.rebuildCount += 1
+        else:
+            self.updateCount += 1
+        ownerGrid = domain.getDataGrid( -1, np.int32 )
+        ownerGrid.cells[ :, : ] = self.grid.crop( self.owner.reshape( self.grid.W, self.grid.H ) )
+        return ownerGrid
+
+    def rebuild( self, domain, pos, idArray, voronoiLimit ):
+        '''Computes the diagram from scratch.
+
+        @param      domain          An instance of AbstractGrid.  The domain of the diagram.
+        @param      pos             An Nx2 numpy array of float64s.  The site positions.
+        @param      idArray         A numpy array of N int32s.  The site ids.
+        @param      voronoiLimit    A float.  The maximum extent of the regions (if positive).
+        '''
+        self.grid = SiteGrid( domain, pos, voronoiLimit, INCREMENTAL_MARGIN )
+        owner, distSq, ownerU, ownerV = floodSiteGrid( self.grid )
+        owned = owner >= 0
+        owner[ owned ] = idArray[ owner[ owned ] ]
+        # the state is kept in flat arrays so cells can be addressed by a single index
+        self.owner = owner.ravel()
+        self.distSq = distSq.ravel()
+        self.ownerU = ownerU.ravel()
+        self.ownerV = ownerV.ravel()
+        order = np.argsort( idArray )
+        self.siteIds = idArray[ order ]
+        self.siteU = self.grid.u[ order ]
+        self.siteV = self.grid.v[ order ]
+
+    def cellPositions( self, pos ):
+        '''Maps site positions into the cell units of the padded grid.
+
+        @param      pos         An Nx2 numpy array of float64s.  The site positions.
+        @returns    A 2-tuple of numpy arrays of N float64s, ( u, v ).  The positions in
+                    cell units (snapped to cell centers if the regions are limited).
+        '''
+        grid = self.grid
+        u = ( pos[:, 0] - grid.domain.minCorner[0] ) / grid.cellX
+        v = ( pos[:, 1] - grid.domain.minCorner[1] ) / grid.cellY
+        if ( grid.limit < np.inf ):
+            u = np.floor( u ) + 0.5
+            v = np.floor( v ) + 0.5
+        return u + grid.padL, v + grid.padB
+
+    def update( self, pos, idArray ):
+        '''Updates the diagram of the previous frame to the given sites.
+
+        @param      pos         An Nx2 numpy array of float64s.  The site positions.
+        @param      idArray     A numpy array of N int32s.  The site ids.
+        @returns    A boolean.  True if the diagram was updated, False if it must be computed
+                    from scratch (in which case, the state is unchanged).
+        '''
+        grid = self.grid
+        if ( self.siteIds.size == 0 or idArray.size == 0 ):
+            return False
+        u, v = self.cellPositions( pos )
+        match = np.minimum( np.searchsorted( self.siteIds, idArray ), self.siteIds.size - 1 )
+        found = self.siteIds[ match ] == idArray
+        moved = ~found | ( np.hypot( u - self.siteU[ match ], v - self.siteV[ match ] ) > self.tolerance )
+        present = np.zeros( self.siteIds.size, dtype=np.bool )
+        present[ match[ found ] ] = True
+        changedIds = np.concatenate( ( self.siteIds[ ~present ], idArray[ found & moved ] ) )
+        if ( np.count_nonzero( moved ) + np.count_nonzero( ~present ) > self.maxChange * idArray.size ):
+            return False
+
+        # The moved sites must lie in the padded grid, unless the padding is already as large
+        #   as it can be.
+        W = grid.W
+        H = grid.H
+        padR = W - grid.padL - int( grid.domain.resolution[0] )
+        padT = H - grid.padB - int( grid.domain.resolution[1] )
+        cellU = np.floor( u[ moved ] ).astype( np.int64 )
+        cellV = np.floor( v[ moved ] ).astype( np.int64 )
+        if ( ( grid.padL < grid.maxPad and np.any( cellU < 0 ) ) or
+             ( padR < grid.maxPad and np.any( cellU >= W ) ) or
+             ( grid.padB < grid.maxPad and np.any( cellV < 0 ) ) or
+             ( padT < grid.maxPad and np.any( cellV >= H ) ) ):
+            return False
+
+        # release the regions of the sites which moved or left
+        stale = np.zeros( 0, dtype=np.int64 )
+        if ( changedIds.size > 0 ):
+            stale = np.flatnonzero( np.in1d( self.owner, changedIds ) )
+            self.owner[ stale ] = -1
+            self.distSq[ stale ] = np.inf
+
+        # Seed the sites which moved or entered into the cells around them.  So are the sites
+        #   which lost their own cell to a site which passed through it.
+        newU = np.where( moved, u, self.siteU[ match ] )
+        newV = np.where( moved, v, self.siteV[ match ] )
+        homeX = np.clip( np.floor( newU ).astype( np.int64 ), 0, W - 1 )
+        homeY = np.clip( np.floor( newV ).astype( np.int64 ), 0, H - 1 )
+        seeded = moved | ( self.owner[ homeX * H + homeY ] != idArray )
+        seedIds = idArray[ seeded ]
+        seedU = newU[ seeded ].reshape( -1, 1 )
+        seedV = newV[ seeded ].reshape( -1, 1 )
+        seedX = np.clip( homeX[ seeded ].reshape( -1, 1 ) + np.repeat( np.arange( -1, 2 ), 3 ), 0, W - 1 )
+        seedY = np.clip( homeY[ seeded ].reshape( -1, 1 ) + np.tile( np.arange( -1, 2 ), 3 ), 0, H - 1 )
+        seedDist = ( ( seedX + 0.5 - seedU ) * grid.cellX ) ** 2 + ( ( seedY + 0.5 - seedV ) * grid.cellY ) ** 2
+        seedCell = ( seedX * H + seedY ).ravel()
+        seedDist = seedDist.ravel()
+        seedSite = np.repeat( np.arange( seedIds.size ), 9 )
+        # where several sites compete for a cell, the nearest wins
+        order = np.lexsort( ( seedIds[ seedSite ], seedDist, seedCell ) )
+        first = np.ones( order.size, dtype=np.bool )
+        first[ 1: ] = seedCell[ order[ 1: ] ] != seedCell[ order[ :-1 ] ]
+        order = order[ first ]
+        seedCell = seedCell[ order ]
+        seedDist = seedDist[ order ]
+        seedSite = seedSite[ order ]
+        currDist = self.distSq[ seedCell ]
+        better = ( seedDist <= grid.limit * grid.limit ) & ( ( seedDist < currDist ) |
+                   ( ( seedDist == currDist ) & ( seedIds[ seedSite ] < self.owner[ seedCell ] ) ) )
+        seedCell = seedCell[ better ]
+        seedSite = seedSite[ better ]
+        self.owner[ seedCell ] = seedIds[ seedSite ]
+        self.distSq[ seedCell ] = seedDist[ better ]
+        self.ownerU[ seedCell ] = seedU[ seedSite, 0 ]
+        self.ownerV[ seedCell ] = seedV[ seedSite, 0 ]
+
+        # propagate from the affected cells
+        active = np.union1d( stale, self.neighborCells( seedCell ) )
+        while ( active.size > 0 ):
+            active = self.neighborCells( self.relax( active ) )
+
+        order = np.argsort( idArray )
+        self.siteIds = idArray[ order ]
+        self.siteU = newU[ order ]
+        self.siteV = newV[ order ]
+        return True
+
+    def neighborCells( self, cells ):
+        '''Reports the cells adjacent to the given cells.
+
+        @param      cells       A numpy array of ints.  The flat indices of cells of the padded
+                                grid.
+        @returns    A numpy array of ints.  The sorted, unique flat indices of the cells
+                    adjacent to the given cells.
+        '''
+        return adjacentCells( cells, self.grid.W, self.grid.H )
+
+    def relax( self, active ):
+        '''Each of the active cells considers the owners of its eight adjacent cells and adopts
+        the nearest.  Equidistant sites are resolved in favor of the lower id.
+
+        @param      active      A numpy array of ints.  The flat indices of the active cells.
+        @returns    A numpy array of ints.  The flat indices of the cells which changed owner.
+        '''
+        grid = self.grid
+        W = grid.W
+        H = grid.H
+        limitSq = grid.limit * grid.limit
+        x = active // H
+        y = active % H
+        centerU = x + 0.5
+        centerV = y + 0.5
+        owner = self.owner[ active ]
+        distSq = self.distSq[ active ]
+        source = active.copy()
+        for dx in ( -1, 0, 1 ):
+            for dy in ( -1, 0, 1 ):
+                if ( dx == 0 and dy == 0 ):
+                    continue
+                neighbor = np.clip( x + dx, 0, W - 1 ) * H + np.clip( y + dy, 0, H - 1 )
+                candidate = self.owner[ neighbor ]
+                candDist = ( ( ( centerU - self.ownerU[ neighbor ] ) * grid.cellX ) ** 2 +
+                             ( ( centerV - self.ownerV[ neighbor ] ) * grid.cellY ) ** 2 )
+                better = ( candidate >= 0 ) & ( candDist <= limitSq ) & ( ( candDist < distSq ) |
+                                                                           ( ( candDist == distSq ) & ( candidate < owner ) ) )
+                owner[ better ] = candidate[ better ]
+                distSq[ better ] = candDist[ better ]
+                source[ better ] = neighbor[ better ]
+        changed = source != active
+        active = active[ changed ]
+        source = source[ changed ]
+        self.owner[ active ] = owner[ changed ]
+        self.distSq[ active ] = distSq[ changed ]
+        self.ownerU[ active ] = self.ownerU[ source ]
+        self.ownerV[ active ] = self.ownerV[ source ]
+        return active
+
+def rasterizeObstacles( domain, obstacles ):
+    '''Rasterizes the obstacles into a mask of blocked cells.  A cell is blocked if its center
+    lies inside a closed obstacle or if an obstacle edge passes through it.
+
+    @param      domain          An instance of AbstractGrid.  The domain to rasterize into.
+    @param      obstacles       An iterable of polygons (such as an ObstacleSet).  Each polygon
+                                has a list of vertices and is either closed or open.
+    @returns    A numpy array of bools with the domain's resolution.  True for blocked cells.
+    '''
+    W = int( domain.resolution[0] )
+    H = int( domain.resolution[1] )
+    blocked = np.zeros( ( W, H ), dtype=np.bool )
+    if ( obstacles is None ):
+        return blocked
+    minX = domain.minCorner[0]
+    minY = domain.minCorner[1]
+    cellX = float( domain.cellSize[0] )
+    cellY = float( domain.cellSize[1] )
+    centerX = ( np.arange( W, dtype=np.float64 ) + 0.5 ) * cellX + minX
+    centerY = ( np.arange( H, dtype=np.float64 ) + 0.5 ) * cellY + minY
+    for poly in obstacles:
+        verts = np.array( [ ( v[0], v[1] ) for v in poly.vertices ], dtype=np.float64 ).reshape( -1, 2 )
+        if ( verts.shape[0] == 0 ):
+            continue
+        if ( poly.closed and verts.shape[0] > 2 ):
+            # the even-odd rule for the cell centers in the polygon's bounding box
+            l = max( 0, int( np.floor( ( verts[:, 0].min() - minX ) / cellX ) ) )
+            r = min( W, int( np.ceil( ( verts[:, 0].max() - minX ) / cellX ) ) + 1 )
+            b = max( 0, int( np.floor( ( verts[:, 1].min() - minY ) / cellY ) ) )
+            t = min( H, int( np.ceil( ( verts[:, 1].max() - minY ) / cellY ) ) + 1 )
+            if ( l < r and b < t ):
+                X = centerX[ l:r ].reshape( -1, 1 )
+                Y = centerY[ b:t ].reshape( 1, -1 )
+                inside = np.zeros( ( r - l, t - b ), dtype=np.bool )
+                for ( x0, y0 ), ( x1, y1 ) in zip( verts, np.roll( verts, -1, axis=0 ) ):
+                    if ( y0 == y1 ):
+                        continue
+                    inside ^= ( ( y0 > Y ) != ( y1 > Y ) ) & ( X < ( x1 - x0 ) * ( Y - y0 ) / ( y1 - y0 ) + x0 )
+                blocked[ l:r, b:t ] |= inside
+        # the edges are sampled densely enough that every cell they cross is blocked
+        ends = verts
+        if ( poly.closed and verts.shape[0] > 2 ):
+            ends = np.concatenate( ( verts, verts[:1] ) )
+        for p0, p1 in zip( ends[ :-1 ], ends[ 1: ] ):
+            length = max( np.abs( p1[0] - p0[0] ) / cellX, np.abs( p1[1] - p0[1] ) / cellY )
+            t = np.linspace( 0.0, 1.0, int( np.ceil( length * 4 ) ) + 2 ).reshape( -1, 1 )
+            points = p0 + t * ( p1 - p0 )
+            x = np.floor( ( points[:, 0] - minX ) / cellX ).astype( np.int64 )
+            y = np.floor( ( points[:, 1] - minY ) / cellY ).astype( np.int64 )
+            # where the edge passes diagonally between cells, the corner cell is blocked as
+            #   well so that nothing can pass between the diagonal cells
+            x = np.concatenate( ( x, x[ :-1 ] ) )
+            y = np.concatenate( ( y, y[ 1: ] ) )
+            inside = ( x >= 0 ) & ( x < W ) & ( y >= 0 ) & ( y < H )
+            blocked[ x[ inside ], y[ inside ] ] = True
+    return blocked
+
+def expandSegments( count ):
+    '''Subdivides segments into pieces.
+
+    @param      count       A numpy array of N ints.  The number of pieces of each segment.
+    @returns    A 2-tuple of numpy arrays ( segment, t ), each with sum( count ) values.  The
+                index of the segment of each piece and the parameter of the end of the piece
+                along the segment.  The pieces of segment i end at t = 1 / count[ i ], ..., 1.
+    '''
+    segment = np.repeat( np.arange( count.size ), count )
+    t = ( np.arange( segment.size ) - np.repeat( np.cumsum( count ) - count, count ) + 1.0 ) / count[ segment ]
+    return segment, t
+
+def traceBlocked( blocked, blockedSum, a0, b0, a1, b1 ):
+    '''Reports which of the line segments pass through blocked cells.  The segments are
+    divided into pieces of TRACE_PIECE cells.  The pieces whose bounding box contains blocked
+    cells (according to the summed area table) are sampled at a third of a cell.  The cell
+    containing the start of the segment is ignored (a site may lie in a blocked cell).
+
+    @param      blocked     An AxB numpy array of bools.  True for blocked cells.
+    @param      blockedSum  An (A+1)x(B+1) numpy array of ints.  The summed area table of
+                            blocked: blockedSum[ a, b ] is the number of blocked cells in
+                            blocked[ :a, :b ].
+    @param      a0          A numpy array of N floats.  The start of each segment along the
+                            first axis (in cell units).
+    @param      b0          A numpy array of N floats.  The start along the second axis.
+    @param      a1          A numpy array of N floats.  The end along the first axis.
+    @param      b1          A numpy array of N floats.  The end along the second axis.
+    @returns    A numpy array of N bools.  True for the segments which pass through a
+                blocked cell.
+    '''
+    A, B = blocked.shape
+    dA = a1 - a0
+    dB = b1 - b0
+    length = np.maximum( np.abs( dA ), np.abs( dB ) )
+    pieceCount = np.ceil( length / TRACE_PIECE ).astype( np.int64 ) + 1
+    segment, t1 = expandSegments( pieceCount )
+    t0 = t1 - 1.0 / pieceCount[ segment ]
+    startA = a0[ segment ] + t0 * dA[ segment ]
+    endA = a0[ segment ] + t1 * dA[ segment ]
+    startB = b0[ segment ] + t0 * dB[ segment ]
+    endB = b0[ segment ] + t1 * dB[ segment ]
+    loA = np.clip( np.floor( np.minimum( startA, endA ) ), 0, A - 1 ).astype( np.int64 )
+    hiA = np.clip( np.floor( np.maximum( startA, endA ) ), 0, A - 1 ).astype( np.int64 ) + 1
+    loB = np.clip( np.floor( np.minimum( startB, endB ) ), 0, B - 1 ).astype( np.int64 )
+    hiB = np.clip( np.floor( np.maximum( startB, endB ) ), 0, B - 1 ).astype( np.int64 ) + 1
+    near = ( blockedSum[ hiA, hiB ] - blockedSum[ loA, hiB ] - blockedSum[ hiA, loB ] +
+             blockedSum[ loA, loB ] ) > 0
+    hidden = np.zeros( a0.size, dtype=np.bool )
+    if ( not near.any() ):
+        return hidden
+
+    # sample the pieces near blocked cells
+    segment = segment[ near ]
+    t0 = t0[ near ]
+    span = t1[ near ] - t0
+    count = np.ceil( length[ segment ] * span * 3 ).astype( np.int64 ) + 1
+    piece, t = expandSegments( count )
+    segment = segment[ piece ]
+    t = t0[ piece ] + t * span[ piece ]
+    cellA = np.clip( np.floor( a0[ segment ] + t * dA[ segment ] ), 0, A - 1 )
+    cellB = np.clip( np.floor( b0[ segment ] + t * dB[ segment ] ), 0, B - 1 )
+    hit = blocked[ cellA.astype( np.int64 ), cellB.astype( np.int64 ) ]
+    hit &= ( cellA != np.floor( a0[ segment ] ) ) | ( cellB != np.floor( b0[ segment ] ) )
+    hidden[ segment[ hit ] ] = True
+    return hidden
+
+class GeodesicFront:
+    '''The state of the constrained propagation of sites over a grid (see sweepNearestSites).
+
+    Each cell records its owner, its distance and its anchor.  The anchor is the last point
+    on the path from the owner to the cell's center.  It is either the site or a cell center
+    at which the path bends around an obstacle.
+    '''
+    def __init__( self, grid, blocked ):
+        '''Constructor.  Seeds the sites.
+
+        @param      grid        An instance of SiteGrid.  The grid and its seeded sites.
+        @param      blocked     A WxH numpy array of bools (the resolution of the padded grid).
+                                True for cells blocked by obstacles.
+        '''
+        W = grid.W
+        H = grid.H
+        self.grid = grid
+        self.blocked = blocked
+        # blockedSum[ x, y ] is the number of blocked cells in blocked[ :x, :y ]
+        self.blockedSum = np.zeros( ( W + 1, H + 1 ), dtype=np.int64 )
+        self.blockedSum[ 1:, 1: ] = np.cumsum( np.cumsum( blocked, axis=0 ), axis=1 )
+        # The state is kept in flat arrays so cells can be addressed by a single index.  The
+        #   site owning each cell and the geodesic distance from the cell's center to it.
+        self.owner = np.empty( W * H, dtype=np.int32 )
+        self.owner.fill( -1 )
+        self.dist = np.empty( W * H, dtype=np.float64 )
+        self.dist.fill( np.inf )
+        self.owner[ grid.seedCell ] = grid.seedSite
+        self.dist[ grid.seedCell ] = np.sqrt( grid.seedDistSq )
+        # the position of the anchor (in cell units) and the geodesic distance to it
+        self.anchorU = np.zeros( W * H, dtype=np.float64 )
+        self.anchorU[ grid.seedCell ] = grid.u[ grid.seedSite ]
+        self.anchorV = np.zeros( W * H, dtype=np.float64 )
+        self.anchorV[ grid.seedCell ] = grid.v[ grid.seedSite ]
+        self.base = np.zeros( W * H, dtype=np.float64 )
+
+    def run( self ):
+        '''Propagates the sites from their cells until no cell changes.  Every change strictly
+        improves a cell's distance (or its owner, at equal distance), so the propagation
+        terminates.  Only the cells adjacent to a cell which changed are considered; with a
+        voronoiLimit, the front dies out at the limit.'''
+        active = adjacentCells( self.grid.seedCell, self.grid.W, self.grid.H )
+        while ( active.size > 0 ):
+            active = adjacentCells( self.relax( active ), self.grid.W, self.grid.H )
+
+    def relax( self, active ):
+        '''Each of the active, unblocked cells considers the owners of its eight adjacent cells
+        and adopts the nearest.  Equidistant sites are resolved in favor of the lower index.
+
+        @param      active      A numpy array of ints.  The flat indices of the active cells.
+        @returns    A numpy array of ints.  The flat indices of the cells which changed.
+        '''
+        grid = self.grid
+        W = grid.W
+        H = grid.H
+        blocked = self.blocked.ravel()
+        active = active[ ~blocked[ active ] ]
+        x = active // H
+        y = active % H
+        centerU = x + 0.5
+        centerV = y + 0.5
+        owner = self.owner[ active ]
+        dist = self.dist[ active ]
+        anchorU = self.anchorU[ active ]
+        anchorV = self.anchorV[ active ]
+        base = self.base[ active ]
+        anyBlocked = self.blockedSum[ -1, -1 ] > 0
+        for dx in ( -1, 0, 1 ):
+            for dy in ( -1, 0, 1 ):
+                if ( dx == 0 and dy == 0 ):
+                    continue
+                # cells active[ dst ] consider the owners of cells src
+                dst = np.flatnonzero( ( x + dx >= 0 ) & ( x + dx < W ) & ( y + dy >= 0 ) & ( y + dy < H ) )
+                src = active[ dst ] + dx * H + dy
+                valid = self.owner[ src ] >= 0
+                if ( dx != 0 and dy != 0 ):
+                    # the path can't cut the corner of a blocked cell
+                    valid &= ~blocked[ active[ dst ] + dx * H ] & ~blocked[ active[ dst ] + dy ]
+                dst = dst[ valid ]
+                src = src[ valid ]
+                candidate = self.owner[ src ]
+                aU = self.anchorU[ src ]
+                aV = self.anchorV[ src ]
+                cU = centerU[ dst ]
+                cV = centerV[ dst ]
+                # If the anchor isn't visible from the cell, the path bends at the center of the
+                #   source cell.  Only the lines whose bounding box contains blocked cells are
+                #   traced.
+                hidden = np.zeros( dst.size, dtype=np.bool )
+                if ( anyBlocked ):
+                    loU = np.clip( np.floor( np.minimum( aU, cU ) ), 0, W - 1 ).astype( np.int64 )
+                    hiU = np.clip( np.floor( np.maximum( aU, cU ) ), 0, W - 1 ).astype( np.int64 ) + 1
+                    loV = np.clip( np.floor( np.minimum( aV, cV ) ), 0, H - 1 ).astype( np.int64 )
+                    hiV = np.clip( np.floor( np.maximum( aV, cV ) ), 0, H - 1 ).astype( np.int64 ) + 1
+                    near = ( self.blockedSum[ hiU, hiV ] - self.blockedSum[ loU, hiV ] -
+                             self.blockedSum[ hiU, loV ] + self.blockedSum[ loU, loV ] ) > 0
+                    if ( near.any() ):
+                        hidden[ near ] = traceBlocked( self.blocked, self.blockedSum, aU[ near ], aV[ near ],
+                                                       cU[ near ], cV[ near ] )
+                newU = np.where( hidden, cU + dx, aU )
+                newV = np.where( hidden, cV + dy, aV )
+                newBase = np.where( hidden, self.dist[ src ], self.base[ src ] )
+                candDist = newBase + np.sqrt( ( ( cU - newU ) * grid.cellX ) ** 2 + ( ( cV - newV ) * grid.cellY ) ** 2 )
+                better = ( candDist <= grid.limit ) & ( ( candDist < dist[ dst ] ) |
+                                                        ( ( candDist == dist[ dst ] ) & ( candidate < owner[ dst ] ) ) )
+                dst = dst[ better ]
+                owner[ dst ] = candidate[ better ]
+                dist[ dst ] = candDist[ better ]
+                anchorU[ dst ] = newU[ better ]
+                anchorV[ dst ] = newV[ better ]
+                base[ dst ] = newBase[ better ]
+        changed = ( dist != self.dist[ active ] ) | ( owner != self.owner[ active ] )
+        active = active[ changed ]
+        self.owner[ active ] = owner[ changed ]
+        self.dist[ active ] = dist[ changed ]
+        self.anchorU[ active ] = anchorU[ changed ]
+        self.anchorV[ active ] = anchorV[ changed ]
+        self.base[ active ] = base[ changed ]
+        return active
+
+def sweepNearestSites( domain, sites, obstacles, voronoiLimit=-1 ):
+    '''Computes the nearest site to every cell center in the domain, where distance is the
+    length of the shortest path which avoids the obstacles.  The obstacles are rasterized
+    into blocked cells (see rasterizeObstacles) and the sites are seeded into their cells (see
+    SiteGrid).  Ownership is then propagated from cell to adjacent, unblocked cell, starting
+    from the seeded cells, until no cell changes (see GeodesicFront).  Each step of the
+    propagation is a whole-array operation over the cells adjacent to the cells which changed
+    in the previous step.  A region can only grow through unblocked cells, so no region leaks
+    through a wall.
+
+    Each cell records an anchor: the last point (the site or a cell center where the path
+    bends around an obstacle) on the path from its owner.  Its distance is the length of the
+    path to the anchor plus the straight line distance from the anchor to the cell's center.
+    A cell adopts its neighbor's anchor if the line from the anchor to the cell's center is
+    unblocked (see traceBlocked), otherwise, the path bends at the neighbor's center.  In the
+    absence of obstacles, the anchor is the site and the distance is euclidean.
+
+    If voronoiLimit is positive, the sites are snapped to the centers of the cells which
+    contain them (as in computeFiniteVoronoi), and no cell farther than voronoiLimit
+    from a site is owned.
+
+    @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                The computation is performed.
+    @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                in the 0th and 1st columns, respectively.
+    @param      obstacles       An iterable of polygons (such as an ObstacleSet).
+    @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                any site's voronoi region.  If negative, a site's region is
+                                unbounded.
+    @returns    A 2-tuple of numpy arrays, each with the domain's resolution, (owner, dist).
+                owner is an array of int32s, the index of the site which owns each cell (-1
+                for blocked cells and cells which are owned by no site).  dist is an array of
+                float64s, the distance from each cell center to its owning site.
+    '''
+    grid = SiteGrid( domain, sites, voronoiLimit )
+    blocked = rasterizeObstacles( grid.paddedDomain(), obstacles )
+    propagation = GeodesicFront( grid, blocked )
+    if ( grid.seedCell.size > 0 ):
+        propagation.run()
+    owner = propagation.owner.reshape( grid.W, grid.H )
+    dist = propagation.dist.reshape( grid.W, grid.H )
+    owner[ blocked ] = -1
+    dist[ blocked ] = np.inf
+    return grid.crop( owner ), grid.crop( dist )
+
+def computeConstrainedVoronoi( domain, sites, ids, obstacles, voronoiLimit=-1 ):
+    '''Computes the DISCRETE constrained voronoi diagram for the given sites over the given
+    domain.  A region cannot extend through an obstacle and the distance from a cell to a
+    site is the length of the shortest path around the obstacles (see sweepNearestSites).
+
+    Areas which belong to no one (including the cells blocked by obstacles) are given the
+    value -1.  Otherwise, the ownership is the same as the id in the data.
+
+    @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                The computation is performed.
+    @param      sites           An Nx2 numpy array of sites.  The x-/y-position of each site
+                                in the 0th and 1st columns, respectively.
+    @param      ids             A N-tuple-like instance of ints.  For each row in the sites,
+                                this tuple contains an int which is the sites id.
+    @param      obstacles       An instance of ObstacleSet (or any iterable of polygons).
+    @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                any site's voronoi region.  If negative, a site's region is
+                                unbounded.
+    @returns    An instance of DataGrid.  The discrete voronoi diagram.
+    '''
+    ownerGrid = domain.getDataGrid( -1, np.int32 )
+    owner, dist = sweepNearestSites( domain, sites[:, :2], obstacles, voronoiLimit )
+    owned = owner >= 0
+    idArray = np.array( [ ids[ i ] for i in xrange( len( sites ) ) ], dtype=np.int32 )
+    ownerGrid.cells[ owned ] = idArray[ owner[ owned ] ]
+    return ownerGrid
+
+def selectVoronoiEngine( domain, siteCount, voronoiLimit=-1 ):
+    '''Reports if the jump flooding engine (computeFloodVoronoi) is expected to be cheaper
+    than the per-site engines (computeFiniteVoronoi and computeInfiniteVoronoi).  The per-site
+    engines cost is proportional to the number of sites, the flooding engine's cost is
+    proportional to the number of cells in the domain.
+
+    @param      domain          An instance of AbstractGrid.  Defines the domain over which
+                                The computation is performed.
+    @param      siteCount       An int.  The number of sites.
+    @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
+                                any site's voronoi region.  If negative, a site's region is
+                                unbounded.
+    @returns    A boolean.  True if the jump flooding engine should be used.
+    '''
+    cellCount = domain.resolution[0] * domain.resolution[1]
+    if ( voronoiLimit > 0.0 ):
+        hCount = int( np.ceil( 2 * voronoiLimit / domain.cellSize[0] ) )
+        reach = int( np.ceil( voronoiLimit / min( domain.cellSize[0], domain.cellSize[1] ) ) ) + 1
+        siteCost = siteCount * ( STAMP_SITE_COST + hCount * hCount * STAMP_CELL_COST )
+    else:
+        reach = max( domain.resolution[0], domain.resolution[1] )
+        siteCost = siteCount * cellCount * BRUTE_CELL_COST
+    floodCost = len( floodSteps( reach ) ) * 8 * cellCount * FLOOD_CELL_COST
+    return floodCost < siteCost
+
 def computeVoronoi( domain, sites, ids, obstacles=None, voronoiLimit=-1 ):
     '''Computes the DISCRETE constrained voronoi diagram for the given sites over the given
     domain subject to the constraints imparted by the (optiona) obstacles.
@@ -144,24 +1058,55 @@ def computeVoronoi( domain, sites, ids, obstacles=None, voronoiLimit=-1 ):
                                 in the 0th and 1st columns, respectively.
     @param      ids             A N-tuple-like instance of ints.  For each row in the sites,
                                 this tuple contains an int which is the sites id.
-    @param      obstacles       An instance of ObstacleHandler.  The set of obstacles which
-                                satisfies visibility queries.
+    @param      obstacles       An instance of ObstacleSet (or any iterable of polygons).
+                                If given, the regions are constrained by the obstacles (see
+                                computeConstrainedVoronoi).
     @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
                                 any site's voronoi region.  If negative, a site's region is
                                 unbounded.
     @returns    An instance of DataGrid.  The discrete voronoi diagram.
     '''
-    if ( voronoiLimit > 0.0 ):
+    if ( obstacles is not None and len( obstacles ) > 0 ):
+        return computeConstrainedVoronoi( domain, sites, ids, obstacles, voronoiLimit )
+    elif ( selectVoronoiEngine( domain, len( sites ), voronoiLimit ) ):
+        return computeFloodVoronoi( domain, sites, ids, voronoiLimit )
+    elif ( voronoiLimit > 0.0 ):
         return computeFiniteVoronoi( domain, sites, ids, voronoiLimit, obstacles )
     else:
         return computeInfiniteVoronoi( domain, sites, ids, obstacles )
 
-def computeVoronoiDensity( domain, sites, ids, obstacles=None, voronoiLimit=-1 ):
+def regionLabels( owner, ids ):
+    '''Maps the ids in a voronoi diagram to the indices of the sites.
+
+    @param      owner       A numpy array of ints.  The id of the site owning each cell (-1 for
+                            cells which are owned by no site).
+    @param      ids         A numpy array of N ints.  The non-negative, unique site ids.
+    @returns    A numpy array of ints with the shape of owner.  The index of the site owning
+                each cell (N for cells which are owned by no site).
+    '''
+    N = ids.size
+    if ( N == 0 ):
+        return np.zeros( owner.shape, dtype=np.int64 )
+    maxId = int( max( ids.max(), owner.max() ) )
+    if ( maxId < LABEL_TABLE_SIZE ):
+        # the ids are small enough to be mapped through a table
+        table = np.empty( maxId + 2, dtype=np.int64 )
+        table.fill( N )
+        table[ ids + 1 ] = np.arange( N )
+        return table[ owner + 1 ]
+    order = np.argsort( ids )
+    label = np.minimum( np.searchsorted( ids[ order ], owner ), N - 1 )
+    found = ids[ order[ label ] ] == owner
+    return np.where( found, order[ label ], N )
+
+def computeVoronoiDensity( domain, sites, ids, obstacles=None, voronoiLimit=-1, incremental=None,
+                           agentDensity=False ):
     '''Computes the density of each site based on the inverse area of the voronoi region
     for that site.
 
-    Areas which belong to no one are given the value -1.  Otherwise, the ownership is
-    the same as the id in the data.
+    The area of every region is measured with a single histogram of the voronoi diagram and
+    the densities are mapped back onto the grid through a table, so the cost is independent
+    of the number of sites.  Areas which belong to no one have zero density.
 
     @param      domain          An instance of AbstractGrid.  Defines the domain over which
                                 The computation is performed.
@@ -169,26 +1114,38 @@ def computeVoronoiDensity( domain, sites, ids, obstacles=None, voronoiLimit=-1 )
                                 in the 0th and 1st columns, respectively.
     @param      ids             A N-tuple-like instance of ints.  For each row in the sites,
                                 this tuple contains an int which is the sites id.
-    @param      obstacles       An instance of ObstacleHandler.  The set of obstacles which
-                                satisfies visibility queries.
+    @param      obstacles       An instance of ObstacleSet (or any iterable of polygons).
+                                If given, the regions are constrained by the obstacles (see
+                                computeConstrainedVoronoi).
     @param      voronoiLimit    A float.  If non-negative, it defines the maximum extent of
                                 any site's voronoi region.  If negative, a site's region is
                                 unbounded.
-    @returns    An instance of DataGrid.  The discrete voronoi diagram.
+    @param      incremental     An instance of IncrementalVoronoi.  If given, the voronoi
+                                diagram is derived from the diagram of the previous frame it
+                                computed.
+    @param      agentDensity    A boolean.  If True, the density of each site is reported
+                                along with the density grid.
+    @returns    An instance of DataGrid.  The density grid.  If agentDensity is True, a
+                2-tuple ( densityGrid, density ), where density is a numpy array of N
+                float32s, the density of each site (zero for sites without a region).
     '''
     cellArea = domain.cellArea()
-    ownerGrid = computeVoronoi( domain, sites, ids, obstacles, voronoiLimit )
-    ownData = ownerGrid.cells
+    if ( incremental is None ):
+        ownerGrid = computeVoronoi( domain, sites, ids, obstacles, voronoiLimit )
+    else:
+        ownerGrid = incremental.computeVoronoi( domain, sites, ids, obstacles, voronoiLimit )
+    idArray = np.array( [ ids[ i ] for i in xrange( len( sites ) ) ], dtype=np.int64 )
+    N = idArray.size
     # now compute density
+    labels = regionLabels( ownerGrid.cells, idArray )
+    area = np.bincount( labels.ravel(), minlength=N + 1 )[ :N ] * cellArea
+    density = np.zeros( N + 1, dtype=np.float32 )
+    valid = area > 0.0001
+    density[ :N ][ valid ] = 1.0 / area[ valid ]
     densityGrid = domain.getDataGrid( 0.0, np.float32 )
-    rhoData = densityGrid.cells
-    for id in ids:
-        mask = ownData == id
-        area = np.sum( mask ) * cellArea
-        if ( area > 0.0001 ):
-            rhoData[ mask ] = 1.0 / area
-        else:
-            rhoData[ mask ] = 0.0
+    densityGrid.cells[ :, : ] = density[ labels ]
+    if ( agentDensity ):
+        return densityGrid, density[ :N ]
     return densityGrid
 
 ##class Voronoi:
@@ -398,6 +1355,8 @@ def main():
                        action='store', dest='obstXML', default=None )
     parser.add_option( '-d', '--density', help='Indicates that the voronoi density should be computed and not the voronoi diagram',
                        action='store_true', default=False, dest='density' )
+    parser.add_option( '-i', '--incremental', help='Indicates that the voronoi density of each frame should be derived from the previous frame (faster, but approximate)',
+                       action='store_true', default=False, dest='incremental' )
     options, args = parser.parse_args()
 
     if ( options.trajFileName == '' ):
@@ -445,7 +1404,7 @@ def main():
     if ( options.density ):
         print 'Computing density voronoi'
         gfs = GridFileSequence( os.path.join( folder, baseName ), obstacles, arrayType=np.float32 )
-        gfs.computeVoronoiDensity( voronoiDomain, pedData, obstacles )
+        gfs.computeVoronoiDensity( voronoiDomain, pedData, obstacles, incremental=options.incremental )
     else:
         print 'Computing normal voronoi'
         gfs = GridFileSequence( os.path.join( folder, baseName ), obstacles, arrayType=np.int32 )
@@ -5,7 +5,7 @@ import os
 from GLWidget import *
 import sys
 from analyzeWidgets import AnlaysisWidget, SystemResource
-from AnalysisTask import readAnalysisProject
+from AnalysisTask import readAnalysisProject, executeTasks
 from scb_qt_playback import PlayerController
 
 class ConsoleFile( QtCore.QObject ):
@@ -243,6 +243,10 @@ def main():
                        action='store', dest='projFile', default=None )
     parser.add_option( '-t', '--tasks', help='A list of task indices (starting at zero) to explicitly run.  Only works in conjunction with the --noGui flag.  This list replaces the active state indicated in the analysis configuration file',
                        action='callback', callback=taskListArg, dest='tasks', default=None )
+    parser.add_option( '-w', '--workers', help='The number of worker processes used to compute grid-based analyses.  Only works in conjunction with the --noGui flag.  The default is 1.',
+                       action='store', type='int', dest='workers', default=1 )
+    parser.add_option( '-c', '--cache', help='The maximum size (in MB) of the cache of computed results kept in each output folder.  Tasks whose inputs and parameters are unchanged reuse the cached results.  The cache is not aware of changes to the analysis code; clear it (delete the .resultCache folder) after updating.  Only works in conjunction with the --noGui flag.  The default is 0 (no cache).',
+                       action='store', type='int', dest='cacheSize', default=0 )
 
     options, args = parser.parse_args()
     
@@ -257,21 +261,23 @@ def main():
         # load tasks
         print "\tProject file:", options.projFile
         tasks = readAnalysisProject( options.projFile )
+        for task in tasks:
+            task.setWorkerCount( options.workers )
+            task.setCacheSize( options.cacheSize * 1024 ** 2 )
         # if tasks exists, reset activity
         if ( options.tasks ):
             print "\t\tExecuting user-specified tasks:", options.tasks
+            selected = []
             for taskID in options.tasks:
                 try:
-                    task = tasks[ taskID ]
+                    selected.append( tasks[ taskID ] )
                 except IndexError:
                     print "\t\t\tThe project file doesn't have task %d" % taskID
                     print '\t\t\t\tProject only has %d tasks.  Valid ids are in the range: [%d, %d].' % ( len( tasks ), -len( tasks ), len( tasks ) - 1 )
-                else:
-                    task.execute()
+            executeTasks( selected )
         else:
             print "\t\tExecuting active tasks in project file"
-            for task in tasks:
-                task.execute()
+            executeTasks( tasks )
     else:
         pygame.init()
         app = QtGui.QApplication( sys.argv )
@@ -15,7 +15,8 @@
 #           - it is the displacement vector from preferred velocity to actual velocity transformed by
 #            the same transformation which changes the preferred velocity to the vector <v_p, 0>, where the magnitude (v_p) is maintained
 #           QUESTION: 
-#           - the deviation is saved to a file: intermediate file path.deviation
+#           - the deviation is streamed, in blocks of frames, directly into the consistency computation
+#             (optionally, it is also saved to a file: intermediate file path.deviation)
 #           - there will be one R2 vector per agent per frame.
 #       2. Compute consistency
 #           - Consistency is the variance in the deviation over the given time window
@@ -43,11 +44,13 @@ VEL_X = 6
 VEL_Y = 7
 
 from trajectory.scbData import NPFrameSet
+import multiprocessing
 import numpy as np
 import os
 import struct
-from matplotlib import mlab
-import warnings
+
+# The number of agent values (frames x agents) processed together in a block
+BLOCK_SIZE = 1 << 18
 
 class DataReader:
     '''Base class for reading a data file based on frames of agent data'''
@@ -89,6 +92,21 @@ class DataReader:
         self.currIdx += 1
         return self.currFrame
 
+    def nextBlock( self, maxFrames ):
+        '''Reads the next block of frames.  Unlike next, the block is a new array.
+
+        @param      maxFrames       An int.  The maximum number of frames to read.
+        @returns    A K x N x F numpy array of float32s: K frames (K <= maxFrames) of N agents
+                    with F floats each.
+        @raises     StopIteration when there are no more frames.
+        '''
+        count = min( maxFrames, self.frameCount - self.currIdx )
+        if ( count <= 0 ):
+            raise StopIteration
+        s = self.file.read( count * self.frameSizeBytes )
+        self.currIdx += count
+        return np.fromstring( s, np.float32, count * self.frameSizeFloats ).reshape( count, self.agtCount, self.AGT_SIZE_FLOATS )
+
 class DataWriter:
     '''Base class for writing a data file based on frames of agent data'''
     def __init__( self, fileName ):
@@ -104,8 +122,14 @@ class DataWriter:
         self.file.close()
 
     def write( self, data ):
-        '''Writes the frame of deviation data'''
-        self.file.write( data.tostring() )    
+        '''Writes the frame (or block of frames) of data'''
+        self.file.write( data.tostring() )
+
+    def reserve( self, byteCount ):
+        '''Extends the file by the given number of bytes.  The reserved frames can then be
+        written in any order (e.g., through memory maps by several processes).'''
+        self.file.seek( 0, os.SEEK_END )
+        self.file.truncate( self.file.tell() + byteCount )
 
 
 # consistency correlation
@@ -195,6 +219,116 @@ def consistencyFile( config ):
         os.makedirs( outPath )
     return os.path.join( outPath, config[ 'tempName' ] + '.consistency' )
 
+def windowConsistency( sums, sumSq, T, invalid=None ):
+    '''Computes the consistency of every agent from the moments of its deviations over a window
+    of frames.  The principal components of each agent's deviations are the eigenvectors of the
+    2 x 2 covariance of the deviations, which are computed in closed form for all agents at once.
+
+    @param      sums        An N x 2 numpy array.  The sum of each agent's deviations.
+    @param      sumSq       An N x 3 numpy array.  The sums of the products of each agent's
+                            deviations: xx, yy and xy.
+    @param      T           An int.  The number of frames in the window.
+    @param      invalid     An N numpy array of ints (optional).  The number of frames in each
+                            agent's window whose deviation isn't finite (e.g., the agent had no
+                            preferred speed).  Those frames must be left out of the sums.
+    @returns    An N x 6 numpy array of float32s.  The consistency of each agent (see the
+                consistency file format).  The first axis is scaled by the fourth root of its
+                variance (times T), the second likewise.  An agent without variance has no
+                principal axes; its values are not a number.  An agent with invalid frames
+                in its window has no consistency; all of its values are not a number.
+    '''
+    mean = sums / T
+    # the entries of the (unnormalized) covariance matrix [ [ a, b ], [ b, c ] ]
+    a = sumSq[ :, 0 ] - sums[ :, 0 ] * mean[ :, 0 ]
+    c = sumSq[ :, 1 ] - sums[ :, 1 ] * mean[ :, 1 ]
+    b = sumSq[ :, 2 ] - sums[ :, 0 ] * mean[ :, 1 ]
+    half = 0.5 * ( a + c )
+    delta = np.sqrt( ( 0.5 * ( a - c ) ) ** 2 + b * b )
+    var0 = np.maximum( half + delta, 0.0 )
+    var1 = np.maximum( half - delta, 0.0 )
+    # the first eigenvector lies at this angle; the second is perpendicular to it
+    theta = 0.5 * np.arctan2( 2.0 * b, a - c )
+    cos = np.cos( theta )
+    sin = np.sin( theta )
+    scale0 = var0 ** 0.25
+    scale1 = var1 ** 0.25
+    consistency = np.empty( ( sums.shape[0], 6 ), dtype=np.float32 )
+    consistency[ :, 0 ] = scale0 * cos
+    consistency[ :, 1 ] = scale0 * sin
+    consistency[ :, 2 ] = -scale1 * sin
+    consistency[ :, 3 ] = scale1 * cos
+    total = var0 + var1
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        consistency[ :, 4 ] = var0 / total
+        consistency[ :, 5 ] = var1 / total
+    noVar = total <= 0
+    consistency[ noVar, :4 ] = np.nan
+    if ( invalid is not None ):
+        consistency[ invalid > 0, : ] = np.nan
+    return consistency
+
+class WindowMoments:
+    '''The sums and second moments of the deviations of every agent over a sliding window of
+    frames, computed for a block of frames at a time.  The moments of all windows in a block
+    are differences of running sums, so the cost of each frame is independent of the window
+    size.  The last T - 1 frames of each block are kept so the windows span the blocks.
+
+    A deviation which isn't finite (an agent without preferred speed) is left out of the sums
+    and counted instead; only the windows which contain it lose their consistency.'''
+    def __init__( self, agtCount, T ):
+        '''Constructor.
+
+        @param      agtCount        An int.  The number of agents, N.
+        @param      T               An int.  The number of frames in the window.
+        '''
+        self.T = T
+        self.carry = np.zeros( ( 0, agtCount, 2 ), dtype=np.float64 )
+
+    def add( self, deviations ):
+        '''Adds a block of frames of deviations and computes the consistency of the windows
+        which end in the block.
+
+        @param      deviations      A K x N x 2 numpy array.  The deviation of each agent in K
+                                    consecutive frames.
+        @returns    A K' x N x 6 numpy array of float32s.  The consistency (see windowConsistency)
+                    of each window ending in the block.
+        '''
+        data = np.concatenate( ( self.carry, deviations ) )
+        self.carry = data[ max( 0, data.shape[0] - ( self.T - 1 ) ): ]
+        agtCount = data.shape[1]
+        windows = data.shape[0] - self.T + 1
+        if ( windows <= 0 ):
+            return np.empty( ( 0, agtCount, 6 ), dtype=np.float32 )
+        invalid = ~np.isfinite( data ).all( axis=2 )
+        x = np.where( invalid, 0.0, data[ :, :, 0 ] )
+        y = np.where( invalid, 0.0, data[ :, :, 1 ] )
+        # the moments and, last, the number of invalid frames
+        moments = np.empty( ( data.shape[0], agtCount, 6 ), dtype=np.float64 )
+        moments[ :, :, 0 ] = x
+        moments[ :, :, 1 ] = y
+        moments[ :, :, 2 ] = x * x
+        moments[ :, :, 3 ] = y * y
+        moments[ :, :, 4 ] = x * y
+        moments[ :, :, 5 ] = invalid
+        total = np.zeros( ( data.shape[0] + 1, agtCount, 6 ), dtype=np.float64 )
+        np.cumsum( moments, axis=0, out=total[ 1: ] )
+        window = total[ self.T: ] - total[ :windows ]
+        consistency = windowConsistency( window[ :, :, :2 ].reshape( -1, 2 ), window[ :, :, 2:5 ].reshape( -1, 3 ),
+                                         self.T, np.rint( window[ :, :, 5 ] ).reshape( -1 ) )
+        return consistency.reshape( windows, agtCount, 6 )
+
+def checkWindow( T, frameCount ):
+    '''Validates the consistency window size.
+
+    @param      T               An int.  The window size (in frames).
+    @param      frameCount      An int.  The number of frames of deviation.
+    @raises     ValueError if the window is invalid.
+    '''
+    if ( T % 2 != 1 or T <= 0 ):
+        raise ValueError( "The window size for consistency calculation must be positive and odd.  Given %d." % T )
+    if ( T > frameCount ):
+        raise ValueError( "The consistency window size is larger than the number of frames: T = %d, frame count = %d" % ( T, frameCount) )
+
 def computeConsistency( config ):
     '''Computes the consistency, assuming that the deviation has already been computed'''
     try:
@@ -203,10 +337,7 @@ def computeConsistency( config ):
         raise IOError( "Unable to load the deviation file for computing consistency" )
 
     T = int( config[ 'consistencyWindow' ] )
-    if ( T % 2 != 1 and T <= 0 ):
-        raise ValueError( "The window size for consistency calculation must be positive and odd.  Given %d." % T )
-    if ( T > devFile.frameCount ):
-        raise ValueError( "The consistency window size is larger than the number of frames: T = %d, frame count = %d" % ( T, devFile.frameCount) )
+    checkWindow( T, devFile.frameCount )
 
     conFile = ConsistencyWriter( consistencyFile( config ) )    
     conFile.setWindowSize( T )
@@ -216,47 +347,17 @@ def computeConsistency( config ):
     print "\tWindow:", T
     print "\tTotal frames:", devFile.frameCount
     print "\tTotal agents:", devFile.agtCount
-    deviations = np.zeros( ( devFile.agtCount, 2, T ), dtype=np.float32 )
-    print "\tLoading %d deviations:" % ( T )
-    for t in xrange( T ):
-        # no need to put this in a try block, because I know that I will be able to read all of these.
-        deviations[ :, :, t ] = devFile.next()
-        print "\t\t", deviations[:,:,t]
-
-    replaceID = 0
-    consistency = np.zeros( ( devFile.agtCount, 6 ), dtype=np.float32 )
+    moments = WindowMoments( devFile.agtCount, T )
+    blockFrames = max( 1, BLOCK_SIZE / max( 1, devFile.agtCount ) )
     print "\tComputing consistency"
     count = 0
     while ( True ):
-        # The PCA class performs the mean for me -- in fact, I can't stop it.
-        #   So, although I'm sure it would be cheaper to compute the mean myself in one huge
-        #   block, I can't stop PCA from doing so.
-        # NOTE: Not currently using PCA because I can't figure out what the damn AXES are
-        mean = deviations.mean( axis=2 )
-        print "\t\tMean:", mean
-        mean.shape = ( -1, 2, 1 )
-        centered = deviations - mean
-        for a in xrange( devFile.agtCount ):
-##            p = mlab.PCA( centered[ a, :, : ].T )
-##            print p.Wt
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                components, trace, fracVar = mlab.prepca( centered[ a, :, : ].T )
-                sig2 = np.sqrt( np.sum( components ** 2, axis=1 ) )
-                sig = np.sqrt( sig2 )
-                a0 = components[0] / sig[0]
-                a1 = components[1] / sig[1]
-                consistency[ a, :2 ] = a0
-                consistency[ a, 2:4 ] = a1
-                consistency[ a, 4: ] = fracVar
-        conFile.write( consistency )
-        count += 1
         try:
-            deviations[ :, :, replaceID ] = devFile.next()
+            consistency = moments.add( devFile.nextBlock( blockFrames ) )
         except StopIteration:
             break
-        else:
-            replaceID = ( replaceID + 1 ) % T
+        conFile.write( consistency )
+        count += consistency.shape[0]
     conFile.setFrameCount( count )
     conFile.close()
         
@@ -324,52 +425,161 @@ def deviationFile( config ):
         os.makedirs( outPath )
     return os.path.join( outPath, config[ 'tempName' ] + '.deviation' )
 
+def frameDeviation( frames ):
+    '''Computes the deviation of every agent in a block of frames.
+
+    @param      frames      A K x N x 8 numpy array.  K frames of N agents in the scb 2.2 format.
+    @returns    A K x N x 2 numpy array of float32s.  The deviation of each agent in each frame.
+    '''
+    prefVel = frames[ :, :, VPREF_X:VEL_X ]
+    displacement = frames[ :, :, VEL_X:VEL_Y + 1 ] - prefVel
+    # transform deviation
+    prefSpeed = np.sqrt( prefVel[ :, :, :1 ] ** 2 + prefVel[ :, :, 1: ] ** 2 )
+    # without a preferred speed, the deviation is not a number (see WindowMoments)
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        xform = prefVel / prefSpeed
+    deviation = np.empty( frames.shape[ :2 ] + ( 2, ), dtype=np.float32 )
+    deviation[ :, :, 0 ] = displacement[ :, :, 0 ] * xform[ :, :, 0 ] + displacement[ :, :, 1 ] * xform[ :, :, 1 ]
+    deviation[ :, :, 1 ] = displacement[ :, :, 1 ] * xform[ :, :, 0 ] - displacement[ :, :, 0 ] * xform[ :, :, 1 ]
+    return deviation
+
 def computeDeviation( scbData, config ):
     '''Given a set of scbData and a config file, computes the deviation and caches it in an intermediate file'''
     file = DeviationWriter( deviationFile( config ) )
-        
-    scbData.setNext( 0 )    # don't assume I'm at the beginning
 
     agtCount = scbData.agentCount()
+    frameCount = scbData.totalFrames()
     file.setAgentCount( agtCount )
-    # pre-allocate arrays to save time
-    displacement = np.zeros( (agtCount,2), dtype=np.float32 )
-    prefSpeed = np.zeros( (agtCount, 1), dtype=np.float32 )
-    xform = np.zeros( (agtCount, 2), dtype=np.float32 )
-    deviation = np.zeros( (agtCount, 2), dtype=np.float32 )
-    frameCount = 0
     print "\nDEVIATION"
     print "\t%d agents:" % agtCount
-    while ( True ):
-        try:
-            frame, idx = scbData.next()
-        except StopIteration:
-            break
-        displacement[:,:] = frame[:, VEL_X:] - frame[:, VPREF_X:VEL_X]
-        # transform deviation
-        prefSpeed[:] = np.sqrt( frame[:,VPREF_X:VPREF_Y] ** 2 + frame[:,VPREF_Y:VEL_X] ** 2 )
-        xform[:,:] = frame[:, VPREF_X:VEL_X ] / prefSpeed
-        deviation[:,0] = displacement[:,0] * xform[:,0] + displacement[:,1] * xform[:,1]
-        deviation[:,1] = displacement[:,1] * xform[:,0] - displacement[:,0] * xform[:,1]
-        file.write( deviation )
-        print '\t',deviation
-        frameCount += 1
+    blockFrames = max( 1, BLOCK_SIZE / max( 1, agtCount ) )
+    for start in xrange( 0, frameCount, blockFrames ):
+        file.write( frameDeviation( scbData.frames[ start:min( start + blockFrames, frameCount ) ] ) )
     file.setFrameCount( frameCount )
     file.close()
 
+# streaming consistency
+#   The deviation and the consistency of an agent depend on no other agent.  So, the agents
+#   can be partitioned and each partition streamed through the deviation and consistency
+#   computations in blocks of frames, independently.  The output files are reserved up front
+#   and each partition writes its agents' columns of each block through a memory map, so the
+#   partitions can be processed in separate processes.
+
+def agentPartitions( agtCount, partCount ):
+    '''Partitions the agents into contiguous ranges of (nearly) equal size.
+
+    @param      agtCount        An int.  The number of agents.
+    @param      partCount       An int.  The number of partitions.
+    @returns    A list of 2-tuples of ints: ( first agent, last agent + 1 ).
+    '''
+    partCount = max( 1, min( partCount, agtCount ) )
+    bounds = [ ( agtCount * i ) / partCount for i in xrange( partCount + 1 ) ]
+    return zip( bounds[ :-1 ], bounds[ 1: ] )
+
+def streamPartition( frameSet, agents, T, conName, devName=None ):
+    '''Computes the deviation and consistency of a range of agents and writes them into
+    the reserved output files (see streamConsistency).
+
+    @param      frameSet        An instance of NPFrameSet.
+    @param      agents          A 2-tuple of ints.  The range of agents: [ first, last + 1 ).
+    @param      T               An int.  The consistency window size (in frames).
+    @param      conName         A string.  The name of the consistency file.
+    @param      devName         A string.  The name of the deviation file, or None if the
+                                deviation isn't written.
+    '''
+    first, last = agents
+    agtCount = frameSet.agentCount()
+    frameCount = frameSet.totalFrames()
+    consistency = np.memmap( conName, dtype=np.float32, mode='r+', offset=ConsistencyReader.HEADER_SIZE,
+                             shape=( frameCount - T + 1, agtCount, 6 ) )
+    deviation = None
+    if ( devName ):
+        deviation = np.memmap( devName, dtype=np.float32, mode='r+', offset=DeviationReader.HEADER_SIZE,
+                               shape=( frameCount, agtCount, 2 ) )
+    moments = WindowMoments( last - first, T )
+    blockFrames = max( 1, BLOCK_SIZE / max( 1, last - first ) )
+    written = 0
+    for start in xrange( 0, frameCount, blockFrames ):
+        stop = min( start + blockFrames, frameCount )
+        dev = frameDeviation( frameSet.frames[ start:stop, first:last ] )
+        if ( deviation is not None ):
+            deviation[ start:stop, first:last ] = dev
+        con = moments.add( dev )
+        consistency[ written:written + con.shape[0], first:last ] = con
+        written += con.shape[0]
+    consistency.flush()
+    if ( deviation is not None ):
+        deviation.flush()
+
+def processPartition( args ):
+    '''The body of a worker process: streams one partition of the agents.
+
+    @param      args        A tuple.  The arguments to open the worker's NPFrameSet, followed
+                            by the remaining arguments of streamPartition.
+    '''
+    openArgs, agents, T, conName, devName = args
+    frameSet = NPFrameSet( *openArgs )
+    streamPartition( frameSet, agents, T, conName, devName )
+    frameSet.close()
+
+def streamConsistency( scbData, config, workerCount=1, keepDeviation=False ):
+    '''Computes the consistency directly from the scb data in a single pass, without an
+    intermediate deviation file.
+
+    @param      scbData         An instance of NPFrameSet with scb 2.2 data.
+    @param      config          The analysis configuration.
+    @param      workerCount     An int.  The number of processes among which the agents are
+                                partitioned.
+    @param      keepDeviation   A boolean.  If True, the deviation file is written as well.
+    '''
+    T = int( config[ 'consistencyWindow' ] )
+    agtCount = scbData.agentCount()
+    frameCount = scbData.totalFrames()
+    checkWindow( T, frameCount )
+
+    print "\nCONSISTENCY"
+    print "\tWindow:", T
+    print "\tTotal frames:", frameCount
+    print "\tTotal agents:", agtCount
+    conName = consistencyFile( config )
+    conFile = ConsistencyWriter( conName )
+    conFile.setWindowSize( T )
+    conFile.setAgentCount( agtCount )
+    conFile.setFrameCount( frameCount - T + 1 )
+    conFile.reserve( ( frameCount - T + 1 ) * agtCount * ConsistencyReader.AGT_SIZE_BYTES )
+    conFile.close()
+    devName = None
+    if ( keepDeviation ):
+        devName = deviationFile( config )
+        devFile = DeviationWriter( devName )
+        devFile.setAgentCount( agtCount )
+        devFile.setFrameCount( frameCount )
+        devFile.reserve( frameCount * agtCount * DeviationReader.AGT_SIZE_BYTES )
+        devFile.close()
+
+    partitions = agentPartitions( agtCount, workerCount )
+    if ( len( partitions ) == 1 ):
+        streamPartition( scbData, partitions[0], T, conName, devName )
+    else:
+        print "\tComputing in %d processes" % len( partitions )
+        work = [ ( scbData.openArgs, agents, T, conName, devName ) for agents in partitions ]
+        pool = multiprocessing.Pool( len( partitions ) )
+        try:
+            pool.map( processPartition, work )
+        finally:
+            pool.close()
+            pool.join()
 
-def processConsistency( config, scbFile=None ):
+def processConsistency( config, scbFile=None, workerCount=1 ):
     '''Performs the work of deviation from data in the config file, with an optional
-    override on the scbFile to process'''
+    override on the scbFile to process.  The agents are divided among workerCount processes.'''
     
     if ( scbFile == None ):
         scbFile = config[ 'SCB' ]
         
     # TODO: ultimately extract start, max frames, max agents, target agent, frame sample from config
     try:
-        # TODO: for testing purposes, I've got these arguments to facilitate testing
-##        data = NPFrameSet( scbFile )
-        data = NPFrameSet( scbFile, startFrame=5, maxFrames=15, maxAgents=1 )
+        data = NPFrameSet( scbFile )
     except IOError:
         raise IOError( 'No such scb file: %s' % ( scbFile ) )
     except:
@@ -381,10 +591,8 @@ def processConsistency( config, scbFile=None ):
     print "SCB file: ", scbFile
     print "\tNumber of agents:", data.agentCount()
 
-    # compute the deviation, producing a .deviation file
-    computeDeviation( data, config )
-    # compute the consistency, producing a .consistency file
-    computeConsistency( config )
+    # compute the deviation and the consistency in one pass, producing a .consistency file
+    streamConsistency( data, config, workerCount )
     # compute correlation between density and consistency
     correlateConsistency( config )
 
@@ -398,6 +606,8 @@ def main():
                        action='store', dest='configFileName', default='' )
     parser.add_option( '-s', '--scbFile', help='The scb file to analyze (if not specified, the scb file in the config file is processed)',
                        action='store', dest='scbFileName', default=None )
+    parser.add_option( '-w', '--workers', help='The number of processes among which the agents are divided (default is 1)',
+                       action='store', dest='workerCount', type='int', default=1 )
     options, args = parser.parse_args()
 
     if ( options.configFileName == '' ):
@@ -422,7 +632,7 @@ def main():
     if ( config == None ):
         sys.exit(1)
 
-    processConsistency( config, options.scbFileName )
+    processConsistency( config, options.scbFileName, options.workerCount )
 ##    try:
 ##        processConsistency( config, options.scbFileName )
 ##    except Exception as inst:
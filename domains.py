@@ -127,6 +127,36 @@ class RectDomain:
         
         return reflection
 
+    def reflectPoints( self, points ):
+        '''Given points INSIDE the domain, returns their reflections over all domain boundaries.
+
+            It is the caller's responsibility to only call this function on points that are KNOWN
+            to be inside the domain.  Otherwise, the reflection values will not be meaningful.
+
+        @param      points      An Nx2 numpy array of floats.  The x- and y-values of the N points
+                                in world space.
+        @returns    A 4 x N x 2 numpy array of float32.  reflection[ i ] is the reflection of all
+                    points over the left, right, bottom and top boundaries for i = 0, 1, 2, 3,
+                    respectively.
+        '''
+        reflection = np.empty( ( 4, points.shape[0], 2 ), dtype=np.float32 )
+        l = self.minCorner[0]
+        b = self.minCorner[1]
+        r = l + self.size[0]
+        t = b + self.size[1]
+
+        reflection[ :, :, : ] = points[ :, :2 ]
+        # left
+        reflection[ 0, :, 0 ] = 2 * l - points[ :, 0 ]
+        # right
+        reflection[ 1, :, 0 ] = 2 * r - points[ :, 0 ]
+        # bottom
+        reflection[ 2, :, 1 ] = 2 * b - points[ :, 1 ]
+        # top
+        reflection[ 3, :, 1 ] = 2 * t - points[ :, 1 ]
+
+        return reflection
+
     def intersection( self, domain ):
         '''Computes the intersection of two domains and reports it as a domain.minCorner
 
@@ -1,10 +1,11 @@
 import pygame as pg
 import numpy as np
 from primitives import Vector2
-from GFSVis import drawObstacles, drawSites
+from GFSVis import drawObstacles, drawObstaclesNP, drawSites, drawSitesNP, PYGAME_BACKEND, NUMPY_BACKEND, IMAGE_BACKENDS
+import PNGWriter
 import os
 
-def drawVoronoi( dataGrid, fileName, sites=None, obstacles=None ):
+def drawVoronoi( dataGrid, fileName, sites=None, obstacles=None, backend=PYGAME_BACKEND ):
     '''Creates an image of the voronoi diagram, optionally drawing sites
     and obstacles as provided.
 
@@ -17,6 +18,8 @@ def drawVoronoi( dataGrid, fileName, sites=None, obstacles=None ):
                             If provided, dots are drawn, otherwise, no sites.
     @param      obstacles   An instance of ObstacleSet.  If provided, obstacles
                             will be drawn over the top of the voronoi diagram.
+    @param      backend     A string.  The image output backend (see GFSVis.IMAGE_BACKENDS).
+                            The numpy backend only writes png images.
     '''
     COLORS = np.array( ( (255, 0 ,0),
                          (127, 0, 0 ),
@@ -31,7 +34,6 @@ def drawVoronoi( dataGrid, fileName, sites=None, obstacles=None ):
                          (255, 255, 255) ),
                        dtype=np.uint8 )
     BG_COLOR = np.array( (0,0,0), dtype=np.uint8 )
-    OBST_COLOR = np.array( (255,255,255), dtype=np.uint8 )
     OBST_WIDTH = 1
     def imgSpace( point, grid ):
         '''Given a grid and a point in world space, returns the grid cell value.'''
@@ -45,16 +47,24 @@ def drawVoronoi( dataGrid, fileName, sites=None, obstacles=None ):
     color[~bg, : ] = COLORS[ indices[~bg] ]
     color[ bg, : ] = BG_COLOR
 
+    if ( backend == NUMPY_BACKEND ):
+        pixels = color[:, ::-1, : ]
+        if ( not sites is None ):
+            drawSitesNP( sites, pixels, dataGrid )
+        if ( not obstacles is None ):
+            drawObstaclesNP( obstacles, pixels, dataGrid )
+        PNGWriter.writePNG( fileName, pixels )
+        return
+
     surf = pg.surfarray.make_surface( color[:, ::-1, : ] )
     if ( not sites is None ):
         drawSites( sites, surf, dataGrid )
             
     if ( not obstacles is None ):
-        for obst in obstacles.polys:
-                drawObstacle( obst, surf, dataGrid )
+        drawObstacles( obstacles, surf, dataGrid )
     pg.image.save( surf, fileName )
 
-def drawVoronoiSeries( gfsData, outBaseName, trajData=None, obstacles=None, ext='png' ):
+def drawVoronoiSeries( gfsData, outBaseName, trajData=None, obstacles=None, ext='png', backend=PYGAME_BACKEND ):
     '''Given a GridFileSequence of voronoi diagrams, draws the sequence.
 
     @param      gfsData         An instance of GridFileSequenceReader.
@@ -67,8 +77,10 @@ def drawVoronoiSeries( gfsData, outBaseName, trajData=None, obstacles=None, ext=
     @param      obstacles       An instance of ObstacleSet.  If provided, obstacles will be
                                 drawn over the top of the voronoi diagram and sites.
     @param      ext             A string.  The file type to save the files as.
+    @param      backend         A string.  The image output backend (see GFSVis.IMAGE_BACKENDS).
     '''
-    pg.init()
+    if ( backend == PYGAME_BACKEND ):
+        pg.init()
 
     # make sure the path exists
     path, name = os.path.split( outBaseName )
@@ -88,7 +100,7 @@ def drawVoronoiSeries( gfsData, outBaseName, trajData=None, obstacles=None, ext=
                 break
         fileName = '{0}{1:0{2}d}.{3}'.format( outBaseName, gridID, digits, ext )
         try:
-            drawVoronoi( grid, fileName, frame, obstacles )
+            drawVoronoi( grid, fileName, frame, obstacles, backend )
         except MemoryError:
             print "Error on frame", i
             raise
@@ -112,6 +124,8 @@ if __name__ == '__main__':
                            action='store', dest='ext', default='png' )
         parser.add_option( '-b', '--obstacles', help='(Optional) Path to an obstacle xml file.  If provided, they will be drawn on top of the voronoi.',
                            action='store', dest='obstXML', default=None )
+        parser.add_option( '-k', '--backend', help='The image output backend: %s (default is pygame).  The numpy backend only writes png images.' % ( ', '.join( IMAGE_BACKENDS ) ),
+                           action='store', dest='backend', default=PYGAME_BACKEND )
         options, args = parser.parse_args()
 
         if ( options.gfsName == '' ):
@@ -124,6 +138,12 @@ if __name__ == '__main__':
             parser.print_help()
             sys.exit(1)
 
+        if ( not options.backend in IMAGE_BACKENDS or
+             ( options.backend == NUMPY_BACKEND and options.ext.lower() != 'png' ) ):
+            print '\n *** You have selected an invalid image backend: %s' % ( options.backend )
+            parser.print_help()
+            sys.exit(1)
+
         folder, baseName = os.path.split( options.output )
         if ( folder ):
             if ( not os.path.exists( folder ) ):
@@ -143,7 +163,7 @@ if __name__ == '__main__':
         if ( options.obstXML ):
             obstacles, bb = obstacles.readObstacles( options.obstXML )
 
-        drawVoronoiSeries( reader, options.output, trajData, obstacles )
+        drawVoronoiSeries( reader, options.output, trajData, obstacles, options.ext, options.backend )
         
     main()    
     
\ No newline at end of file
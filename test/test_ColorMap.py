@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+import pygame
+
+import ColorMap as dut
+
+
+def allMaps(dataRange=None):
+    '''An instance of every color map.'''
+    return [dut.GreyScaleMap(dataRange), dut.BlackBodyMap(dataRange=dataRange),
+            dut.FlameMap(dataRange), dut.StephenBlackBodyMap(dataRange=dataRange),
+            dut.LogBlackBodyMap(dataRange=dataRange),
+            dut.BandedBlackBodyMap(dataRange=dataRange), dut.RedBlueMap(dataRange),
+            dut.TwoToneHSVMap(dataRange=dataRange)]
+
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(2)
+        self.data = np.random.uniform(0.0, 10.0, (13, 17)).astype(np.float32)
+        # values below the range are background (their log is still defined)
+        self.data[:3, :4] = -0.0005
+
+    def test_backends(self):
+        '''Both backends color every map identically and record the same range.'''
+        for dataRange in (None, [1.0, 8.0]):
+            for surfaceMap, arrayMap in zip(allMaps(dataRange), allMaps(dataRange)):
+                surface = surfaceMap.colorOnSurface((0.0, 10.0), self.data)
+                pixels = arrayMap.colorArray((0.0, 10.0), self.data)
+                self.assertTrue(np.array_equal(pygame.surfarray.array3d(surface), pixels),
+                                surfaceMap.__class__.__name__)
+                self.assertEqual(list(surfaceMap.dataRange), list(arrayMap.dataRange))
+
+    def test_transforms(self):
+        '''The log map colors the log of the data and Stephen's map clamps the range.'''
+        logData = np.log(self.data + 0.001)
+        logRange = (np.log(0.001), np.log(10.001))
+        logMap = dut.LogBlackBodyMap()
+        expected = dut.BlackBodyMap().colorArray(logRange, logData)
+        self.assertTrue(np.array_equal(logMap.colorArray((0.0, 10.0), self.data), expected))
+        self.assertEqual(logMap.dataRange, [0.0, 10.0])
+        stephenMap = dut.StephenBlackBodyMap(6.0)
+        expected = dut.BlackBodyMap().colorArray((0.0, 6.0), self.data)
+        self.assertTrue(np.array_equal(stephenMap.colorArray((0.0, 10.0), self.data), expected))
+        self.assertEqual(stephenMap.dataRange, [0.0, 6.0])
+
+    def test_lazyFont(self):
+        '''Coloring data doesn't initialize pygame's fonts; drawing the bar does.'''
+        pygame.font.quit()
+        dut.ColorMap.FONT = None
+        cMap = dut.BlackBodyMap()
+        cMap.colorArray((0.0, 10.0), self.data)
+        self.assertFalse(pygame.font.get_init())
+        cMap.lastMapBar(7)
+        self.assertTrue(pygame.font.get_init())
+
+
+if __name__ == '__main__':
+    unittest.main()
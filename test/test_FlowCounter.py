@@ -0,0 +1,129 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+# Signals and GridFileSequence import each other; Signals must be imported first.
+import Signals
+import Crowd as dut
+from primitives import Segment, Vector2
+from trajectory.scbData import NPFrameSet, writeNPSCB
+
+
+def countCrossings(positions, segments):
+    '''Counts the agents crossing each segment, one displacement at a time.
+
+    @param      positions   A K x N x 2 numpy array.  The position of each agent in each frame.
+    @param      segments    A list of M Segment instances.
+    @returns    A (K - 1) x M numpy array of ints.  The number of agents who have crossed each
+                segment by the end of each displacement.
+    '''
+    counts = np.zeros((positions.shape[0] - 1, len(segments)), dtype=np.int32)
+    crossed = set()
+    for f in range(positions.shape[0] - 1):
+        for a in range(positions.shape[1]):
+            (x0, y0), (x1, y1) = positions[f, a], positions[f + 1, a]
+            for s, seg in enumerate(segments):
+                dx, dy = seg.p2.x - seg.p1.x, seg.p2.y - seg.p1.y
+                length = np.hypot(dx, dy)
+                dx, dy = dx / length, dy / length
+                # signed distances from the line; positive is to the left of the segment
+                d0 = dx * (y0 - seg.p1.y) - dy * (x0 - seg.p1.x)
+                d1 = dx * (y1 - seg.p1.y) - dy * (x1 - seg.p1.x)
+                if not (d0 < 0 and d1 >= 0) or (a, s) in crossed:
+                    continue
+                u = d0 / (d0 - d1)
+                t = (x0 + u * (x1 - x0) - seg.p1.x) * dx + (y0 + u * (y1 - y0) - seg.p1.y) * dy
+                if 0 <= t <= length:
+                    crossed.add((a, s))
+        for a, s in crossed:
+            counts[f, s] += 1
+    return counts
+
+
+class TestFlowCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.blockSize = dut.FLOW_BLOCK_SIZE
+        np.random.seed(8)
+        # agents wandering about the segments cross them back and forth (or never)
+        self.K = 40
+        data = np.random.uniform(-3.0, 3.0, (9, 3, 1)) + np.random.normal(0.0, 0.6, (9, 3, self.K)).cumsum(axis=2)
+        data = data.astype(np.float32)
+        self.positions = data[:, :2, :].transpose(2, 0, 1).astype(np.float64)
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, data, None)
+        self.segments = [Segment(Vector2(-2.0, 0.0), Vector2(2.0, 0.0)),
+                         Segment(Vector2(1.0, 2.0), Vector2(0.0, -2.0))]
+        self.outName = os.path.join(self.folder, 'flow')
+
+    def tearDown(self):
+        dut.FLOW_BLOCK_SIZE = self.blockSize
+        shutil.rmtree(self.folder)
+
+    def test_crossings(self):
+        '''The counts don't depend on the block size, even when a crossing straddles blocks.'''
+        expected = countCrossings(self.positions, self.segments)
+        # some agents cross each segment, and some never do
+        self.assertTrue(0 < expected[-1].min() and expected[-1].max() < 9)
+        agentLines = 9 * len(self.segments)
+        # blocks of one, two and seven frames, and a single block
+        for blockFrames in (1, 2, 7, self.K):
+            dut.FLOW_BLOCK_SIZE = blockFrames * agentLines
+            dut.computeFlow(NPFrameSet(self.scbName), self.segments, self.outName)
+            names, data = dut.readFlow(self.outName)
+            self.assertEqual(names, ['Line 0', 'Line 1'])
+            # a row per displacement, following the row of the first frame
+            self.assertEqual(list(data[:, 0]), range(self.K))
+            self.assertTrue(np.array_equal(data[0, 1:], [0, 0]))
+            self.assertTrue(np.array_equal(data[1:, 1:], expected), blockFrames)
+
+    def test_readFlow(self):
+        '''The names and counts are read back from either format.'''
+        dut.computeFlow(NPFrameSet(self.scbName), self.segments, self.outName,
+                        ['North', 'South east'])
+        names, data = dut.readFlow(self.outName)
+        self.assertEqual(names, ['North', 'South east'])
+        self.assertEqual(data.dtype, np.int32)
+        # the older text format: a commented header of the names, joined by ~
+        oldName = os.path.join(self.folder, 'old')
+        with open(oldName + '.flow', 'w') as f:
+            f.write('# North~South east\n')
+            np.savetxt(f, data, fmt='%d')
+        oldNames, oldData = dut.readFlow(oldName)
+        self.assertEqual(oldNames, names)
+        self.assertTrue(np.array_equal(oldData, data))
+
+
+class TestNPYHeader(unittest.TestCase):
+
+    def test_header(self):
+        '''The header has a fixed size and is read by numpy.'''
+        folder = tempfile.mkdtemp()
+        try:
+            fileName = os.path.join(folder, 'data.npy')
+            data = np.arange(12, dtype=np.int32).reshape(4, 3)
+            with open(fileName, 'wb') as f:
+                dut.writeNPYHeader(f, np.int32, (0, 3))
+                self.assertEqual(f.tell(), dut.NPY_HEADER_SIZE)
+                f.write(data.tostring())
+                f.seek(0)
+                dut.writeNPYHeader(f, np.int32, data.shape)
+                self.assertEqual(f.tell(), dut.NPY_HEADER_SIZE)
+            self.assertTrue(np.array_equal(np.load(fileName), data))
+            with open(fileName, 'wb') as f:
+                self.assertRaises(ValueError, dut.writeNPYHeader, f, np.int32, (1,) * 40)
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+# Signals and GridFileSequence import each other; Signals must be imported first.
+import Signals
+import Crowd as dut
+from domains import RectDomain
+from trajectory.scbData import NPFrameSet, writeNPSCB
+
+
+def regionFundDiag(positions, rect, density, timeStep):
+    '''The fundamental diagram of a single region, computed agent by agent and frame by frame
+    (as each region was computed on its own).
+
+    @param      positions   A K x N x 2 numpy array.  The position of each agent in each frame.
+    @param      rect        An instance of RectDomain.
+    @param      density     A numpy array of K floats.  The density of the region in each frame.
+    @param      timeStep    A float.  The duration of a frame.
+    @returns    An L x 2 numpy array.  The density and speed of each agent with an interval.
+    '''
+    N = positions.shape[1]
+    intervals = np.zeros((N, 2), dtype=np.int)
+    distances = np.zeros(N)
+    entered = {}
+    for idx in range(positions.shape[0]):
+        for a in range(N):
+            p = positions[idx, a]
+            if rect.pointInside(p):
+                if a not in entered:
+                    entered[a] = (idx, p)
+            elif a in entered:
+                enter, enterPt = entered.pop(a)
+                if idx - enter > intervals[a, 1]:
+                    intervals[a] = (enter, idx - enter)
+                    distances[a] = np.sqrt(np.sum((p - enterPt) ** 2))
+    valid = intervals[:, 1] > 0
+    speeds = distances[valid] / (intervals[valid, 1] * timeStep)
+    densities = [np.mean(density[start:start + length]) for start, length in intervals[valid]]
+    return np.column_stack((densities, speeds))
+
+
+class TestFundDiag(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        np.random.seed(6)
+        # agents wandering in and out of the regions, several times
+        K = 60
+        data = np.random.uniform(2.0, 8.0, (15, 3, 1)) + np.random.normal(0.0, 0.4, (15, 3, K)).cumsum(axis=2)
+        data = data.astype(np.float32)
+        self.positions = data[:, :2, :].transpose(2, 0, 1)
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, data, None)
+        # overlapping regions, with corners exactly representable as float32
+        self.rects = [RectDomain((2.0, 2.5), (4.0, 3.5)), RectDomain((4.5, 3.0), (2.5, 4.0))]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_regions(self):
+        '''Each region's diagram matches the diagram computed for the region on its own.'''
+        outName = os.path.join(self.folder, 'fd')
+        frameSet = NPFrameSet(self.scbName)
+        dut.computeFundDiag(frameSet, self.rects, outName)
+        for i, rect in enumerate(self.rects):
+            inside = [[rect.pointInside(p) for p in frame] for frame in self.positions]
+            density = np.sum(inside, axis=1) / float(rect.area)
+            expected = regionFundDiag(self.positions, rect, density, frameSet.simStepSize)
+            self.assertTrue(len(expected) > 5)
+            data = np.load(outName + '_Region_%d.npy' % i)
+            self.assertEqual(data.shape, expected.shape)
+            self.assertTrue(np.allclose(data, expected, rtol=1e-5, atol=1e-6))
+
+    def test_intervalDensity(self):
+        '''The mean density over each interval matches the mean of the interval's frames.'''
+        density = np.random.uniform(0.0, 4.0, 30)
+        intervals = np.array([[0, 30], [4, 1], [7, 0], [12, 9], [29, 1]])
+        densities = dut.calcIntervalDensityRegion(intervals, density)
+        for (start, length), value in zip(intervals, densities):
+            if length > 0:
+                self.assertAlmostEqual(value, np.mean(density[start:start + length]), 5)
+            else:
+                self.assertEqual(value, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
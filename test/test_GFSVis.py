@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+# Signals and GridFileSequence import each other; Signals must be imported first.
+import Signals
+import GridFileSequence as GFS
+import ColorMap
+import GFSVis as dut
+from Grid import makeDomain
+from primitives import Vector2
+from test_GridFileSequence import writeSequence
+
+
+class TestVisualizeGFS(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        domain = makeDomain(Vector2(0.0, 2.0), Vector2(0.0, 3.0), 0.5)
+        grids = [np.full(domain.resolution, i * 0.5, dtype=np.float32) for i in range(6)]
+        self.fileName = writeSequence(self.folder, domain, np.float32, grids)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def export(self, name, workerCount):
+        '''Exports the sequence's images and returns the content of its color bar.'''
+        outFileBase = os.path.join(self.folder, name, 'img')
+        reader = GFS.GridFileSequenceReader(self.fileName)
+        dut.visualizeGFS(reader, ColorMap.BlackBodyMap(), outFileBase, 'png',
+                         workerCount=workerCount, backend=dut.NUMPY_BACKEND)
+        reader.close()
+        with open(outFileBase + 'bar.png', 'rb') as f:
+            return f.read()
+
+    def test_parallelBar(self):
+        '''The color bar of a parallel export spans the range of the data.'''
+        serial = self.export('serial', 1)
+        self.assertEqual(serial, self.export('parallel', 2))
+        cMap = ColorMap.BlackBodyMap()
+        dut.saveMapBar(cMap, os.path.join(self.folder, 'default.png'), dut.NUMPY_BACKEND)
+        with open(os.path.join(self.folder, 'default.png'), 'rb') as f:
+            self.assertNotEqual(serial, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+# Signals and GridFileSequence import each other; Signals must be imported first.
+import Signals
+import GridFileSequence as dut
+import GFSCompression
+import Kernels
+import RegionRaster
+from FramePass import consumeFrames
+from Grid import makeDomain
+from primitives import Vector2
+from trajectory.scbData import NPFrameSet, writeNPSCB
+from test_RegionRaster import Region
+
+
+def writeSequence(folder, domain, arrayType, grids, compression=None):
+    '''Writes the grids to a sequence in the folder.'''
+    gfs = dut.GridFileSequence(os.path.join(folder, 'seq'), arrayType=arrayType,
+                               compression=compression)
+    fileName = gfs.outFileName + '.test'
+    outFile = gfs.openGrids(fileName, domain.minCorner, domain.size, domain.resolution)
+    for grid in grids:
+        outFile.write(grid.astype(arrayType).tostring())
+    gfs.fillInHeader(outFile, len(grids), np.min(grids), np.max(grids))
+    outFile.close()
+    return fileName
+
+
+class TestGridFileSequenceReader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.domain = makeDomain(Vector2(0.0, 2.0), Vector2(0.0, 3.0), 0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writeSequence(self, arrayType, count):
+        '''Writes a sequence whose grid i has the value i in every cell.'''
+        grids = [np.full(self.domain.resolution, i, dtype=arrayType) for i in range(count)]
+        return writeSequence(self.folder, self.domain, arrayType, grids)
+
+    def test_types(self):
+        '''Grids of every type are read with their own size.'''
+        for arrayType in (np.float32, np.float64, np.int8, np.int32):
+            reader = dut.GridFileSequenceReader(self.writeSequence(arrayType, 5))
+            self.assertEqual(reader.gridSize(), 4 * 6 * np.dtype(arrayType).itemsize)
+            self.assertEqual([int(g.cells[0, 0]) for g, i in reader], range(5))
+            self.assertEqual(reader.currGrid.cells.dtype, arrayType)
+            reader.close()
+
+    def test_access(self):
+        '''Grids are accessed with respect to the starting grid and the stride.'''
+        fileName = self.writeSequence(np.float32, 10)
+        reader = dut.GridFileSequenceReader(fileName, startGrid=1, maxGrids=3, gridStep=3)
+        self.assertEqual(reader.gridCount(), 3)
+        self.assertEqual([(int(g.cells[0, 0]), i) for g, i in reader], [(1, 0), (4, 1), (7, 2)])
+        self.assertEqual(reader.getGrid(2).cells[1, 1], 7)
+        self.assertRaises(IndexError, reader.getGrid, 3)
+        block = reader.gridRange(1)
+        self.assertEqual(block.shape, (2, 4, 6))
+        self.assertEqual(list(block[:, 0, 0]), [4, 7])
+        reader = dut.GridFileSequenceReader(fileName, maxGrids=20)
+        self.assertEqual(reader.gridCount(), 10)
+
+    def test_prefetch(self):
+        '''Prefetching doesn't change the grids.'''
+        reader = dut.GridFileSequenceReader(self.writeSequence(np.float32, 10), prefetch=3)
+        self.assertEqual([int(g.cells[0, 0]) for g, i in reader], range(10))
+        reader.setNext(4)
+        self.assertEqual(reader.next()[1], 4)
+        reader.close()
+
+    def test_stats(self):
+        '''The grid statistics come from the statistics file, or the grids if it is missing.'''
+        fileName = self.writeSequence(np.float32, 10)
+        reader = dut.GridFileSequenceReader(fileName, startGrid=1, gridStep=2)
+        stats = reader.getStats()
+        self.assertEqual(list(stats['max']), [1, 3, 5, 7, 9])
+        self.assertEqual(list(stats['sum']), [24 * i for i in (1, 3, 5, 7, 9)])
+        self.assertEqual(stats['nonzero'][0], 24)
+        self.assertEqual(reader.peakGrid(), 4)
+        log = dut.RasterReport()
+        for i in range(10):
+            log.recordGrid(9 - i, (0.0, 1.0 + i, 1.0, 24.0, 24))
+        dut.GridFileSequence(fileName).writeStats(fileName, log.statsTable())
+        reader = dut.GridFileSequenceReader(fileName, startGrid=1, gridStep=2)
+        self.assertEqual(list(reader.getStats()['max']), [9, 7, 5, 3, 1])
+        self.assertEqual(reader.peakGrid(), 0)
+
+    def test_dataRange(self):
+        '''The range of the accessible grids comes from the statistics file; without it, the
+        header's range of every grid is used.'''
+        fileName = self.writeSequence(np.float32, 10)
+        reader = dut.GridFileSequenceReader(fileName, startGrid=1, maxGrids=3, gridStep=3)
+        self.assertEqual(reader.dataRange(), (0.0, 9.0))
+        self.assertEqual(reader.stats, None)
+        log = dut.RasterReport()
+        for i in range(10):
+            log.recordGrid(i, (-float(i), 2.0 * i, 1.0, 24.0, 24))
+        dut.GridFileSequence(fileName).writeStats(fileName, log.statsTable())
+        reader = dut.GridFileSequenceReader(fileName, startGrid=1, maxGrids=3, gridStep=3)
+        self.assertEqual(reader.dataRange(), (-7.0, 14.0))
+
+
+class TestCompressedGridFileSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.domain = makeDomain(Vector2(0.0, 20.0), Vector2(0.0, 10.0), 0.5)
+        np.random.seed(3)
+        # mostly empty grids
+        self.grids = np.random.uniform(0.0, 4.0, (7, 40, 20)).astype(np.float32)
+        self.grids[self.grids < 3.5] = 0.0
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, compression):
+        return writeSequence(self.folder, self.domain, np.float32, self.grids, compression)
+
+    def test_lossless(self):
+        '''Native storage reproduces the grids exactly, in any block size.'''
+        for blockSize in (1, 3):
+            compression = GFSCompression.GridCompression(blockSize=blockSize)
+            fileName = self.write(compression)
+            self.assertTrue(os.path.getsize(fileName) < self.grids.nbytes / 2)
+            reader = dut.GridFileSequenceReader(fileName, gridStep=2)
+            self.assertEqual(reader.gridCount(), 4)
+            self.assertEqual(reader.range, (0.0, self.grids.max()))
+            self.assertTrue(np.array_equal(reader.gridRange(), self.grids[::2]))
+            self.assertTrue(np.array_equal(reader.getGrid(3).cells, self.grids[6]))
+            self.assertEqual([i for g, i in reader], range(4))
+            reader.close()
+
+    def test_lossy(self):
+        '''Half precision and quantized storage approximate the grids.'''
+        for storage, tolerance in (('float16', 2e-3), ('quantized', 4.0 / 65535)):
+            compression = GFSCompression.GridCompression(storage=storage, blockSize=2)
+            reader = dut.GridFileSequenceReader(self.write(compression))
+            self.assertTrue(np.allclose(reader.gridRange(), self.grids, rtol=0, atol=tolerance))
+            reader.close()
+
+    def test_convert(self):
+        '''A sequence converted to the compressed format and back is unchanged.'''
+        fileName = self.write(None)
+        compressed = os.path.join(self.folder, 'seq.z')
+        restored = os.path.join(self.folder, 'seq.raw')
+        GFSCompression.convertGridFile(fileName, compressed, GFSCompression.GridCompression())
+        GFSCompression.convertGridFile(compressed, restored)
+        self.assertEqual(open(fileName, 'rb').read(), open(restored, 'rb').read())
+
+
+class TestSharedPass(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.domain = makeDomain(Vector2(0.0, 10.0), Vector2(0.0, 10.0), 0.5)
+        np.random.seed(4)
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, np.random.uniform(0.0, 10.0, (20, 3, 12)).astype(np.float32), None)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_consumers(self):
+        '''Grids computed in a shared pass match the grids computed on their own.'''
+        kernel = Kernels.GaussianKernel(1.0, 0.5, False)
+        signal = Signals.PedestrianSignal(makeDomain(Vector2(0.0, 10.0), Vector2(0.0, 10.0)))
+        alone = dut.GridFileSequence(os.path.join(self.folder, 'alone'))
+        density = alone.convolveSignal(self.domain, kernel, signal, NPFrameSet(self.scbName))
+        stats, speed = alone.computeSpeeds(self.domain, NPFrameSet(self.scbName), 10.0)
+        frameSet = NPFrameSet(self.scbName)
+        shared = dut.GridFileSequence(os.path.join(self.folder, 'shared'))
+        consumers = [shared.convolveConsumer(self.domain, kernel, signal),
+                     shared.speedConsumer(self.domain, frameSet, 10.0)]
+        self.assertEqual(consumeFrames(frameSet, consumers), 12)
+        for fileName, consumer in ((density, consumers[0]), (speed, consumers[1])):
+            self.assertEqual(open(fileName, 'rb').read(), open(consumer.fileName, 'rb').read())
+        self.assertEqual(dut.GridFileSequenceReader(consumers[1].fileName).gridCount(), 11)
+
+    def test_noSpeeds(self):
+        '''Too few frames for the time window produce no speed file.'''
+        gfs = dut.GridFileSequence(os.path.join(self.folder, 'short'))
+        result = gfs.computeSpeeds(self.domain, NPFrameSet(self.scbName), 10.0, timeWindow=12)
+        self.assertEqual(result, None)
+        self.assertFalse(os.path.exists(gfs.outFileName + '.speed'))
+
+    def test_regionSpeed(self):
+        '''The region speeds computed from the scb data match the speeds computed agent by
+        agent, frame by frame.'''
+        regions = [Region((0.0, 0.0), (8.0, 1.0), (2.0, 7.0)),
+                   Region((0.0, 0.0), (6.0, 0.0), (6.0, 6.0), (0.0, 6.0))]
+        gfs = dut.GridFileSequence(os.path.join(self.folder, 'region'))
+        gfs.computeRegionSpeed(NPFrameSet(self.scbName), regions, 0.1, ())
+        speeds = np.loadtxt(gfs.outFileName + '.region')
+        frames = NPFrameSet(self.scbName).frames[:, :, :2].astype(np.float64)
+        expected = np.zeros((frames.shape[0] - 1, len(regions)))
+        for f in range(expected.shape[0]):
+            counts = np.zeros(len(regions))
+            for a in range(frames.shape[1]):
+                p1, p2 = frames[f, a], frames[f + 1, a]
+                region = RegionRaster.polygonsContaining(p2[np.newaxis], regions)[0]
+                if region >= 0:
+                    expected[f, region] += np.sqrt(np.sum((p2 - p1) ** 2)) / 0.1
+                    counts[region] += 1
+            expected[f, counts > 0] /= counts[counts > 0]
+        self.assertTrue(np.all(expected > 0))
+        self.assertTrue(np.allclose(speeds, expected, atol=1e-4))
+
+    def test_unsupportedSpeed(self):
+        '''Speed types other than blitting are rejected before any frame is consumed.'''
+        gfs = dut.GridFileSequence(os.path.join(self.folder, 'gauss'))
+        for speedType in (dut.GridFileSequence.NORM_SPEED, dut.GridFileSequence.LAPLACE_SPEED):
+            self.assertRaises(ValueError, gfs.speedConsumer, self.domain,
+                              NPFrameSet(self.scbName), 10.0, speedType=speedType)
+
+
+def failingProducer(log, buffer, frameLock, frames, failAt, domain):
+    '''A rasterization thread which fails after taking the grid failAt.'''
+    while True:
+        with frameLock:
+            if not frames:
+                break
+            index = frames.pop(0)
+        if index == failAt:
+            raise ValueError('no grid %d' % index)
+        log.incCount()
+        buffer.put(index, domain.getDataGrid())
+
+
+class TestThreadWork(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.domain = makeDomain(Vector2(0.0, 2.0), Vector2(0.0, 2.0), 0.5)
+        self.threadCount = dut.THREAD_COUNT
+        self.capacity = dut.BUFFER_CAPACITY
+
+    def tearDown(self):
+        dut.THREAD_COUNT = self.threadCount
+        dut.BUFFER_CAPACITY = self.capacity
+        shutil.rmtree(self.folder)
+
+    def test_failedThread(self):
+        '''A failed thread is an error, whether or not the buffer fills.'''
+        dut.THREAD_COUNT = 3
+        gfs = dut.GridFileSequence(os.path.join(self.folder, 'seq'))
+        for capacity in (2, 100):
+            dut.BUFFER_CAPACITY = capacity
+            frames = range(40)
+            args = lambda: (frames, 5, self.domain)
+            self.assertRaises(RuntimeError, gfs._threadWork, 'test', failingProducer, args,
+                              self.domain)
+
+    def test_allGrids(self):
+        '''Without failures, every grid is written.'''
+        dut.THREAD_COUNT = 3
+        dut.BUFFER_CAPACITY = 2
+        gfs = dut.GridFileSequence(os.path.join(self.folder, 'seq'))
+        frames = range(40)
+        fileName = gfs._threadWork('test', failingProducer, lambda: (frames, -1, self.domain),
+                                   self.domain)
+        self.assertEqual(dut.GridFileSequenceReader(fileName).gridCount(), 40)
+
+
+def crashRaster(frameSet, index):
+    '''A work function whose worker dies without reporting.'''
+    os._exit(3)
+
+
+def failRaster(frameSet, index):
+    '''A work function which raises in its worker.'''
+    raise ValueError('no grid for frame %d' % index)
+
+
+class TestProcessWork(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.domain = makeDomain(Vector2(0.0, 10.0), Vector2(0.0, 10.0), 0.5)
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, np.zeros((5, 3, 4), dtype=np.float32), None)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_deadWorker(self):
+        '''A worker which dies without reporting is an error, not a hang.'''
+        outFile = open(os.path.join(self.folder, 'out'), 'wb')
+        self.assertRaises(RuntimeError, dut.processWork, outFile, crashRaster, (),
+                          NPFrameSet(self.scbName), self.domain, 2, dut.RasterReport())
+        outFile.close()
+
+    def test_failedWorker(self):
+        '''A worker's exception is reported to the parent with its traceback.'''
+        outFile = open(os.path.join(self.folder, 'out'), 'wb')
+        try:
+            dut.processWork(outFile, failRaster, (), NPFrameSet(self.scbName), self.domain, 2,
+                            dut.RasterReport())
+        except RuntimeError as e:
+            self.assertTrue('ValueError: no grid for frame' in str(e))
+        else:
+            self.fail('RuntimeError not raised')
+        outFile.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
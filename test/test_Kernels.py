@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+import Signals
+import Kernels as dut
+from Grid import makeDomain
+from primitives import Vector2
+
+
+class TestDiracConvolution(unittest.TestCase):
+
+    def setUp(self):
+        # The impulses deliberately include points near and beyond every boundary of the
+        # domain so the clipped (and reflected) kernels are exercised.
+        np.random.seed(17)
+        self.impulses = np.random.uniform(-1.5, 11.5, (300, 2)).astype(np.float32)
+        self.domain = makeDomain(Vector2(0.0, 10.0), Vector2(0.0, 8.0), 0.2)
+        self.sigDomain = makeDomain(Vector2(0.0, 10.0), Vector2(0.0, 8.0))
+
+    def convolve(self, kernel):
+        '''Convolves the impulses with the kernel using both the vectorized and the reference
+        implementations and returns the two grids.'''
+        signal = Signals.DiracSignal(self.sigDomain, self.impulses)
+        fast = self.domain.getDataGrid(0.0)
+        kernel.convolveDirac(signal, fast)
+        slow = self.domain.getDataGrid(0.0)
+        kernel.convolveDiracReference(signal, slow)
+        return fast, slow
+
+    def assertSameGrid(self, fast, slow):
+        self.assertEqual(fast.cells.shape, slow.cells.shape)
+        self.assertTrue(np.allclose(fast.cells, slow.cells, rtol=1e-4, atol=1e-5))
+
+    def test_separable(self):
+        '''The batched splat matches the per-impulse splat for a separable kernel.'''
+        for reflect in (False, True):
+            fast, slow = self.convolve(dut.GaussianKernel(0.5, 0.2, reflect))
+            self.assertSameGrid(fast, slow)
+
+    def test_inseparable(self):
+        '''The batched splat matches the per-impulse splat for an inseparable kernel.'''
+        fast, slow = self.convolve(dut.UniformCircleKernel(0.7, 0.2, False))
+        self.assertSameGrid(fast, slow)
+
+    def test_uniform(self):
+        '''The uniform kernel's constant-valued splat matches its reference.'''
+        fast, slow = self.convolve(dut.UniformKernel(1.0, 0.2, True))
+        self.assertSameGrid(fast, slow)
+
+    def test_coincident(self):
+        '''Impulses which share a cell are each counted.'''
+        self.impulses = np.concatenate((self.impulses, self.impulses[:50], self.impulses[:10]))
+        fast, slow = self.convolve(dut.GaussianKernel(0.5, 0.2, False))
+        self.assertSameGrid(fast, slow)
+
+    def test_methods(self):
+        '''Every dirac convolution method matches the per-impulse splat.'''
+        methods = {dut.KernelBase.DIRAC_SCATTER: (dut.GaussianKernel(0.5, 0.2, True),
+                                                  dut.UniformCircleKernel(0.7, 0.2, False),
+                                                  dut.UniformKernel(1.0, 0.2, False)),
+                   dut.KernelBase.DIRAC_FFT: (dut.GaussianKernel(0.5, 0.2, True),
+                                              dut.UniformCircleKernel(0.7, 0.2, False),
+                                              dut.UniformKernel(1.0, 0.2, False)),
+                   dut.KernelBase.DIRAC_SEPARABLE: (dut.GaussianKernel(0.5, 0.2, True),
+                                                    dut.TriangleKernel(0.6, 0.2, False),
+                                                    dut.UniformKernel(1.0, 0.2, True))}
+        for method, kernels in methods.items():
+            for kernel in kernels:
+                kernel.diracMethod = method
+                fast, slow = self.convolve(kernel)
+                self.assertSameGrid(fast, slow)
+
+    def test_inseparable_method(self):
+        '''An inseparable kernel can't be forced to use the separable method.'''
+        kernel = dut.UniformCircleKernel(0.7, 0.2, False)
+        kernel.diracMethod = dut.KernelBase.DIRAC_SEPARABLE
+        self.assertRaises(dut.KernelImplementationError, self.convolve, kernel)
+
+    def test_select_method(self):
+        '''Sparse impulses are scattered, dense impulses on large grids are convolved.'''
+        kernel = dut.GaussianKernel(0.5, 0.2, False)
+        shape = kernel.data.shape
+        self.assertEqual(kernel.selectDiracMethod(5, shape, (400, 400), True),
+                         dut.KernelBase.DIRAC_SCATTER)
+        self.assertNotEqual(kernel.selectDiracMethod(20000, shape, (400, 400), True),
+                            dut.KernelBase.DIRAC_SCATTER)
+        self.assertEqual(kernel.selectDiracMethod(20000, shape, (400, 400), False),
+                         dut.KernelBase.DIRAC_FFT)
+
+
+if __name__ == '__main__':
+    unittest.main()
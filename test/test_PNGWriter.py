@@ -0,0 +1,59 @@
+import os
+import struct
+import sys
+import unittest
+import zlib
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+import PNGWriter as dut
+
+
+def decodePNG(data):
+    '''Decodes a PNG with 8-bit channels and "none" or "up" row filters.'''
+    assert data[:8] == dut.PNG_SIGNATURE
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        chunkType = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(chunkType + body) & 0xFFFFFFFF
+        chunks[chunkType] = chunks.get(chunkType, '') + body
+        pos += 12 + length
+    W, H, depth, colorType = struct.unpack('>IIBB', chunks['IHDR'][:10])
+    C = {0: 1, 2: 3, 6: 4}[colorType]
+    raw = np.frombuffer(zlib.decompress(chunks['IDAT']), np.uint8).reshape(H, W * C + 1)
+    rows = raw[:, 1:].copy()
+    for y in range(1, H):
+        if raw[y, 0] == dut.FILTER_UP:
+            rows[y] += rows[y - 1]
+    return rows.reshape(H, W, C).swapaxes(0, 1)
+
+
+class TestPNGWriter(unittest.TestCase):
+
+    def test_roundtrip(self):
+        '''Grey, RGB and RGBA images decode to the encoded pixels.'''
+        np.random.seed(2)
+        for shape in ((7, 5), (7, 5, 3), (3, 4, 4), (1, 1, 3)):
+            pixels = np.random.randint(0, 256, shape).astype(np.uint8)
+            for level in (dut.FAST_LEVEL, dut.DEFAULT_LEVEL):
+                decoded = decodePNG(dut.encodePNG(pixels, level))
+                self.assertTrue(np.array_equal(decoded.reshape(shape), pixels))
+        pixels = np.zeros((4, 4, 3), dtype=np.uint8)
+        decoded = decodePNG(dut.encodePNG(pixels, rowFilter=dut.FILTER_NONE))
+        self.assertTrue(np.array_equal(decoded, pixels))
+
+    def test_invalid(self):
+        '''Images without 1, 3 or 4 channels are rejected.'''
+        self.assertRaises(ValueError, dut.encodePNG, np.zeros((4, 4, 2), dtype=np.uint8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+# Signals and GridFileSequence import each other; Signals must be imported first.
+import Signals
+import Crowd as dut
+from domains import RectDomain
+from trajectory.scbData import NPFrameSet, writeNPSCB
+
+
+def trackFrames(positions, rect):
+    '''Tracks the agents in and out of the region one agent and one frame at a time.
+
+    @param      positions   A K x N x 2 numpy array.  The position of each agent in each frame.
+    @param      rect        An instance of RectDomain.
+    @returns    A 3-tuple ( longest, distances, intervals ).  longest is an N x 2 numpy array of
+                the entrance frame and duration of each agent's longest interval and distances
+                the distance traveled over it.  intervals is a list of every interval
+                ( agent, enter, duration, distance ), in the order in which the agents left.
+    '''
+    N = positions.shape[1]
+    longest = np.zeros((N, 2), dtype=np.int)
+    distances = np.zeros(N)
+    intervals = []
+    entered = {}
+    for idx in range(positions.shape[0]):
+        for a in range(N):
+            p = positions[idx, a]
+            if rect.pointInside(p):
+                if a not in entered:
+                    entered[a] = (idx, p)
+            elif a in entered:
+                enter, enterPt = entered.pop(a)
+                distance = np.sqrt(np.sum((p - enterPt) ** 2))
+                intervals.append((a, enter, idx - enter, distance))
+                if idx - enter > longest[a, 1]:
+                    longest[a] = (enter, idx - enter)
+                    distances[a] = distance
+    return longest, distances, intervals
+
+
+class TestRegionDwell(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        np.random.seed(12)
+        # agents wandering in and out of the region, several times
+        K = 80
+        data = np.random.uniform(2.0, 8.0, (12, 3, 1)) + np.random.normal(0.0, 0.3, (12, 3, K)).cumsum(axis=2)
+        data = data.astype(np.float32)
+        self.positions = data[:, :2, :].transpose(2, 0, 1)
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, data, None)
+        # the corners are exactly representable as float32
+        self.rect = RectDomain((3.0, 2.5), (4.0, 3.5))
+        self.expected = trackFrames(self.positions, self.rect)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_framesInRegion(self):
+        '''Each agent's longest interval matches the interval tracked frame by frame.'''
+        longest, distances, intervals = self.expected
+        # several agents visit the region more than once
+        visits = np.bincount([i[0] for i in intervals])
+        self.assertTrue(np.count_nonzero(visits > 1) > 2)
+        result, resultDist = dut.framesInRegion(self.rect, NPFrameSet(self.scbName))
+        self.assertTrue(np.array_equal(result, longest))
+        valid = longest[:, 1] > 0
+        self.assertTrue(np.allclose(resultDist[valid], distances[valid], rtol=1e-5))
+
+    def test_intervalsInRegion(self):
+        '''Every interval, including the repeated visits, is recorded in the order of exit.'''
+        intervals = self.expected[2]
+        result = dut.intervalsInRegion(self.rect, NPFrameSet(self.scbName))
+        self.assertEqual(len(result), len(intervals))
+        self.assertEqual(len(set(result['agent'])), len(set(i[0] for i in intervals)))
+        self.assertTrue(np.all(result['region'] == 0))
+        for record, (agent, enter, duration, distance) in zip(result, intervals):
+            self.assertEqual((record['agent'], record['enter'], record['duration']),
+                             (agent, enter, duration))
+            self.assertAlmostEqual(record['distance'], distance, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+from primitives import Vector2
+import RegionRaster as dut
+
+
+class Region:
+    '''A closed polygon with the vertex list of ObjSlice.Polygon.'''
+    def __init__(self, *vertices):
+        self.vertices = [Vector2(x, y) for x, y in vertices]
+        self.closed = True
+
+
+class TestRegionRaster(unittest.TestCase):
+
+    def setUp(self):
+        # a triangle overlapping a square; the overlap belongs to the triangle
+        self.regions = [Region((0.0, 0.0), (4.0, 1.0), (1.0, 3.0)),
+                        Region((0.0, 0.0), (3.0, 0.0), (3.0, 3.0), (0.0, 3.0))]
+
+    def test_assign(self):
+        '''Raster labels agree with the exact polygon test.'''
+        np.random.seed(4)
+        points = np.random.uniform(-1, 5, (5000, 2))
+        for resolution in (4, 16, 64):
+            raster = dut.RegionRaster(self.regions, resolution)
+            exact = dut.polygonsContaining(points, self.regions)
+            self.assertTrue(np.array_equal(raster.assign(points), exact))
+        self.assertEqual(set(exact), set([dut.NO_REGION, 0, 1]))
+
+    def test_speeds(self):
+        '''Speeds are averaged over the agents ending the window in each region.'''
+        counter = dut.RegionSpeedCounter(dut.RegionRaster(self.regions), 0.5)
+        f1 = np.array([[1.0, 0.5, 0], [0.5, 2.0, 0], [2.5, 0.2, 0], [9.0, 9.0, 0]], dtype=np.float32)
+        f2 = f1 + np.array([[0.0, 0.5, 0], [0.0, 0.5, 0], [0.0, 1.0, 0], [1.0, 0.0, 0]], dtype=np.float32)
+        counter.Y_COL = 1
+        counter.STATE_COL = None
+        speeds = counter.frameSpeeds(f1, f2)
+        self.assertTrue(np.allclose(speeds, [1.5, 1.0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import ResultCache as dut
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data):
+        fileName = os.path.join(self.folder, name)
+        f = open(fileName, 'wb')
+        f.write(data)
+        f.close()
+        return fileName
+
+    def test_fetch(self):
+        '''Stored results are restored to other files; unknown keys aren't found.'''
+        cache = dut.ResultCache(os.path.join(self.folder, 'cache'))
+        key = dut.makeKey('DENSITY', (0.0, 10.0), 0.25)
+        cache.store(key, [self.write('a.density', 'grids'), self.write('a.stats', 'stats')])
+        targets = [os.path.join(self.folder, name) for name in ('b.density', 'b.stats')]
+        self.assertFalse(cache.fetch(dut.makeKey('DENSITY', (0.0, 10.0), 0.5), targets))
+        self.assertTrue(cache.fetch(key, targets))
+        self.assertEqual([open(t, 'rb').read() for t in targets], ['grids', 'stats'])
+        # results with missing files aren't stored
+        cache.store('missing', [os.path.join(self.folder, 'none')])
+        self.assertEqual(len(cache.entries()), 1)
+
+    def test_evict(self):
+        '''The least recently used results are discarded to stay within the size.'''
+        cache = dut.ResultCache(os.path.join(self.folder, 'cache'), maxSize=25)
+        for key in ('a', 'b'):
+            cache.store(key, [self.write(key, key * 10)])
+        os.utime(cache.entryPath('a'), (0, 0))
+        os.utime(cache.entryPath('b'), (100, 100))
+        cache.fetch('a', [os.path.join(self.folder, 'c')])
+        cache.store('d', [self.write('d', 'd' * 10)])
+        self.assertFalse(os.path.exists(cache.entryPath('b')))
+        self.assertTrue(os.path.exists(cache.entryPath('a')))
+        self.assertTrue(os.path.exists(cache.entryPath('d')))
+
+    def test_identity(self):
+        '''A file's identity changes with its contents.'''
+        fileName = self.write('data.scb', 'abc')
+        identity = dut.fileIdentity(fileName)
+        self.assertEqual(identity, dut.fileIdentity(fileName))
+        self.write('data.scb', 'abd')
+        self.assertNotEqual(identity, dut.fileIdentity(fileName))
+        self.assertEqual(dut.fileIdentity(os.path.join(self.folder, 'none')), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+import Voronoi as dut
+from Grid import makeDomain
+from primitives import Vector2
+
+
+class TestFloodVoronoi(unittest.TestCase):
+
+    def setUp(self):
+        # The sites deliberately include points beyond every boundary of the domain.
+        np.random.seed(5)
+        self.domain = makeDomain(Vector2(0.0, 20.0), Vector2(0.0, 15.0), 0.1)
+        self.sites = np.random.uniform(-1.0, 21.0, (400, 2)).astype(np.float32)
+        self.ids = range(100, 500)
+
+    def ownerDistSq(self, owner, snap):
+        '''Computes the squared distance from each cell center to the site which owns it.'''
+        pos = self.sites.astype(np.float64) / 0.1
+        if snap:
+            pos = np.floor(pos) + 0.5
+        X, Y = np.meshgrid(np.arange(owner.shape[0]) + 0.5, np.arange(owner.shape[1]) + 0.5,
+                           indexing='ij')
+        site = owner - 100
+        distSq = (X - pos[site, 0]) ** 2 + (Y - pos[site, 1]) ** 2
+        distSq[owner < 0] = np.inf
+        return distSq
+
+    def test_infinite(self):
+        '''The flood matches the per-site voronoi for unbounded regions.'''
+        flood = dut.computeFloodVoronoi(self.domain, self.sites, self.ids)
+        brute = dut.computeInfiniteVoronoi(self.domain, self.sites, self.ids)
+        self.assertTrue(np.all(flood.cells >= 100))
+        self.assertTrue(np.array_equal(self.ownerDistSq(flood.cells, False),
+                                       self.ownerDistSq(brute.cells, False)))
+
+    def test_finite(self):
+        '''The flood assigns every cell to an equally near site as the per-site voronoi.'''
+        for limit in (0.75, 2.0):
+            flood = dut.computeFloodVoronoi(self.domain, self.sites, self.ids, limit)
+            brute = dut.computeFiniteVoronoi(self.domain, self.sites, self.ids, limit)
+            self.assertTrue(np.array_equal(flood.cells < 0, brute.cells < 0))
+            self.assertTrue(np.allclose(self.ownerDistSq(flood.cells, True),
+                                        self.ownerDistSq(brute.cells, True)))
+
+    def test_empty(self):
+        '''Without sites, no cell is owned.'''
+        flood = dut.computeFloodVoronoi(self.domain, self.sites[:0], self.ids)
+        self.assertTrue(np.all(flood.cells == -1))
+
+
+class TestIncrementalVoronoi(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(11)
+        self.domain = makeDomain(Vector2(0.0, 20.0), Vector2(0.0, 15.0), 0.1)
+
+    def frames(self):
+        '''Yields a sequence of frames in which a few sites move, leave and enter.'''
+        sites = np.random.uniform(0.0, 15.0, (300, 2))
+        ids = np.arange(300)
+        for f in range(8):
+            moving = np.random.randint(len(ids), size=20)
+            sites[moving] += np.random.normal(0.0, 0.3, (20, 2))
+            if f % 3 == 2:
+                keep = np.arange(len(ids)) != np.random.randint(len(ids))
+                sites = np.vstack((sites[keep], np.random.uniform(0.0, 15.0, (1, 2))))
+                ids = np.append(ids[keep], ids.max() + 1)
+            yield sites, ids
+
+    def test_zeroTolerance(self):
+        '''Without a tolerance, the updates match the diagrams computed from scratch, except
+        for the cells of a region which is split on the grid: a piece of a region which
+        touches no other cell of the region isn't reached by the propagation.'''
+        for limit in (-1, 1.0):
+            incremental = dut.IncrementalVoronoi(tolerance=0.0)
+            for sites, ids in self.frames():
+                grid = incremental.computeVoronoi(self.domain, sites, ids, None, limit)
+                flood = dut.computeFloodVoronoi(self.domain, sites, ids, limit).cells
+                missed = grid.cells != flood
+                self.assertTrue(np.count_nonzero(missed) <= 5)
+                for x, y in zip(*np.nonzero(missed)):
+                    block = (slice(max(x - 1, 0), x + 2), slice(max(y - 1, 0), y + 2))
+                    # every adjacent cell of the same region is missed as well
+                    self.assertTrue(np.all(missed[block][flood[block] == flood[x, y]]))
+            self.assertEqual(incremental.rebuildCount, 1)
+
+    def test_rebuild(self):
+        '''A frame in which too many sites moved is computed from scratch.'''
+        incremental = dut.IncrementalVoronoi()
+        sites = np.random.uniform(0.0, 15.0, (100, 2))
+        incremental.computeVoronoi(self.domain, sites, range(100))
+        incremental.computeVoronoi(self.domain, sites + 1.0, range(100))
+        self.assertEqual(incremental.rebuildCount, 2)
+        self.assertEqual(incremental.updateCount, 0)
+
+
+class TestVoronoiDensity(unittest.TestCase):
+
+    def test_density(self):
+        '''Each cell has the inverse area of the region which contains it.'''
+        np.random.seed(13)
+        domain = makeDomain(Vector2(0.0, 20.0), Vector2(0.0, 15.0), 0.1)
+        sites = np.random.uniform(-1.0, 21.0, (200, 2))
+        for ids in (range(200), range(10 ** 9, 10 ** 9 + 200)):
+            owner = dut.computeVoronoi(domain, sites, ids, None, 1.0).cells
+            grid, density = dut.computeVoronoiDensity(domain, sites, ids, None, 1.0,
+                                                      agentDensity=True)
+            self.assertEqual(density.shape, (200,))
+            for i in (0, 50, 199):
+                area = np.count_nonzero(owner == ids[i]) * domain.cellArea()
+                expected = 1.0 / area if area > 0.0001 else 0.0
+                self.assertAlmostEqual(density[i], expected, places=5)
+                self.assertTrue(np.all(grid.cells[owner == ids[i]] == density[i]))
+            self.assertTrue(np.all(grid.cells[owner == -1] == 0.0))
+
+
+class Wall(object):
+    '''A minimal obstacle polygon.'''
+    def __init__(self, vertices, closed):
+        self.vertices = [Vector2(x, y) for x, y in vertices]
+        self.closed = closed
+
+
+class TestConstrainedVoronoi(unittest.TestCase):
+
+    def setUp(self):
+        self.domain = makeDomain(Vector2(0.0, 20.0), Vector2(0.0, 15.0), 0.1)
+        # a wall at x = 10 which ends at y = 12 and a square obstacle
+        self.obstacles = [Wall(((10.0, -1.0), (10.0, 12.0)), False),
+                          Wall(((3.0, 3.0), (5.0, 3.0), (5.0, 5.0), (3.0, 5.0)), True)]
+
+    def test_unconstrained(self):
+        '''Without obstacles, the geodesic distances are the euclidean distances.'''
+        np.random.seed(7)
+        sites = np.random.uniform(-1.0, 21.0, (300, 2))
+        owner, dist = dut.sweepNearestSites(self.domain, sites, None)
+        flood, distSq = dut.floodNearestSites(self.domain, sites)
+        self.assertTrue(np.all(owner >= 0))
+        self.assertTrue(np.allclose(dist, np.sqrt(distSq)))
+
+    def test_unconstrainedLimit(self):
+        '''Without obstacles, the limited regions cover the cells of the flooded diagram.'''
+        np.random.seed(7)
+        sites = np.random.uniform(-1.0, 21.0, (300, 2))
+        owner, dist = dut.sweepNearestSites(self.domain, sites, None, 1.05)
+        flood, distSq = dut.floodNearestSites(self.domain, sites, 1.05)
+        owned = owner >= 0
+        self.assertTrue(np.array_equal(owned, flood >= 0))
+        self.assertTrue(np.any(~owned))
+        self.assertTrue(np.allclose(dist[owned], np.sqrt(distSq[owned])))
+
+    def test_wall(self):
+        '''Regions don't leak through walls and paths bend around their ends.'''
+        sites = np.array(((9.0, 5.0), (11.0, 5.0)))
+        owner, dist = dut.sweepNearestSites(self.domain, sites, self.obstacles)
+        # below the end of the wall, each site owns its own side
+        self.assertTrue(np.all(owner[:100, :120] != 1))
+        self.assertTrue(np.all(owner[101:, :120] != 0))
+        # the cells inside the square obstacle are owned by no one
+        self.assertTrue(np.all(owner[31:49, 31:49] == -1))
+        # a cell visible from the site has the euclidean distance
+        self.assertAlmostEqual(dist[105, 20], np.hypot(10.55 - 11.0, 2.05 - 5.0))
+        # a cell behind the wall is reached around the end of the wall
+        self.assertEqual(owner[105, 130], 1)
+        self.assertEqual(owner[95, 130], 0)
+        owner, dist = dut.sweepNearestSites(self.domain, sites[:1], self.obstacles)
+        self.assertEqual(owner[101, 110], 0)
+        self.assertTrue(dist[101, 110] >= np.hypot(10.0 - 9.0, 12.0 - 5.0))
+
+    def test_ids(self):
+        '''The voronoi diagram reports the site ids and honors the limit.'''
+        sites = np.array(((9.0, 5.0), (11.0, 5.0)), dtype=np.float32)
+        grid = dut.computeVoronoi(self.domain, sites, (3, 4), self.obstacles, 1.0)
+        self.assertEqual(set(np.unique(grid.cells)), set((-1, 3, 4)))
+        self.assertTrue(np.count_nonzero(grid.cells == 3) <= 1.1 * np.pi * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# This allows execution of this file, in this directory but gives it
+# access to the parent directory (the files under test).
+sys.path.insert(0, os.path.abspath(os.path.relpath('..', os.path.dirname(__file__))))
+
+import numpy as np
+
+import crowdConsistency as dut
+from trajectory.scbData import NPFrameSet, writeNPSCB
+
+
+class FrameInfo:
+    '''The frame set properties written into the header of an scb 2.2 file.'''
+    simStepSize = 0.1
+    ids = None
+
+
+class TestConsistency(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.blockSize = dut.BLOCK_SIZE
+        # several frames per block, so the windows span the blocks
+        dut.BLOCK_SIZE = 7 * 50
+        np.random.seed(5)
+        data = np.random.randn(7, 8, 400).astype(np.float32)
+        # agent 3 has no preferred velocity in frames 100 - 102
+        data[3, dut.VPREF_X:dut.VPREF_Y + 1, 100:103] = 0.0
+        self.scbName = os.path.join(self.folder, 'data.scb')
+        writeNPSCB(self.scbName, data, FrameInfo(), '2.2')
+        self.T = 11
+
+    def tearDown(self):
+        dut.BLOCK_SIZE = self.blockSize
+        shutil.rmtree(self.folder)
+
+    def expected(self):
+        '''The consistency computed with a principal component analysis of each agent's
+        deviations over each window (a replica of matplotlib's mlab.prepca, which the
+        consistency was originally computed with).'''
+        frameSet = NPFrameSet(self.scbName)
+        deviation = dut.frameDeviation(frameSet.frames[:, :, :]).astype(np.float64)
+        frameSet.close()
+        windowCount = deviation.shape[0] - self.T + 1
+        consistency = np.full((windowCount, deviation.shape[1], 6), np.nan)
+        for w in range(windowCount):
+            for a in range(deviation.shape[1]):
+                window = deviation[w:w + self.T, a, :]
+                if not np.all(np.isfinite(window)):
+                    continue
+                centered = window - window.mean(axis=0)
+                U, s, v = np.linalg.svd(centered)
+                variance = s ** 2 / centered.shape[1]
+                components = np.dot(U[:, :2].T, centered)
+                sig = np.sqrt(np.sqrt(np.sum(components ** 2, axis=1)))
+                consistency[w, a, :2] = components[0] / sig[0]
+                consistency[w, a, 2:4] = components[1] / sig[1]
+                consistency[w, a, 4:] = variance / variance.sum()
+        return consistency
+
+    def assertConsistent(self, consistency, expected):
+        '''Asserts that the consistencies have the same axes (up to their signs) and the same
+        fractions of variance.'''
+        self.assertEqual(consistency.shape, expected.shape)
+        for axis in (slice(0, 2), slice(2, 4)):
+            same = np.abs(consistency[:, :, axis] - expected[:, :, axis]).max(axis=2)
+            flipped = np.abs(consistency[:, :, axis] + expected[:, :, axis]).max(axis=2)
+            self.assertTrue(np.all(np.minimum(same, flipped) < 1e-4))
+        self.assertTrue(np.allclose(consistency[:, :, 4:], expected[:, :, 4:], atol=1e-4))
+
+    def readConsistency(self, config):
+        '''Reads every frame of the consistency file.'''
+        reader = dut.ConsistencyReader(dut.consistencyFile(config))
+        return np.array([reader.next().copy() for i in range(reader.frameCount)])
+
+    def config(self, name):
+        return {'tempDir': self.folder, 'tempName': name, 'consistencyWindow': self.T}
+
+    def test_invalidDeviation(self):
+        '''Only the windows containing an invalid deviation lose their consistency.'''
+        expected = self.expected()
+        for workerCount in (1, 3):
+            config = self.config('w%d' % workerCount)
+            dut.streamConsistency(NPFrameSet(self.scbName), config, workerCount)
+            consistency = self.readConsistency(config)
+            invalid = np.isnan(consistency).any(axis=2)
+            self.assertEqual(np.count_nonzero(invalid), 13)
+            self.assertTrue(np.all(invalid[90:103, 3]))
+            self.assertTrue(np.all(np.isnan(consistency[invalid])))
+            self.assertTrue(np.array_equal(invalid, np.isnan(expected).any(axis=2)))
+            self.assertConsistent(consistency[~invalid][None], expected[~invalid][None])
+
+    def test_deviationFile(self):
+        '''The consistency computed from the deviation file matches the streamed consistency.'''
+        config = self.config('file')
+        dut.computeDeviation(NPFrameSet(self.scbName), config)
+        dut.computeConsistency(config)
+        fromFile = self.readConsistency(config)
+        config = self.config('stream')
+        dut.streamConsistency(NPFrameSet(self.scbName), config)
+        streamed = self.readConsistency(config)
+        self.assertTrue(np.array_equal(np.isnan(fromFile), np.isnan(streamed)))
+        valid = ~np.isnan(streamed)
+        self.assertTrue(np.allclose(fromFile[valid], streamed[valid], atol=1e-5))
+
+    def test_window(self):
+        '''The window must be positive, odd and no longer than the data.'''
+        for T in (0, -1, -3, 4):
+            self.assertRaises(ValueError, dut.checkWindow, T, 400)
+        self.assertRaises(ValueError, dut.checkWindow, 401, 400)
+        dut.checkWindow(11, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -198,6 +198,7 @@ class FrameSet:
             raise AttributeError, "Unrecognized scb version: %s" % ( version )
 
         self.effectiveTimeStep = self.simStepSize * frameStep
+        self.frameStep = frameStep
         self.readAgtStride = agtStep
         selectableCount = self.agtCount / self.readAgtStride
         self.readAgtCount = selectableCount
@@ -229,6 +230,9 @@ class FrameSet:
         if verbose:
             print "\tFrame stride size:    ", self.strideDelta, "bytes"
             print "\tAgent stride size:    ", self.agentDelta, "bytes"
+        # the number of complete frames in the file (computed on demand, see fileFrameCount)
+        self.fileFrames = None
+        self.truncatedBytes = 0
         self.currFrame = None
         self.setNext( 0 )
         if ( verbose ):
@@ -268,6 +272,8 @@ class FrameSet:
         s = 'SCB Trajectory data'
         s += '\n\t%d pedestrians' % self.agentCount()
         s += '\n\t%d frames of  data' % self.totalFrames()
+        if ( self.truncatedBytes ):
+            s += '\n\tfinal frame truncated (%d bytes ignored)' % self.truncatedBytes
         return s
     
     def readHeader1_0( self, scbFile ):
@@ -416,24 +422,29 @@ class FrameSet:
         self.file.seek( byteAddr )
         self.currFrameIndex -= 1
 
+    def fileFrameCount( self ):
+        '''Reports the number of complete frames stored in the file, regardless of the
+        frame selection (startFrame, frameStep and maxFrames) of this frame set.
+
+        The count is derived from the file size and cached.  A partially written
+        trailing frame is not counted; its size is recorded in self.truncatedBytes.
+
+        @returns        An int.  The number of complete frames in the file.
+        '''
+        if ( self.fileFrames is None ):
+            bodySize = max( 0, os.fstat( self.file.fileno() ).st_size - self.headerOffset() )
+            if ( self.frameSize > 0 ):
+                self.fileFrames = bodySize / self.frameSize
+                self.truncatedBytes = bodySize % self.frameSize
+            else:
+                self.fileFrames = 0
+        return self.fileFrames
+
     def totalFrames( self ):
-        """Reports the total number of frames in the file"""
-        # does this by scanning the whole file
-        currentPos = self.file.tell()
-        self.setNext( 0 )
-        frameCount = 0
-        data = self.file.read( self.frameSize )
-        while ( len( data ) == self.frameSize ):
-            frameCount += 1
-            self.file.seek( self.readDelta, 1 ) # advance to next frame
-            self.file.seek( self.strideDelta, 1 ) # advance according to stride
-            data = self.file.read( self.frameSize )
-        self.file.seek( currentPos )
-
-        if ( frameCount > self.maxFrames ):
-            return self.maxFrames
-        else:
-            return frameCount
+        """Reports the total number of frames in the frame set"""
+        available = max( 0, self.fileFrameCount() - self.startFrame )
+        frameCount = ( available + self.frameStep - 1 ) / self.frameStep
+        return min( frameCount, self.maxFrames )
 
     def agentCount( self ):
         '''Returns the agent count'''
@@ -548,74 +559,69 @@ class FrameSet:
         self.file.close()
     
 class NPFrameSet( FrameSet ):
-    """A frame set that uses numpy arrays instead of frames as the underlying structure"""
+    """A frame set that uses numpy arrays instead of frames as the underlying structure.
+
+    The body of the scb file is memory mapped and exposed as a strided view of shape
+    (frames, agents, columns).  The frame and agent selection (startFrame, frameStep,
+    maxAgents and agtStep) are simply slices of that view, so walking the data with
+    next, prev and setNext never copies trajectory data.  The returned frames are
+    read-only views into the file."""
     def __init__( self, scbFile, startFrame=0, maxFrames=-1, maxAgents=-1, frameStep=1, agtStep=1 ):
         FrameSet.__init__( self, scbFile, startFrame, maxFrames, maxAgents, frameStep, agtStep )
+        # the arguments required to open an identical, independent frame set (e.g., in
+        #   another process)
+        self.openArgs = ( scbFile, startFrame, maxFrames, maxAgents, frameStep, agtStep )
         # number of columns, per-frame, for the data
         self.colCount = self.agentByteSize / 4
-        
+        self.frames = self.mapFrames()
+        self.frameCount = self.totalFrames()
+
+    def mapFrames( self ):
+        '''Memory maps the body of the scb file and creates the view of the selected
+        frames and agents.
+
+        @returns        A KxNxM numpy array (a view of a numpy memmap) for K selected frames,
+                        N selected agents and M floats per agent.
+        '''
+        fileFrames = self.fileFrameCount()
+        shape = ( fileFrames, self.agtCount, self.colCount )
+        if ( fileFrames == 0 ):
+            body = np.empty( shape, dtype=np.float32 )
+        else:
+            body = np.memmap( self.file, dtype=np.float32, mode='r', offset=self.headerOffset(),
+                              shape=shape )
+        lastAgent = self.readAgtCount * self.readAgtStride
+        return body[ self.startFrame::self.frameStep, :lastAgent:self.readAgtStride, : ]
+
     def next( self, stride=1 ):
         """Returns the next frame in sequence from current point"""
-        if ( self.currFrameIndex >= self.maxFrames - 1 ):
+        index = self.currFrameIndex + stride
+        if ( index >= self.frameCount ):
             raise StopIteration  # TODO: make everything rely on this exception
-        
-        if ( self.currFrame is None):
-            self.currFrame = np.empty( ( self.readAgtCount, self.colCount ), dtype=np.float32 )
-
-        skipAmount = stride - 1
-        original_pos = self.file.tell()
-        if ( skipAmount ):
-            # TODO: Are the semantics of "readDelta" and 'strideDelta" correct here?
-            seek_address = skipAmount * (self.readDelta + self.strideDelta + self.frameSize)
-            self.file.seek(seek_address, os.SEEK_CUR)
-        try:
-            floatCount = self.readAgtCount * self.colCount * self.readAgtStride
-            data = np.fromstring( self.file.read( self.readFrameSize ), np.float32, floatCount )
-            readAgents = self.readAgtCount * self.readAgtStride
-            self.currFrame[:,:] = np.reshape( data, ( readAgents, self.colCount ) )[ ::self.readAgtStride, : ]
-        except ValueError:
-            # We failed to read data; let's put the head back to where it was originally.
-            self.file.seek(original_pos, os.SEEK_SET)
-            raise StopIteration
-        self.currFrameIndex += stride
-
-        # seek forward based on skipping
-        if ( self.agentDelta ):
-            self.file.seek( self.agentDelta, 1 ) # advance to next frame
-        if ( self.strideDelta ):
-            self.file.seek( self.strideDelta, 1 ) # advance according to stride
-
+        self.currFrameIndex = index
+        self.currFrame = self.frames[ index ]
         return self.currFrame, self.currFrameIndex
 
     def prev( self, stride=1 ):
         """Returns the next frame in sequence from current point"""
         if ( self.currFrameIndex >= stride ):
-            self.colCount = self.agentByteSize / 4
-            
             self.currFrameIndex -= stride
-            self.file.seek( -(stride+1) * ( self.readDelta + self.strideDelta+ self.frameSize ), 1 )
-            if ( self.currFrame is None):
-                self.currFrame = np.empty( ( self.readAgtCount, self.colCount ), dtype=np.float32 )
-            self.currFrame[:,:] = np.reshape( np.fromstring( self.file.read( self.frameSize ), np.float32, self.readAgtCount * self.colCount ), ( self.readAgtCount, self.colCount ) )
-            # seek forward based on skipping
-            self.file.seek( self.readDelta, 1 ) # advance to next frame
-            self.file.seek( self.strideDelta, 1 ) # advance according to stride
-        
+            self.currFrame = self.frames[ self.currFrameIndex ]
         return self.currFrame, self.currFrameIndex
 
+    def setNext( self, index ):
+        """Sets the set so that the call to next frame will return frame index"""
+        if ( index < 0 ):
+            index = 0
+        self.currFrameIndex = index - 1
+
     def fullData( self ):
         """Returns an N X M X K array consisting of all trajectory info for the frame set, for
         N agents, M floats per agent and K time steps"""
         # TODO: This should return an instance of SCBDataMemory
         #   The end result should support the normal "SCBData" oeprations.
-        M = self.agentByteSize / 4
-        frameCount = self.totalFrames()
-        data = np.empty( ( self.readAgtCount, M, frameCount ), dtype=np.float32 )
-        self.setNext( 0 )
-        for i in range( frameCount ):
-            frame, idx = self.next()
-            data[ :, :, i ] = frame
-        return data
+        # a single copy out of the memory map
+        return np.array( self.frames[ :self.frameCount ].transpose( 1, 2, 0 ) )
 
     def writeFrame( self, frame, file, agent=-1 ):
         '''Writes the numpy array representing the agent data to the file'''
@@ -629,6 +635,12 @@ class NPFrameSet( FrameSet ):
         # For this data set, it's tautological
         return IDMap( self.agentCount() )
 
+    def close( self ):
+        '''Closes the file and releases the memory map'''
+        self.frames = None
+        self.currFrame = None
+        FrameSet.close( self )
+
 class SCBDataMemory:
     '''A version of SCBData that has the full data set loaded into memory as a numpy array.'''
     def __init__( self ):